@@ -0,0 +1,191 @@
+"""Codecs of the compressed audio uplink from the client to the server, in the framing protocol (framing.py).
+
+The server offers the codecs that it can decode in its hello, {"type": "hello", ..., "codecs": [...]}. The client
+chooses one with {"type": "codec", "codec": NAME, ...the parameters of the encoder}, and the next AUDIO frames are
+encoded. The server answers with {"type": "codec", "codec": NAME}, or with an error, and closes the connection.
+
+    pcm   16-bit PCM without compression, 256 kbit/s. It's the default without the codec message.
+    flac  lossless, with soundfile (libsndfile). Every AUDIO frame is a complete FLAC stream of one chunk, so that it
+          doesn't depend on the other frames.
+    opus  lossy, with PyAV (libopus), for the constrained links. One continuous Opus stream, and every AUDIO frame
+          contains the Opus packets that were completed by the chunk, each of them prefixed by its length (uint16, LE).
+
+The decoders return 16-bit PCM bytes, so the rest of the server processes the same stream as without compression.
+The backends are imported only when the codec is used.
+"""
+import io
+import struct
+
+import numpy as np
+
+SAMPLING_RATE = 16000
+
+PREFERENCE = ["opus", "flac", "pcm"]  # the client's choice when it's not given, the best available one first
+
+
+class PCMEncoder:
+    name = "pcm"
+
+    def encode(self, pcm):
+        return bytes(pcm)
+
+    def flush(self):
+        return b""
+
+    def params(self):
+        return {}
+
+class PCMDecoder:
+
+    def __init__(self, **params):
+        pass
+
+    def decode(self, payload):
+        return payload
+
+
+class FlacEncoder:
+    name = "flac"
+
+    def __init__(self, compression_level=None):
+        import soundfile
+        self.soundfile = soundfile
+        self.compression_level = compression_level
+
+    def encode(self, pcm):
+        samples = np.frombuffer(pcm, dtype="<i2")
+        if len(samples) == 0:
+            return b""
+        out = io.BytesIO()
+        with self.soundfile.SoundFile(out, "w", SAMPLING_RATE, 1, "PCM_16", format="FLAC",
+                                      compression_level=self.compression_level) as f:
+            f.write(samples)
+        return out.getvalue()
+
+    def flush(self):
+        return b""
+
+    def params(self):
+        return {}
+
+class FlacDecoder:
+
+    def __init__(self, **params):
+        import soundfile
+        self.soundfile = soundfile
+
+    def decode(self, payload):
+        if not payload:
+            return b""
+        samples, sr = self.soundfile.read(io.BytesIO(payload), dtype="int16")
+        if sr != SAMPLING_RATE or samples.ndim != 1:
+            raise ValueError(f"FLAC audio must be mono {SAMPLING_RATE} Hz, not {sr} Hz with shape {samples.shape}")
+        return samples.astype("<i2").tobytes()
+
+
+PACKET_LENGTH = struct.Struct("<H")
+
+class OpusEncoder:
+    name = "opus"
+
+    def __init__(self, bitrate=24000):
+        import av
+        self.av = av
+        self.codec = av.CodecContext.create("libopus", "w")
+        self.codec.sample_rate = SAMPLING_RATE
+        self.codec.layout = "mono"
+        self.codec.format = "s16"
+        self.codec.bit_rate = bitrate
+        self.codec.options = {"application": "voip"}
+        self.codec.open()
+        self.pts = 0
+
+    def packets(self, packets):
+        packets = [bytes(p) for p in packets]
+        return b"".join(PACKET_LENGTH.pack(len(p)) + p for p in packets)
+
+    def encode(self, pcm):
+        samples = np.frombuffer(pcm, dtype="<i2")
+        if len(samples) == 0:
+            return b""
+        frame = self.av.AudioFrame.from_ndarray(samples.reshape(1, -1), format="s16", layout="mono")
+        frame.sample_rate = SAMPLING_RATE
+        frame.pts = self.pts
+        self.pts += len(samples)
+        return self.packets(self.codec.encode(frame))
+
+    def flush(self):
+        """the rest of the audio, at the end of the stream"""
+        return self.packets(self.codec.encode(None))
+
+    def params(self):
+        # the encoder's delay at the start of the stream, in 48 kHz samples, from the OpusHead header
+        return {"preskip": PACKET_LENGTH.unpack_from(self.codec.extradata, 10)[0]}
+
+class OpusDecoder:
+
+    def __init__(self, preskip=0, **params):
+        import av
+        self.av = av
+        self.codec = av.CodecContext.create("opus", "r")
+        self.codec.sample_rate = SAMPLING_RATE
+        self.codec.layout = "mono"
+        # Opus decodes to 48 kHz float
+        self.resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLING_RATE)
+        self.skip = int(preskip) * SAMPLING_RATE // 48000 * 2  # bytes of the encoder's delay, they are dropped
+
+    def decode(self, payload):
+        out = bytearray()
+        pos = 0
+        while pos < len(payload):
+            n, = PACKET_LENGTH.unpack_from(payload, pos)
+            pos += PACKET_LENGTH.size
+            for frame in self.codec.decode(self.av.Packet(bytes(payload[pos:pos+n]))):
+                for f in self.resampler.resample(frame):
+                    out += f.to_ndarray().astype("<i2").tobytes()
+            pos += n
+        if self.skip:
+            skipped = min(self.skip, len(out))
+            del out[:skipped]
+            self.skip -= skipped
+        return bytes(out)
+
+
+CODECS = {
+    "pcm": (PCMEncoder, PCMDecoder),
+    "flac": (FlacEncoder, FlacDecoder),
+    "opus": (OpusEncoder, OpusDecoder),
+}
+
+def is_available(name):
+    try:
+        if name == "flac":
+            import soundfile
+            return "FLAC" in soundfile.available_formats()
+        if name == "opus":
+            import av
+            return "libopus" in av.codecs_available and "opus" in av.codecs_available
+    except (ImportError, OSError):
+        return False
+    return name in CODECS
+
+def available_codecs():
+    """the names of the codecs that can be used here, the preferred one first"""
+    return [name for name in PREFERENCE if is_available(name)]
+
+def choose(offered, wanted="auto"):
+    """the codec of the client: wanted, or the preferred one of the codecs that the server offered and that are available"""
+    if wanted != "auto":
+        if wanted not in offered:
+            raise ValueError(f"the server doesn't support the codec {wanted}, only {', '.join(offered)}")
+        return wanted
+    for name in available_codecs():
+        if name in offered:
+            return name
+    return "pcm"
+
+def encoder(name, **options):
+    return CODECS[name][0](**options)
+
+def decoder(name, **params):
+    return CODECS[name][1](**params)
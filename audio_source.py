@@ -0,0 +1,207 @@
+"""Seekable reader of audio files as 16 kHz mono float32, for the simulation, the replay and the bulk mode.
+
+AudioSource reads only the requested range of the file, so that a recording of many hours is neither decoded
+nor held in memory at once:
+
+    16-bit PCM WAV      memory-mapped, without any decoding
+    other formats       soundfile (libsndfile: WAV, FLAC, Ogg/Vorbis and Opus, MP3...), which seeks in the file
+    the rest            (e.g. MP4, M4A) decoded once by PyAV to a temporary raw PCM file, which is memory-mapped
+
+The audio is converted in blocks of block_sec seconds: mixed to mono and, if the file isn't 16 kHz, resampled with
+soxr (as librosa.load does) or scipy. Every block is resampled with a margin of the neighbouring audio, so that the
+result doesn't depend on where the blocks begin. The last cache_blocks converted blocks are cached, the reading in
+chunks (OnlineASRProcessor) needs at most two. The samples are scaled as by librosa.load.
+"""
+import os
+import math
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+SAMPLING_RATE = 16000
+
+
+class WavReader:
+    '''16-bit PCM WAV file, memory-mapped. The other WAV files are read by soundfile.'''
+
+    def __init__(self, path):
+        self.rate = self.channels = None
+        with open(path, "rb") as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+                raise ValueError(f"{path} is not a WAV file")
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise ValueError(f"{path} has no data chunk")
+                chunk, size = struct.unpack("<4sI", header)
+                if chunk == b"fmt ":
+                    fmt = f.read(size)
+                    tag, self.channels, self.rate = struct.unpack_from("<HHI", fmt)
+                    bits, = struct.unpack_from("<H", fmt, 14)
+                    if tag == 0xFFFE and size >= 26:  # WAVE_FORMAT_EXTENSIBLE, the format is in the subformat GUID
+                        tag, = struct.unpack_from("<H", fmt, 24)
+                    if tag != 1 or bits != 16:
+                        raise ValueError(f"{path} is not 16-bit PCM")
+                    f.seek(size % 2, os.SEEK_CUR)
+                elif chunk == b"data":
+                    if self.rate is None:
+                        raise ValueError(f"{path} has no fmt chunk before the data")
+                    offset = f.tell()
+                    # the size of a stream that wasn't finished may be 0 or too large
+                    size = min(size, os.path.getsize(path) - offset) if size else os.path.getsize(path) - offset
+                    break
+                else:
+                    f.seek(size + size % 2, os.SEEK_CUR)
+        self.frames = size // (2*self.channels)
+        self.data = memmap(path, offset, self.frames, self.channels)
+
+    def read(self, start, n):
+        return self.data[start:start+n].astype(np.float32) * (1/32768)
+
+class SoundFileReader:
+    '''any file of libsndfile, with seeking'''
+
+    def __init__(self, path):
+        import soundfile
+        self.file = soundfile.SoundFile(path)
+        self.rate, self.channels, self.frames = self.file.samplerate, self.file.channels, self.file.frames
+
+    def read(self, start, n):
+        self.file.seek(start)
+        return self.file.read(n, dtype="float32", always_2d=True)
+
+class DecodedReader:
+    '''the formats that libsndfile can't read, decoded by PyAV (ffmpeg) to a temporary file of 16-bit PCM, at the
+    original sampling rate'''
+
+    def __init__(self, path):
+        import tempfile
+        import av
+        self.tmp = tempfile.TemporaryFile()
+        with av.open(path) as container:
+            stream = container.streams.audio[0]
+            self.rate, self.channels = stream.rate, stream.channels
+            # interleaved 16-bit, in the original layout and rate
+            resampler = av.AudioResampler(format="s16", layout=stream.layout.name, rate=self.rate)
+            for frame in container.decode(stream):
+                for f in resampler.resample(frame):
+                    self.tmp.write(f.to_ndarray().astype("<i2").tobytes())
+            for f in resampler.resample(None):
+                self.tmp.write(f.to_ndarray().astype("<i2").tobytes())
+        self.tmp.flush()
+        self.frames = self.tmp.tell() // (2*self.channels)
+        self.data = memmap(self.tmp, 0, self.frames, self.channels)
+
+    def read(self, start, n):
+        return self.data[start:start+n].astype(np.float32) * (1/32768)
+
+def memmap(file, offset, frames, channels):
+    if frames == 0:  # an empty file can't be mapped
+        return np.zeros((0, channels), dtype="<i2")
+    return np.memmap(file, dtype="<i2", mode="r", offset=offset, shape=(frames, channels))
+
+def open_reader(path):
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    try:
+        return WavReader(path)
+    except ValueError:
+        pass
+    try:
+        return SoundFileReader(path)
+    except (RuntimeError, ImportError):  # soundfile.LibsndfileError is a RuntimeError
+        pass
+    return DecodedReader(path)
+
+def resample(x, rate):
+    """mono float32 audio x of the sampling rate to SAMPLING_RATE"""
+    try:
+        import soxr
+    except ImportError:
+        from scipy.signal import resample_poly
+        g = math.gcd(rate, SAMPLING_RATE)
+        return resample_poly(x, SAMPLING_RATE // g, rate // g).astype(np.float32)
+    return soxr.resample(x, rate, SAMPLING_RATE, quality="HQ")
+
+
+class AudioSource:
+    '''Random access to the audio of the file path, as 16 kHz mono float32.
+
+    block_sec must be a whole number of seconds, so that a block begins at a whole sample also in the original
+    sampling rate. The memory is at most cache_blocks*block_sec seconds of 16 kHz audio, and the memory-mapped pages
+    of the file that the OS keeps.
+    '''
+
+    def __init__(self, path, block_sec=10, cache_blocks=4):
+        self.path = path
+        self.reader = open_reader(path)
+        self.rate = self.reader.rate
+        self.block = int(block_sec)*SAMPLING_RATE
+        self.cache_blocks = max(1, cache_blocks)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.samples = math.ceil(self.reader.frames * SAMPLING_RATE / self.rate)
+        # the margin of resampling: a whole number of samples in both rates, at least 0.1 s
+        g = math.gcd(self.rate, SAMPLING_RATE)
+        k = math.ceil(0.1 * g)
+        self.margin = self.rate // g * k
+        # mono 16 kHz 16-bit WAV is read directly from the memory-mapped file, without the blocks
+        self.direct = isinstance(self.reader, WavReader) and self.rate == SAMPLING_RATE and self.reader.channels == 1
+
+    @property
+    def duration(self):
+        """in seconds"""
+        return self.samples / SAMPLING_RATE
+
+    def __len__(self):
+        return self.samples
+
+    def read(self, beg, end=None):
+        """the audio from beg to end seconds, to the end of the file without end"""
+        return self.read_samples(int(beg*SAMPLING_RATE), self.samples if end is None else int(end*SAMPLING_RATE))
+
+    def read_samples(self, beg, end):
+        beg, end = max(0, beg), min(end, self.samples)
+        if end <= beg:
+            return np.zeros(0, dtype=np.float32)
+        if self.direct:
+            return self.reader.read(beg, end - beg)[:, 0]
+        with self.lock:
+            first, last = beg // self.block, (end - 1) // self.block
+            parts = [self.get_block(i) for i in range(first, last + 1)]
+        a = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return a[beg - first*self.block:end - first*self.block].copy()
+
+    def get_block(self, i):
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+        a = self.convert_block(i)
+        self.cache[i] = a
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return a
+
+    def convert_block(self, i):
+        beg, end = i*self.block, min((i + 1)*self.block, self.samples)
+        if self.rate == SAMPLING_RATE:
+            return mono(self.reader.read(beg, end - beg))
+        # the block in the original rate, with the margins, as far as the file goes
+        src_beg = beg * self.rate // SAMPLING_RATE
+        src_end = min(self.reader.frames, -(-end * self.rate // SAMPLING_RATE) + self.margin)
+        pad = min(src_beg, self.margin)
+        a = resample(mono(self.reader.read(src_beg - pad, src_end - src_beg + pad)), self.rate)
+        skip = pad * SAMPLING_RATE // self.rate
+        a = a[skip:skip + end - beg]
+        if len(a) < end - beg:
+            a = np.concatenate([a, np.zeros(end - beg - len(a), dtype=np.float32)])
+        return a
+
+def mono(frames):
+    """(n, channels) to (n,), as librosa.to_mono"""
+    if frames.shape[1] == 1:
+        return np.ascontiguousarray(frames[:, 0], dtype=np.float32)
+    return frames.mean(axis=1, dtype=np.float32)
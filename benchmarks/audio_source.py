@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Compares AudioSource (audio_source.py), which reads only the requested chunks of the file, with decoding the whole
+file by librosa.load and slicing it, as load_audio did before.
+
+A synthetic recording of --minutes (made of jfk.wav) is written as 16 kHz WAV and as 44.1 kHz stereo FLAC, and read
+in chunks of --chunk-size seconds as the simulation of whisper_online.py reads it. Every method runs in its own
+process, so that its peak memory (max RSS) is measured alone. The chunks of both methods must be the same, up to
+the rounding of the resampling.
+
+    python3 benchmarks/audio_source.py --minutes 60
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+SAMPLING_RATE = 16000
+
+
+def read_chunks(method, path, chunk_sec):
+    """reads the file in chunks, returns the times and a checksum of the chunks"""
+    t = time.perf_counter()
+    if method == "librosa":
+        import librosa
+        audio, _ = librosa.load(path, sr=SAMPLING_RATE, dtype=np.float32)
+        chunk = lambda beg, end: audio[int(beg*SAMPLING_RATE):int(end*SAMPLING_RATE)]
+        duration = len(audio)/SAMPLING_RATE
+    else:
+        from audio_source import AudioSource
+        source = AudioSource(path)
+        chunk = source.read
+        duration = source.duration
+    first = None
+    sums = []
+    beg = 0.0
+    while beg < duration:
+        a = chunk(beg, beg + chunk_sec)
+        if first is None:
+            first = time.perf_counter() - t
+        sums.append(float(np.abs(a).astype(np.float64).sum()))
+        beg += chunk_sec
+    return {
+        "first_chunk_sec": first,
+        "total_sec": time.perf_counter() - t,
+        "sums": sums,
+        "max_rss_mb": max_rss_mb(),
+    }
+
+def max_rss_mb():
+    # ru_maxrss is inherited from the parent process over fork and exec on Linux, the high water mark isn't
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def run_method(method, path, chunk_sec):
+    out = subprocess.run([sys.executable, __file__, "--run", method, path, "--chunk-size", str(chunk_sec)],
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jfk.wav"), help="Base recording.")
+    parser.add_argument("--minutes", type=float, default=20, help="Length of the synthetic recording.")
+    parser.add_argument("--chunk-size", type=float, default=1.0, dest="chunk_size")
+    parser.add_argument("--run", type=str, nargs=2, default=None, metavar=("METHOD", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(read_chunks(*args.run, args.chunk_size)))
+        return
+
+    import soundfile
+    import librosa
+    from whisper_online import load_audio
+    from streaming import synthetic_audio
+
+    audio = synthetic_audio(load_audio(args.audio), args.minutes)
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        wav = os.path.join(tmp, "recording.wav")
+        soundfile.write(wav, audio, SAMPLING_RATE, subtype="PCM_16")
+        flac = os.path.join(tmp, "recording_44k.flac")
+        a44 = librosa.resample(audio, orig_sr=SAMPLING_RATE, target_sr=44100)
+        soundfile.write(flac, np.stack([a44, a44], axis=1), 44100, subtype="PCM_16")
+        del a44
+
+        print(f"{args.minutes:g} minutes, chunks of {args.chunk_size} seconds")
+        print(f"{'file':20s} {'method':12s} {'first chunk s':>14s} {'total s':>8s} {'max RSS MB':>11s}")
+        for path in (wav, flac):
+            results = {}
+            for method in ("librosa", "audio_source"):
+                r = results[method] = run_method(method, path, args.chunk_size)
+                print(f"{os.path.basename(path):20s} {method:12s} {r['first_chunk_sec']:14.3f} {r['total_sec']:8.2f} {r['max_rss_mb']:11.1f}")
+            a, b = (np.array(results[m]["sums"]) for m in ("librosa", "audio_source"))
+            # the sums of the absolute values of the chunks, up to 1e-6 per sample
+            if len(a) != len(b) or np.abs(a - b).max() > 1e-6*args.chunk_size*SAMPLING_RATE:
+                print(f"{os.path.basename(path)}: the chunks differ")
+                failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Compares the codecs of the audio uplink (audio_codecs.py): the bandwidth that they save against 16-bit PCM, and the
+CPU time that the server spends decoding them.
+
+The audio (jfk.wav and a synthetic recording made of it) is encoded in chunks of --chunk-size seconds, as
+client_connect.py sends them, and decoded by the server's decoder. Lossless codecs must decode to the same samples,
+for the lossy ones the signal-to-noise ratio is reported.
+
+    python3 benchmarks/codec_uplink.py --minutes 10
+    python3 benchmarks/codec_uplink.py --codecs flac opus --opus-bitrate 16000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online import load_audio
+import audio_codecs
+from streaming import synthetic_audio
+
+SAMPLING_RATE = 16000
+
+
+def run(codec, pcm, chunk_sec, options):
+    encoder = audio_codecs.encoder(codec, **options)
+    step = int(chunk_sec*SAMPLING_RATE)*2
+    t = time.perf_counter()
+    payloads = [encoder.encode(pcm[i:i+step]) for i in range(0, len(pcm), step)]
+    payloads.append(encoder.flush())
+    encode_time = time.perf_counter() - t
+
+    decoder = audio_codecs.decoder(codec, **encoder.params())
+    t = time.perf_counter()
+    decoded = b"".join(decoder.decode(p) for p in payloads if p)
+    decode_time = time.perf_counter() - t
+
+    sent = sum(len(p) for p in payloads if p)
+    original = np.frombuffer(pcm, dtype="<i2").astype(np.float64)
+    out = np.frombuffer(decoded, dtype="<i2").astype(np.float64)
+    n = min(len(original), len(out))
+    noise = ((original[:n] - out[:n])**2).sum()
+    snr = float("inf") if noise == 0 else 10*np.log10((original[:n]**2).sum()/noise)
+    return {
+        "sent_bytes": sent,
+        "encode_sec": encode_time,
+        "decode_sec": decode_time,
+        "samples": (len(original), len(out)),
+        "snr_db": snr,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jfk.wav"), help="Base recording.")
+    parser.add_argument("--minutes", type=float, default=5, help="Length of the synthetic recording.")
+    parser.add_argument("--chunk-size", type=float, default=0.2, help="Seconds of audio per AUDIO frame, as client_connect.py sends.")
+    parser.add_argument("--codecs", type=str, nargs="*", default=None, help="Codecs to compare. By default, all the available ones.")
+    parser.add_argument("--opus-bitrate", type=int, default=24000)
+    args = parser.parse_args()
+
+    base = load_audio(args.audio)
+    codecs = args.codecs or audio_codecs.available_codecs()
+    print(f"codecs: {', '.join(codecs)}, chunks of {args.chunk_size} seconds")
+    failed = False
+    for name, audio in ((os.path.basename(args.audio), base), (f"synthetic-{args.minutes:g}min", synthetic_audio(base, args.minutes))):
+        pcm = (np.clip(audio, -1, 32767/32768)*32768).astype("<i2").tobytes()
+        duration = len(audio)/SAMPLING_RATE
+        print(f"\n{name}, {duration:.1f} seconds")
+        print(f"{'codec':6s} {'kbit/s':>8s} {'saved':>7s} {'encode s/h':>11s} {'decode s/h':>11s} {'SNR dB':>7s}")
+        for codec in codecs:
+            options = {"bitrate": args.opus_bitrate} if codec == "opus" else {}
+            r = run(codec, pcm, args.chunk_size, options)
+            kbit = r["sent_bytes"]*8/duration/1000
+            saved = 1 - r["sent_bytes"]/len(pcm)
+            # CPU seconds per hour of audio
+            enc, dec = r["encode_sec"]/duration*3600, r["decode_sec"]/duration*3600
+            print(f"{codec:6s} {kbit:8.1f} {saved:7.1%} {enc:11.2f} {dec:11.2f} {r['snr_db']:7.1f}")
+            if codec in ("pcm", "flac") and r["snr_db"] != float("inf"):
+                print(f"{codec} is lossless, but the decoded audio differs")
+                failed = True
+            if abs(r["samples"][0] - r["samples"][1]) > args.chunk_size*SAMPLING_RATE:
+                print(f"{codec}: {r['samples'][0]} samples were sent, {r['samples'][1]} decoded")
+                failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
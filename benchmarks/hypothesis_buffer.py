@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Benchmark of HypothesisBuffer. It replays long sessions of word streams through the previous list-based
+implementation (copied below) and through the current one, checks that they commit the same words, and reports the time.
+
+The replay follows OnlineASRProcessor: every iteration, the "Whisper" hypothesis contains the words of the audio buffer
+from buffer_time_offset until now. Its last words are unstable (randomly replaced), so LocalAgreement commits only
+a part of them. Every --trim-every seconds, the buffer is trimmed at the last commited word (pop_commited), so that
+the buffers grow long, as with a long --buffer_trimming_sec.
+
+    python3 benchmarks/hypothesis_buffer.py --words 20000 --trim-every 30
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online import HypothesisBuffer
+
+log = logging.getLogger(__name__)
+
+
+class OldHypothesisBuffer:
+    """HypothesisBuffer before it was array-backed, for comparison"""
+
+    def __init__(self, logfile=sys.stderr):
+        self.commited_in_buffer = []
+        self.buffer = []
+        self.new = []
+
+        self.last_commited_time = 0
+        self.last_commited_word = None
+
+        self.logfile = logfile
+
+    def insert(self, new, offset):
+        # compare self.commited_in_buffer and new. It inserts only the words in new that extend the commited_in_buffer, it means they are roughly behind last_commited_time and new in content
+        # the new tail is added to self.new
+        
+        new = [(a+offset,b+offset,t) for a,b,t in new]
+        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
+
+        if len(self.new) >= 1:
+            a,b,t = self.new[0]
+            if abs(a - self.last_commited_time) < 1:
+                if self.commited_in_buffer:
+                    # it's going to search for 1, 2, ..., 5 consecutive words (n-grams) that are identical in commited and new. If they are, they're dropped.
+                    cn = len(self.commited_in_buffer)
+                    nn = len(self.new)
+                    for i in range(1,min(min(cn,nn),5)+1):  # 5 is the maximum 
+                        c = " ".join([self.commited_in_buffer[-j][2] for j in range(1,i+1)][::-1])
+                        tail = " ".join(self.new[j-1][2] for j in range(1,i+1))
+                        if c == tail:
+                            words = []
+                            for j in range(i):
+                                words.append(repr(self.new.pop(0)))
+                            words_msg = " ".join(words)
+                            log.debug(f"removing last {i} words: {words_msg}")
+                            break
+
+    def flush(self):
+        # returns commited chunk = the longest common prefix of 2 last inserts. 
+
+        commit = []
+        while self.new:
+            na, nb, nt = self.new[0]
+
+            if len(self.buffer) == 0:
+                break
+
+            if nt == self.buffer[0][2]:
+                commit.append((na,nb,nt))
+                self.last_commited_word = nt
+                self.last_commited_time = nb
+                self.buffer.pop(0)
+                self.new.pop(0)
+            else:
+                break
+        self.buffer = self.new
+        self.new = []
+        self.commited_in_buffer.extend(commit)
+        return commit
+
+    def pop_commited(self, time):
+        while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
+            self.commited_in_buffer.pop(0)
+
+    def complete(self):
+        return self.buffer
+
+
+def replay(buffer_cls, words, word_len, chunk, trim_every, seed=0):
+    """Returns (commited words, seconds spent in the buffer methods)"""
+    rnd = random.Random(seed)
+    buf = buffer_cls()
+    offset = 0.0
+    last_trim = 0.0
+    now = chunk
+    commited = []
+    spent = 0.0
+    while now <= len(words)*word_len:
+        hyp = [(b-offset, e-offset, t) for b, e, t in words[int(round(offset/word_len)):int(now/word_len)]]
+        for k in range(1, min(3, len(hyp))+1):  # unstable tail
+            if rnd.random() < 0.5:
+                hyp[-k] = (hyp[-k][0], hyp[-k][1], " x%d" % rnd.randrange(50))
+
+        t = time.perf_counter()
+        buf.insert(hyp, offset)
+        commited.extend(buf.flush())
+        buf.complete()
+        if now - last_trim > trim_every and commited:
+            last_trim = now
+            offset = commited[-1][1]
+            buf.pop_commited(offset)
+        spent += time.perf_counter() - t
+        now += chunk
+    return commited, spent
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", type=int, default=20000, help="Number of words in one session. 20000 words is appx. 100 minutes of speech.")
+    parser.add_argument("--sessions", type=int, default=3)
+    parser.add_argument("--chunk", type=float, default=1.0, help="Seconds of audio between two iterations.")
+    parser.add_argument("--trim-every", type=float, default=30, help="Seconds between buffer trimmings.")
+    args = parser.parse_args()
+
+    word_len = 0.3
+    total = {OldHypothesisBuffer: 0.0, HypothesisBuffer: 0.0}
+    for session in range(args.sessions):
+        rnd = random.Random(session)
+        words = [(i*word_len, (i+1)*word_len, " w%d" % rnd.randrange(5000)) for i in range(args.words)]
+        results = {}
+        for cls in total:
+            results[cls], spent = replay(cls, words, word_len, args.chunk, args.trim_every, seed=session)
+            total[cls] += spent
+        assert results[OldHypothesisBuffer] == results[HypothesisBuffer], "the buffers commited different words"
+
+    n = args.sessions * args.words * word_len / args.chunk
+    print(f"{args.sessions} sessions of {args.words} words, {n:.0f} iterations, trimming every {args.trim_every} s")
+    for cls, spent in total.items():
+        print(f"{cls.__name__:20s} {spent:8.3f} s, {spent/n*1e6:8.1f} us per iteration")
+    print(f"speed-up: {total[OldHypothesisBuffer]/total[HypothesisBuffer]:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the per-packet CPU cost of the server's PCM ingest path.
+
+It compares the previous path -- recv of a new PACKET_SIZE bytes object, then io.BytesIO, soundfile.SoundFile RAW
+and librosa.load -- with Connection.non_blocking_receive_audio, which receives into a reused buffer with recv_into
+and converts int16 to float32 with a vectorized numpy view. The packets go through a local socket pair.
+
+    python3 benchmarks/pcm_ingest.py --packet-bytes 6400 --packets 2000
+"""
+import os
+import sys
+import io
+import time
+import socket
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online_server import Connection, SAMPLING_RATE
+
+
+def old_receive(conn):
+    return lambda: old_receive_audio(conn)
+
+def old_receive_audio(conn):
+    import soundfile
+    import librosa
+    raw_bytes = conn.recv(Connection.PACKET_SIZE)
+    sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
+    audio, _ = librosa.load(sf,sr=SAMPLING_RATE,dtype=np.float32)
+    return audio
+
+def new_receive(conn):
+    return Connection(conn).non_blocking_receive_audio
+
+def run(receive_factory, packets):
+    a, b = socket.socketpair()
+    out = []
+    total = 0.0
+    with a, b:
+        receive = receive_factory(b)
+        for p in packets:
+            a.sendall(p)
+            t = time.perf_counter()
+            out.append(receive())
+            total += time.perf_counter() - t
+    return total, np.concatenate(out)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packet-bytes", type=int, default=6400, help="Packet size in bytes, 6400 is 0.2 seconds of audio sent by client_connect.py.")
+    parser.add_argument("--packets", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    pcm = rng.integers(-2**15, 2**15, size=args.packet_bytes*args.packets//2, dtype="<i2").tobytes()
+    packets = [pcm[i:i+args.packet_bytes] for i in range(0, len(pcm), args.packet_bytes)]
+
+    # warm up the imports and the numba cache of librosa
+    run(old_receive, packets[:2])
+
+    old_time, old_audio = run(old_receive, packets)
+    new_time, new_audio = run(new_receive, packets)
+
+    # the reference is the whole stream converted at once; an odd packet size splits the samples across packets
+    reference = np.frombuffer(pcm[:len(pcm)//2*2], dtype="<i2") / 32768
+    assert np.array_equal(new_audio, reference[:len(new_audio)]), "the new conversion differs"
+    if not (len(old_audio) == len(reference) and np.array_equal(old_audio, reference)):
+        print("note: the previous path did not reconstruct the stream correctly")
+
+    n = len(packets)
+    print(f"{n} packets of {args.packet_bytes} bytes")
+    print(f"soundfile + librosa.load: {old_time/n*1e6:8.1f} us per packet")
+    print(f"recv_into + numpy view:   {new_time/n*1e6:8.1f} us per packet")
+    print(f"speed-up: {old_time/new_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Checks the experimental prefix decoding (--experimental-prefix-decoding) with a real backend: that it stays on, and
+that it reduces the decoding work.
+
+The same recording (a synthetic one made of jfk.wav, --minutes long) is streamed twice through OnlineASRProcessor,
+computationally unaware, in chunks of --min-chunk-size: with the full decoding of the audio buffer in every iteration,
+and with the commited text inside of the buffer as the forced decoding prefix. For both, it reports the time of the
+transcribe calls, and the decoder steps, the tokens of the words that the backend returned (count_tokens). With the
+prefix, the commited words aren't decoded again, so there should be fewer steps. It reports also the prefix
+fallbacks, and the similarity of the two transcripts.
+
+It takes the model options of whisper_online.py. Only faster-whisper supports the prefix:
+
+    python3 benchmarks/prefix_decoding.py --backend faster-whisper --model small --lan en --minutes 2
+
+It fails with AssertionError if the prefix decoding was switched off, if it was rejected in more than --max-fallbacks
+of the iterations, or if it didn't save any decoder steps. It's skipped if the backend can't be loaded.
+"""
+import os
+import sys
+import time
+import difflib
+import argparse
+import logging
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online import add_shared_args, backend_factory, online_factory, load_audio, VACOnlineASRProcessor
+from streaming import synthetic_audio
+
+SAMPLING_RATE = 16000
+
+
+class CountingASR:
+    """Proxy of the backend, it counts the transcribe calls, their time, and the tokens of the returned words"""
+
+    def __init__(self, asr):
+        self.asr = asr
+        self.calls = 0
+        self.seconds = 0.0
+        self.steps = 0
+
+    def transcribe(self, audio, *args, **kwargs):
+        t = time.perf_counter()
+        res = self.asr.transcribe(audio, *args, **kwargs)
+        self.seconds += time.perf_counter() - t
+        self.calls += 1
+        self.steps += self.asr.count_tokens(self.asr.sep.join(w[2] for w in self.asr.ts_words(res)))
+        return res
+
+    def __getattr__(self, name):
+        return getattr(self.asr, name)
+
+def run(args, asr, audio, prefix_decoding):
+    args.prefix_decoding = prefix_decoding
+    counting = CountingASR(asr)
+    online = online_factory(args, counting, logfile=open(os.devnull, "w"))
+    processor = online.online if isinstance(online, VACOnlineASRProcessor) else online
+    online.init()
+    step = int(args.min_chunk_size*SAMPLING_RATE)
+    words = []
+    for beg in range(0, len(audio), step):
+        online.insert_audio_chunk(audio[beg:beg+step])
+        o = online.process_iter()
+        if o[0] is not None:
+            words += o[2].split()
+    o = online.finish()
+    online.close()
+    if o[0] is not None:
+        words += o[2].split()
+    return {"words": words, "calls": counting.calls, "seconds": counting.seconds, "steps": counting.steps,
+            "still_on": processor.prefix_decoding, "fallbacks": processor.prefix_fallbacks,
+            "steps_saved": processor.prefix_steps_saved}
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_shared_args(parser)
+    parser.add_argument("--audio", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jfk.wav"), help="Base recording.")
+    parser.add_argument("--minutes", type=float, default=2, help="Length of the synthetic recording.")
+    parser.add_argument("--max-fallbacks", type=float, default=0.1, dest="max_fallbacks", help="Allowed ratio of the rejected prefixes to the iterations.")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    try:
+        asr = backend_factory(args)
+    except (ImportError, OSError, ValueError, RuntimeError) as e:
+        print(f"skipped: the {args.backend} backend can't be loaded: {e}")
+        return
+    if not getattr(asr, "supports_prefix", False):
+        print(f"skipped: the {args.backend} backend does not support prefix decoding")
+        return
+
+    audio = synthetic_audio(load_audio(args.audio), args.minutes)
+    full = run(args, asr, audio, False)
+    prefix = run(args, asr, audio, True)
+
+    for name, r in (("full decoding", full), ("prefix decoding", prefix)):
+        print(f"{name:16s} {r['calls']:5d} transcribe calls {r['seconds']:8.2f} s {r['steps']:7d} decoder steps {len(r['words']):6d} words")
+    print(f"prefix decoding: {'still on' if prefix['still_on'] else 'SWITCHED OFF'}, {prefix['fallbacks']} fallbacks, "
+          f"{prefix['steps_saved']} decoder steps saved by the prefixes")
+    print(f"time {prefix['seconds']/max(full['seconds'], 1e-9):.2f}x, decoder steps {prefix['steps']/max(full['steps'], 1):.2f}x of the full decoding")
+    print(f"transcript similarity: {difflib.SequenceMatcher(a=full['words'], b=prefix['words']).ratio():.3f}")
+
+    assert prefix["still_on"], "the prefix decoding was switched off"
+    assert prefix["fallbacks"] <= args.max_fallbacks*prefix["calls"], f"the prefix was rejected {prefix['fallbacks']} times in {prefix['calls']} calls"
+    assert prefix["steps"] < full["steps"], "the prefix decoding didn't reduce the decoder steps"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Split latency of the sentence tokenizers of the "sentence" buffer trimming: the rule-based splitter of
+sentence_split.py, Moses, tokenize_uk and WtP. The ones that aren't installed are skipped.
+
+Every tokenizer is loaded by create_tokenizer (the load time is reported too) and splits texts of --sentences
+sentences, as SentenceSegmenter passes them: the confirmed text after the last complete sentence, a few sentences
+long. The median time of --repeat calls is reported, and the number of the sentences found, which should be the
+number of the sentences of the text.
+
+    python3 benchmarks/sentence_split.py
+    python3 benchmarks/sentence_split.py --lan uk --sentences 2 10 --wtp-model /models/wtp-canine-s-12l-no-adapters
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online import create_tokenizer, WTP_MODEL
+
+SENTENCES = {
+    "en": ["And so, my fellow Americans, ask not what your country can do for you, ask what you can do for your country.",
+           "Mr. Smith arrived at 9.30 a.m. on Monday.",
+           "Is this the right place?",
+           "The U.S. economy grew by 2.5 percent, according to Dr. Jones!",
+           "It was, e.g., the best of times."],
+    "de": ["Am 3. Oktober feiern wir den Tag der Deutschen Einheit.",
+           "Das ist z.B. ein gutes Beispiel.",
+           "Kommst du morgen?",
+           "Herr Dr. Müller hat bzw. hatte recht."],
+    "uk": ["Сьогодні чудова погода.",
+           "Ми поїхали на вул. Хрещатик, д. 5.",
+           "Ти прийдеш завтра?",
+           "Це було у 2020 р. навесні!"],
+}
+
+def time_split(tokenizer, text, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        sents = tokenizer.split(text)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times), len(sents)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lan", type=str, default="en", choices=sorted(SENTENCES), help="Language of the texts.")
+    parser.add_argument("--sentences", type=int, nargs="+", default=[2, 5, 20, 100], help="Lengths of the texts in sentences.")
+    parser.add_argument("--tokenizers", type=str, nargs="+", default=["rules", "moses", "tokenize_uk", "wtp"])
+    parser.add_argument("--wtp-model", type=str, default=WTP_MODEL, dest="wtp_model")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    base = SENTENCES[args.lan]
+    texts = [(n, " ".join(base[i % len(base)] for i in range(n))) for n in args.sentences]
+
+    print(f"{'tokenizer':12s} {'load s':>7s} " + " ".join(f"{f'{n} sent. ms':>12s} {'found':>5s}" for n, _ in texts))
+    for kind in args.tokenizers:
+        t = time.perf_counter()
+        try:
+            tokenizer = create_tokenizer(args.lan, kind, args.wtp_model)
+        except (ImportError, OSError) as e:
+            print(f"{kind:12s} not available: {e}")
+            continue
+        load = time.perf_counter() - t
+        if kind == "wtp" and type(tokenizer).__name__ == "RuleSplitter":
+            print(f"{kind:12s} not available: the model can't be loaded")
+            continue
+        tokenizer.split(texts[0][1])  # the first call may start a subprocess or compile the model
+        row = []
+        for n, text in texts:
+            sec, found = time_split(tokenizer, text, args.repeat)
+            row.append(f"{sec*1000:12.3f} {found:5d}")
+        print(f"{kind:12s} {load:7.2f} " + " ".join(row))
+
+if __name__ == "__main__":
+    main()
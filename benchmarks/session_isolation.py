@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Checks that the concurrent sessions of CaptionServer don't interfere: every client gets the same commited words
+as when it's the only client of the server.
+
+CaptionServer runs in this process on a free local port, with the deterministic ScriptedASR (benchmarks/streaming.py)
+instead of a Whisper model. Every client streams its own synthetic recording (made of jfk.wav with different gains
+and pauses) in the raw protocol. Every stream is run alone first, then all of them at once, with every --batch-size,
+and the commited words must be the same.
+
+The commited words depend on how the audio is chunked to the processing iterations, so the clients send exactly
+one chunk of --min-chunk-size seconds every --interval seconds, which must be enough for the server to process it
+before the next one arrives. Then the chunks are the same alone and together. It fails with AssertionError, showing
+the first different word, if any session got other words together than alone, i.e. if the sessions share state.
+
+    python3 benchmarks/session_isolation.py --clients 4 --seconds 60 --batch-size 1 4
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online import add_shared_args, load_audio
+from whisper_online_server import CaptionServer, add_server_args
+from streaming import ScriptedASR, synthetic_audio
+
+SAMPLING_RATE = 16000
+
+
+def start_server(batch_size, delay, min_chunk):
+    """CaptionServer with ScriptedASR on a free local port, served by a daemon thread. Returns the port."""
+    parser = argparse.ArgumentParser()
+    add_server_args(parser)
+    add_shared_args(parser)
+    args = parser.parse_args(["--host", "127.0.0.1", "--port", "0", "--batch-size", str(batch_size), "--min-chunk-size", str(min_chunk), "--log-level", "WARNING"])
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((args.host, args.port))
+    s.listen()
+    server = CaptionServer(args, ScriptedASR(delay=delay))
+    threading.Thread(target=server.serve, args=(s,), name="caption-server", daemon=True).start()
+    return s.getsockname()[1]
+
+def stream(port, audio, min_chunk, interval, out):
+    """sends the audio to the server in the raw protocol, a chunk of min_chunk seconds every interval seconds,
+    and appends the words of the received lines to out"""
+    pcm = (np.clip(audio, -1, 1)*32767).astype("<i2").tobytes()
+    chunk = int(min_chunk*SAMPLING_RATE)*2
+    with socket.create_connection(("127.0.0.1", port)) as c:
+        def receive():
+            data = bytearray()
+            while True:
+                b = c.recv(65536)
+                if not b:
+                    break
+                data += b
+            for line in data.replace(b"\0", b"").decode("utf-8").splitlines():
+                out.extend(line.split()[2:])  # beg end text
+        reader = threading.Thread(target=receive)
+        reader.start()
+        for i in range(0, len(pcm), chunk):
+            c.sendall(pcm[i:i+chunk])
+            time.sleep(interval)
+        c.shutdown(socket.SHUT_WR)
+        reader.join()
+
+def run_clients(port, audios, min_chunk, interval):
+    outs = [[] for _ in audios]
+    threads = [threading.Thread(target=stream, args=(port, a, min_chunk, interval, o)) for a, o in zip(audios, outs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return outs
+
+def first_difference(a, b):
+    """index of the first different word of the lists a and b"""
+    return next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+
+def check_isolation(alone, together, batch_size):
+    """asserts that every session got the same words together with the others as alone"""
+    for i, (a, t) in enumerate(zip(alone, together)):
+        print(f"batch size {batch_size}, client {i}: {len(a)} words alone, {len(t)} together: {'same' if a == t else 'DIFFERENT'}")
+    for i, (a, t) in enumerate(zip(alone, together)):
+        k = first_difference(a, t)
+        assert a == t, (f"batch size {batch_size}: client {i} got different words together with the other clients, from word {k}: "
+                        f"{' '.join(a[k:k+8])!r} alone, {' '.join(t[k:k+8])!r} together")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jfk.wav"), help="Base recording.")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=45, help="Length of every stream.")
+    parser.add_argument("--min-chunk-size", type=float, default=1.0, dest="min_chunk_size", help="Seconds of audio of every chunk.")
+    parser.add_argument("--interval", type=float, default=0.25, help="Seconds between the chunks of a client.")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 4], dest="batch_size")
+    parser.add_argument("--delay", type=float, default=0.01, help="Seconds of every ScriptedASR call.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    base = load_audio(args.audio)
+    audios = [synthetic_audio(base, args.seconds/60, seed=i) for i in range(args.clients)]
+
+    port = start_server(1, args.delay, args.min_chunk_size)
+    alone = [run_clients(port, [a], args.min_chunk_size, args.interval)[0] for a in audios]
+    assert all(alone), "a stream alone got no words"
+    # with the same words, a mixed up session couldn't be detected
+    assert len({tuple(w) for w in alone}) == len(alone), "the streams must give different words"
+
+    for batch_size in args.batch_size:
+        port = start_server(batch_size, args.delay, args.min_chunk_size)
+        together = run_clients(port, audios, args.min_chunk_size, args.interval)
+        check_isolation(alone, together, batch_size)
+
+if __name__ == "__main__":
+    main()
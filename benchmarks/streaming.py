@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""Deterministic benchmark of the streaming pipeline's own overhead, without a Whisper model in the loop.
+
+It runs the computationally unaware simulation of whisper_online.py (--comp_unaware) on jfk.wav and on synthetic
+long recordings, with ScriptedASR instead of a real backend. ScriptedASR returns canned timestamped words, derived
+from the audio content, after a configurable delay. The suite reports time per pipeline stage (PCM decode, VAD,
+transcribe, HypothesisBuffer merge, prompt building, trimming), memory growth and emission latency, as JSON.
+With --transcribe-memo, the hits, skips and misses of TranscribeMemo are reported too.
+
+Per commited word, it compares the time to first display, when the word appeared in the interim (uncommitted) hypothesis
+or was commited, with the time to commit. Both are measured from the end of the word in the audio.
+
+    python3 benchmarks/streaming.py --synthetic-minutes 10 30 --json bench.json
+    python3 benchmarks/streaming.py --compare bench.json   # reports the regressions against an earlier run
+
+With --vac, VACOnlineASRProcessor is benchmarked. It needs the VAD model (torch).
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online import *
+from whisper_online_server import pcm16_to_float32
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+
+class ScriptedASR(ASRBase):
+    """Whisper-like stub backend. It splits the audio buffer to words of word_len seconds and names every word
+    by a checksum of its audio, so the same audio gives the same words in the next iterations, and LocalAgreement
+    works as with a real model. The last word depends also on the buffer length, so it's unstable, as the end of
+    real Whisper hypotheses. The words are grouped to segments of segment_words.
+
+    Every transcribe call sleeps delay + delay_per_sec * buffer length.
+    """
+
+    sep = " "
+    supports_prefix = True
+
+    VOCAB = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliett", "kilo",
+             "lima", "mike", "november", "oscar", "papa", "quebec", "romeo", "sierra", "tango", "uniform", "victor",
+             "whiskey", "xray", "yankee", "zulu"]
+
+    def __init__(self, word_len=0.4, segment_words=8, delay=0.0, delay_per_sec=0.0):
+        self.word_len = word_len
+        self.segment_words = segment_words
+        self.delay = delay
+        self.delay_per_sec = delay_per_sec
+        super().__init__("en")
+
+    def load_model(self, *args, **kwargs):
+        return None
+
+    def transcribe(self, audio, init_prompt="", prefix=None):
+        seconds = len(audio)/SAMPLING_RATE
+        if self.delay or self.delay_per_sec:
+            time.sleep(self.delay + self.delay_per_sec*seconds)
+        n = int(seconds/self.word_len)
+        w = int(self.word_len*SAMPLING_RATE)
+        words = []
+        for i in range(n):
+            checksum = int(np.abs(audio[i*w:(i+1)*w]).sum()*1000)
+            if i == n-1:
+                checksum += len(audio)//w  # the unstable end
+            words.append((i*self.word_len, (i+1)*self.word_len, self.VOCAB[checksum % len(self.VOCAB)]))
+        return [{"end": ws[-1][1], "words": ws} for ws in
+                (words[i:i+self.segment_words] for i in range(0, len(words), self.segment_words))]
+
+    def ts_words(self, res):
+        return [w for s in res for w in s["words"]]
+
+    def segments_end_ts(self, res):
+        return [s["end"] for s in res]
+
+    def use_vad(self):
+        pass
+
+    def set_translate_task(self):
+        pass
+
+
+class Timed:
+    """Proxy of an object, it adds the time spent in the given methods to stats[stage]"""
+
+    def __init__(self, obj, stats, methods):
+        object.__setattr__(self, "obj", obj)
+        object.__setattr__(self, "stats", stats)
+        object.__setattr__(self, "methods", methods)
+
+    def __getattr__(self, name):
+        attr = getattr(self.obj, name)
+        if name not in self.methods:
+            return attr
+        stage = self.methods[name]
+        def timed(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.stats[stage][0] += time.perf_counter() - t
+                self.stats[stage][1] += 1
+        return timed
+
+    def __setattr__(self, name, value):
+        setattr(self.obj, name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self.__getattr__("__call__")(*args, **kwargs)
+
+
+def instrument(online, stats):
+    """wraps the stages of online (OnlineASRProcessor or VACOnlineASRProcessor) in timing proxies"""
+    if isinstance(online, VACOnlineASRProcessor):
+        online.vac = Timed(online.vac, stats, {"events": "vad"})
+        online = online.online
+    online.asr = Timed(online.asr, stats, {"transcribe": "transcribe"})
+    online.prompt = Timed(online, stats, {"prompt": "prompt"}).prompt
+    online.chunk_completed_segment = Timed(online, stats, {"chunk_completed_segment": "trimming"}).chunk_completed_segment
+    online.chunk_completed_sentence = Timed(online, stats, {"chunk_completed_sentence": "trimming"}).chunk_completed_sentence
+    init = online.init
+    def timed_init(*args, **kwargs):
+        init(*args, **kwargs)
+        online.transcript_buffer = Timed(online.transcript_buffer, stats, {"insert": "merge", "flush": "merge", "complete": "merge"})
+    online.init = timed_init
+    timed_init()
+
+def synthetic_audio(base, minutes, seed=0):
+    """concatenates the base recording with random gains and pauses, until it's the given length"""
+    rnd = np.random.default_rng(seed)
+    parts = []
+    n = 0
+    while n < minutes*60*SAMPLING_RATE:
+        part = base*rnd.uniform(0.5, 1.0)
+        pause = np.zeros(int(rnd.uniform(0.2, 2.0)*SAMPLING_RATE), dtype=np.float32)
+        parts += [part, pause]
+        n += len(part) + len(pause)
+    return np.concatenate(parts)[:int(minutes*60*SAMPLING_RATE)].astype(np.float32)
+
+def percentiles(values):
+    if not values:
+        return None
+    v = np.array(values)
+    return {"mean": float(v.mean()), "p50": float(np.percentile(v, 50)), "p90": float(np.percentile(v, 90)), "max": float(v.max())}
+
+class DisplayTimes:
+    """Remembers when every word of the interim hypotheses was first displayed. A commited word is the same word as
+    a displayed one with the same text that starts within tolerance seconds."""
+
+    def __init__(self, tolerance=0.3):
+        self.tolerance = tolerance
+        self.shown = defaultdict(list)  # text -> [(beg, time when first displayed)]
+
+    def display(self, words, now):
+        for beg, _, text in words:
+            if not any(abs(b - beg) <= self.tolerance for b, _ in self.shown[text]):
+                self.shown[text].append((beg, now))
+
+    def commit(self, words, now):
+        """returns [(time to first display, time to commit)] of the commited words"""
+        out = []
+        for beg, end, text in words:
+            shown = self.shown[text]
+            first = now
+            for i, (b, t) in enumerate(shown):
+                if abs(b - beg) <= self.tolerance:
+                    first = t
+                    del shown[i]
+                    break
+            out.append((first - end, now - end))
+        return out
+
+def run(name, audio, args, asr, vad_engine=None):
+    online = online_factory(args, asr, logfile=open(os.devnull, "w"), vad_engine=vad_engine)
+    stats = defaultdict(lambda: [0.0, 0])
+    instrument(online, stats)
+    online.init()
+
+    # the audio arrives as 16-bit PCM, as from the client
+    pcm = (np.clip(audio, -1, 32767/32768)*32768).astype("<i2").tobytes()
+    duration = len(audio)/SAMPLING_RATE
+    min_chunk = args.vac_chunk_size if args.vac else args.min_chunk_size
+
+    if args.trace_memory:
+        tracemalloc.start()
+    mem_start = tracemalloc.get_traced_memory()[0] if args.trace_memory else None
+
+    latencies = []
+    word_latencies = []
+    display = DisplayTimes()
+    processor = online.online if isinstance(online, VACOnlineASRProcessor) else online
+    words = 0
+    iterations = 0
+    wall = time.perf_counter()
+    for beg, end in comp_unaware_chunks(duration, min_chunk):
+        t = time.perf_counter()
+        a = pcm16_to_float32(pcm[int(beg*SAMPLING_RATE)*2:int(end*SAMPLING_RATE)*2])
+        stats["pcm_decode"][0] += time.perf_counter() - t
+        stats["pcm_decode"][1] += 1
+
+        online.insert_audio_chunk(a)
+        commited = len(processor.commited)
+        tail = processor.transcript_buffer.complete()
+        o = online.process_iter()
+        iterations += 1
+        if o[0] is not None:
+            latencies.append(end - o[1])
+            words += len(o[2].split())
+            # the new commited words, or the flushed tail when VAC ended the utterance
+            new = processor.commited.since(commited) if len(processor.commited) > commited else tail
+            word_latencies += display.commit(new, end)
+        if processor.interim()[0] is not None:
+            display.display(processor.transcript_buffer.complete(), end)
+    o = online.finish()
+    online.close()
+    if o[0] is not None:
+        words += len(o[2].split())
+    wall = time.perf_counter() - wall
+
+    memory = {}
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory = {"start_bytes": mem_start, "end_bytes": current, "peak_bytes": peak, "growth_bytes": current - mem_start}
+    try:
+        import resource
+        memory["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:  # not on Windows
+        pass
+
+    stages = {}
+    for stage, (total, calls) in sorted(stats.items()):
+        stages[stage] = {"total_sec": total, "calls": calls, "mean_ms": total/calls*1000 if calls else 0.0,
+                         "per_audio_hour_sec": total/duration*3600}
+    return {
+        "name": name,
+        "audio_sec": duration,
+        "iterations": iterations,
+        "commited_words": words,
+        "wall_sec": wall,
+        "stages": stages,
+        "memory": memory,
+        "emission_latency_sec": percentiles(latencies),
+        "word_display_latency_sec": percentiles([d for d, _ in word_latencies]),
+        "word_commit_latency_sec": percentiles([c for _, c in word_latencies]),
+        "transcribe_memo": None if processor.memo is None else {
+            "hits": processor.memo.hits, "skips": processor.memo.skips, "misses": processor.memo.misses,
+            "saved_audio_sec": processor.memo.saved_sec},
+    }
+
+def compare(result, baseline, threshold):
+    """prints the stages that are slower than in the baseline by more than threshold (relative)"""
+    base_runs = {r["name"]: r for r in baseline["runs"]}
+    regressions = 0
+    for r in result["runs"]:
+        b = base_runs.get(r["name"])
+        if b is None:
+            continue
+        for stage, s in r["stages"].items():
+            if stage not in b["stages"]:
+                continue
+            old = b["stages"][stage]["per_audio_hour_sec"]
+            new = s["per_audio_hour_sec"]
+            change = (new - old)/old if old > 0 else 0.0
+            mark = "REGRESSION" if change > threshold else ""
+            regressions += bool(mark)
+            print(f"{r['name']:20s} {stage:12s} {old:10.4f} -> {new:10.4f} s per audio hour {change:+7.1%} {mark}", file=sys.stderr)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_shared_args(parser)
+    parser.add_argument("--audio", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jfk.wav"), help="Base recording.")
+    parser.add_argument("--synthetic-minutes", type=float, nargs="*", default=[10], help="Lengths of the synthetic long recordings, made of the base recording.")
+    parser.add_argument("--delay", type=float, default=0.0, help="ScriptedASR: seconds of delay per transcribe call.")
+    parser.add_argument("--delay-per-sec", type=float, default=0.0, help="ScriptedASR: seconds of delay per second of transcribed audio.")
+    parser.add_argument("--trace-memory", action="store_true", help="Measure the memory growth with tracemalloc. It slows down the stages.")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to this file, instead of stdout.")
+    parser.add_argument("--compare", type=str, default=None, help="Results of an earlier run. The stages that are slower by more than --threshold are reported.")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.set_defaults(log_level="WARNING")
+    args = parser.parse_args()
+    set_logging(args, logger)
+
+    asr = ScriptedASR(delay=args.delay, delay_per_sec=args.delay_per_sec)
+    base = load_audio(args.audio)
+    recordings = [(os.path.basename(args.audio), base)]
+    for m in args.synthetic_minutes:
+        recordings.append((f"synthetic-{m:g}min", synthetic_audio(base, m)))
+
+    result = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        "python": platform.python_version(),
+        "runs": [],
+    }
+    vad_engine = vad_engine_factory(args)
+    for name, audio in recordings:
+        logger.info(f"running {name}, {len(audio)/SAMPLING_RATE:.1f} seconds")
+        result["runs"].append(run(name, audio, args, asr, vad_engine))
+
+    out = json.dumps(result, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Compares the VAD engines of VACOnlineASRProcessor: FixedVADIterator with the torch Silero model, one model call
+per 512-sample window and stream, and BatchedVADIterator with the shared ONNX Runtime VADEngine, which evaluates the
+windows of all the streams in batched forward passes.
+
+It streams --streams synthetic recordings (made of jfk.wav) concurrently, in chunks of --vac-chunk-size seconds as
+VACOnlineASRProcessor receives them, and reports the time. It fails with AssertionError if the engines don't agree:
+if the speech probabilities of any window differ by more than --tolerance, or if the start/end decisions differ.
+The same is checked for the ONNX engine with the streams one by one and concurrently.
+
+    python3 benchmarks/vad_engine.py --streams 8 --minutes 2
+    python3 benchmarks/vad_engine.py --vad-model silero_vad.onnx --torch-model silero_vad.jit
+
+Both models are local files, found as the server finds them (silero_vad.find_model): the VAD cache, the silero-vad
+package or the torch.hub cache, unless --vad-model or --torch-model is given. It's skipped if onnxruntime or the ONNX
+model is missing. Without torch or its model, or with --skip-torch, only the ONNX engine is run and checked.
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from whisper_online import load_audio
+from silero_vad import FixedVADIterator, BatchedVADIterator, OnnxSileroVAD, VADEngine, find_model, load_torch_model
+from streaming import synthetic_audio
+
+SAMPLING_RATE = 16000
+WINDOW = 512
+
+
+def chunks(audio, chunk_sec):
+    """the complete VAD windows of every chunk, as VACOnlineASRProcessor.insert_audio_chunk passes them"""
+    step = int(chunk_sec*SAMPLING_RATE)
+    pending = 0
+    for beg in range(0, len(audio), step):
+        end = min(beg + step, len(audio))
+        n = (end - pending)//WINDOW
+        yield audio[pending:pending + n*WINDOW].reshape(n, WINDOW)
+        pending += n*WINDOW
+
+def run_stream(vac, audio, chunk_sec, out):
+    for windows in chunks(audio, chunk_sec):
+        if len(windows):
+            out.extend(vac.events(windows))
+
+class RecordingModel:
+    """the torch model, it records the speech probabilities that it returns"""
+
+    def __init__(self, model):
+        self.model = model
+        self.probs = []
+
+    def __call__(self, x, sr):
+        out = self.model(x, sr)
+        self.probs.append(out.item())
+        return out
+
+    def reset_states(self):
+        self.model.reset_states()
+
+class RecordingVADIterator(BatchedVADIterator):
+    """BatchedVADIterator that records the speech probabilities of its windows"""
+
+    def __init__(self, engine, **kwargs):
+        self.probs = []
+        super().__init__(engine, **kwargs)
+
+    def events(self, windows, return_seconds=False):
+        probs = self.model.speech_probs(self, windows)
+        self.probs.extend(probs)
+        return [self.update(p, windows.shape[1], return_seconds) for p in probs]
+
+def run_torch(model, recordings, chunk_sec):
+    """returns the events and the speech probabilities of every recording, and the time"""
+    results = []
+    t = time.perf_counter()
+    for audio in recordings:
+        recording = RecordingModel(model)
+        vac = FixedVADIterator(recording)
+        out = []
+        run_stream(vac, audio, chunk_sec, out)
+        results.append((out, np.array(recording.probs)))
+    return results, time.perf_counter() - t
+
+def run_onnx(engine, recordings, chunk_sec, concurrent=True):
+    """returns the events and the speech probabilities of every recording, and the time"""
+    vacs = [RecordingVADIterator(engine) for _ in recordings]
+    outs = [[] for _ in recordings]
+    t = time.perf_counter()
+    if concurrent:
+        threads = [threading.Thread(target=run_stream, args=(vac, audio, chunk_sec, out))
+                   for vac, audio, out in zip(vacs, recordings, outs)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+    else:
+        for vac, audio, out in zip(vacs, recordings, outs):
+            run_stream(vac, audio, chunk_sec, out)
+    return [(out, np.array(vac.probs)) for vac, out in zip(vacs, outs)], time.perf_counter() - t
+
+def decisions(events):
+    return [(i, e) for i, e in enumerate(events) if e is not None]
+
+def compare(name, reference, new, tolerance):
+    """asserts that the speech probabilities of every stream agree within tolerance, and the decisions are the same"""
+    worst = 0.0
+    for k, ((ref_events, ref_probs), (new_events, new_probs)) in enumerate(zip(reference, new)):
+        assert len(ref_probs) == len(new_probs), f"{name}, stream {k}: {len(ref_probs)} windows, but {len(new_probs)}"
+        diff = np.abs(ref_probs - new_probs)
+        worst = max(worst, float(diff.max(initial=0.0)))
+        assert worst <= tolerance, (f"{name}, stream {k}: the speech probability of window {int(diff.argmax())} differs by "
+                                    f"{diff.max():.6f}, more than {tolerance}")
+        assert decisions(ref_events) == decisions(new_events), (f"{name}, stream {k}: different start/end decisions, "
+                                                                f"{decisions(ref_events)[:5]}... and {decisions(new_events)[:5]}...")
+    n = sum(len(decisions(events)) for events, _ in reference)
+    print(f"{name}: {n} start/end decisions, the same; speech probabilities differ by at most {worst:.2e}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jfk.wav"), help="Base recording.")
+    parser.add_argument("--streams", type=int, default=8, help="Number of concurrent streams.")
+    parser.add_argument("--minutes", type=float, default=2, help="Length of every stream.")
+    parser.add_argument("--vac-chunk-size", type=float, default=0.04, help="Seconds of audio per insert_audio_chunk.")
+    parser.add_argument("--vad-model", type=str, default=None, help="Path of silero_vad.onnx.")
+    parser.add_argument("--torch-model", type=str, default=None, help="Path of silero_vad.jit. By default, it's found in the VAD cache, the silero-vad package or the torch.hub cache.")
+    parser.add_argument("--skip-torch", action="store_true", help="Don't run the torch model and don't compare with it.")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Allowed difference of the speech probabilities of the engines.")
+    args = parser.parse_args()
+
+    try:
+        engine = VADEngine(OnnxSileroVAD(args.vad_model))
+    except (ImportError, FileNotFoundError) as e:
+        print(f"skipped: the ONNX engine can't be loaded: {e}")
+        return
+    model = None
+    if not args.skip_torch:
+        try:
+            import torch
+            torch.set_num_threads(1)
+            model = load_torch_model(find_model("silero_vad.jit", args.torch_model))
+        except (ImportError, FileNotFoundError) as e:
+            print(f"the torch engine is skipped, it can't be loaded: {e}")
+
+    base = load_audio(args.audio)
+    recordings = [synthetic_audio(base, args.minutes, seed=i) for i in range(args.streams)]
+    audio_sec = sum(len(a) for a in recordings)/SAMPLING_RATE
+    print(f"{args.streams} streams of {args.minutes:g} minutes, chunks of {args.vac_chunk_size} seconds")
+
+    single, single_time = run_onnx(engine, recordings, args.vac_chunk_size, concurrent=False)
+    calls, windows = engine.forward_calls, engine.windows
+    batched, batched_time = run_onnx(engine, recordings, args.vac_chunk_size)
+    calls, windows = engine.forward_calls - calls, engine.windows - windows
+
+    timings = [("onnx, streams one by one", single_time), ("onnx, concurrent streams", batched_time)]
+    if model is not None:
+        reference, torch_time = run_torch(model, recordings, args.vac_chunk_size)
+        timings.insert(0, ("torch FixedVADIterator", torch_time))
+
+    for name, t in timings:
+        print(f"{name:28s} {t:8.3f} s, {t/audio_sec*3600:8.2f} s per audio hour")
+    print(f"concurrent streams: {windows/max(1, calls):.1f} windows per forward pass on average")
+
+    compare("onnx, one by one and concurrent", single, batched, args.tolerance)
+    if model is not None:
+        compare("torch and onnx", reference, batched, args.tolerance)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
 from pathlib import Path
 import time
+import queue
+import bisect
 import socket
-import struct
+import threading
+import numpy as np
 import pyaudio
 import wave
 
+import framing
+import audio_codecs
+
 def list_audio_devices():
     p = pyaudio.PyAudio()
     try:
@@ -61,12 +67,277 @@ def get_transcript_filename():
         full_path = captions_path / filename
         return str(full_path)  # Convert Path to string for compatibility
 
-def send_audio(host="localhost", port=43007, device_index=None, transcript_file="transcript.txt"):
-    # Audio stream configuration
+class CaptionClient:
+    """Streams the microphone to the server and writes the captions, in stages connected by bounded queues:
+
+    - capture: the PyAudio callback (PortAudio's thread) only puts the chunks to the send and disk queues
+    - send: checks the amplitude of the chunks, encodes the loud ones with the negotiated codec, and sends them.
+      Instead of the quiet ones, and the ones dropped from the full queue, it sends only their length, so that the
+      server keeps the time of the recording.
+    - receive: decodes the frames from the server and renders the captions to the console
+    - disk: writes the WAV file and the transcript, which stays open and is flushed in batches
+
+    No stage waits for another one. A chunk that doesn't fit to a full queue is dropped and counted, instead of
+    blocking the audio input. At the end, it reports the input overflows, the drops and the end-to-end latency.
+    """
+
     CHUNK = 3200
-    FORMAT = pyaudio.paInt16
-    CHANNELS = 1
     RATE = 16000
+    CHANNELS = 1
+    THRESHOLD = 500  # the chunks with lower maximum amplitude are sent as silence
+    SEND_QUEUE = 50  # chunks, 10 seconds
+    DISK_QUEUE = 500  # chunks and lines
+    FLUSH_LINES = 10  # the transcript is flushed after this number of lines, or FLUSH_SEC seconds
+    FLUSH_SEC = 2.0
+
+    def __init__(self, sock, wav_file, transcript_file, codec="auto"):
+        self.sock = sock
+        self.codec = codec
+        self.encoder = None
+        self.decoder = framing.FrameDecoder()
+        self.wav_file = wav_file
+        self.transcript_file = transcript_file
+        self.send_queue = queue.Queue(self.SEND_QUEUE)
+        self.disk_queue = queue.Queue(self.DISK_QUEUE)
+        self.stopping = threading.Event()
+
+        # the sent chunks are remembered as (end of the chunk in the stream in ms, capture time), for the latency
+        self.sent_lock = threading.Lock()
+        self.sent_ms = []
+        self.capture_times = []
+        self.sent_samples = 0  # the position in the stream, the silence included
+        self.dropped_samples = 0  # dropped from the full send queue since the last queued chunk
+
+        self.overflows = 0
+        self.dropped_send = 0
+        self.dropped_disk = 0
+        self.chunks = 0
+        self.chunks_sent = 0
+        self.bytes_sent = 0
+        self.display_latency = []
+        self.commit_latency = []
+
+    # capture stage
+
+    def audio_callback(self, in_data, frame_count, time_info, status_flags):
+        if status_flags & pyaudio.paInputOverflow:
+            self.overflows += 1
+        self.chunks += 1
+        now = time.time()
+        try:
+            # the chunks dropped before this one are sent as silence before it
+            self.send_queue.put_nowait(("audio", in_data, now, self.dropped_samples))
+            self.dropped_samples = 0
+        except queue.Full:
+            self.dropped_send += 1
+            self.dropped_samples += frame_count
+        try:
+            self.disk_queue.put_nowait(("audio", in_data, now))
+        except queue.Full:
+            self.dropped_disk += 1
+        return (None, pyaudio.paContinue)
+
+    # send stage
+
+    def send_loop(self):
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                break
+            _, data, captured, dropped = item
+            samples = np.frombuffer(data, dtype="<i2")
+            if not self.send_silence(dropped):
+                break
+            # the maximum of absolute values, in int32 because abs(-32768) doesn't fit int16
+            if len(samples) == 0 or np.abs(samples.astype(np.int32)).max() <= self.THRESHOLD:
+                if not self.send_silence(len(samples)):
+                    break
+                continue
+            with self.sent_lock:
+                self.sent_samples += len(samples)
+                self.sent_ms.append(self.sent_samples*1000 // self.RATE)
+                self.capture_times.append(captured)
+            if not self.send_payload(self.encoder.encode(data)):
+                break
+            self.chunks_sent += 1
+        self.send_payload(self.encoder.flush())
+
+    def send_silence(self, samples):
+        if not samples:
+            return True
+        with self.sent_lock:
+            self.sent_samples += samples
+        try:
+            self.sock.sendall(framing.encode_silence(samples))
+        except OSError as e:
+            print(f"\nError: {e}")
+            self.stopping.set()
+            return False
+        return True
+
+    def send_payload(self, payload):
+        if not payload:  # the encoder can wait for more audio
+            return True
+        try:
+            self.sock.sendall(framing.encode_audio(payload))
+        except OSError as e:
+            print(f"\nError: {e}")
+            self.stopping.set()
+            return False
+        self.bytes_sent += len(payload)
+        return True
+
+    def handshake(self):
+        """starts the framing protocol and chooses the codec of the audio from the ones that the server offers"""
+        self.sock.sendall(framing.HELLO)
+        hello = None
+        while hello is None:
+            response = self.sock.recv(65536)
+            if not response:
+                raise ConnectionError("the server closed the connection")
+            for kind, payload in self.decoder.feed(response):
+                if kind == framing.CONTROL:
+                    msg = framing.decode_control(payload)
+                    if msg["type"] == "error":
+                        raise ConnectionError(msg.get("message"))
+                    if msg["type"] == "hello":
+                        hello = msg
+        name = audio_codecs.choose(hello.get("codecs", ["pcm"]), self.codec)
+        self.encoder = audio_codecs.encoder(name)
+        if name != "pcm":
+            self.sock.sendall(framing.encode_control("codec", codec=name, **self.encoder.params()))
+        print(f"Audio codec: {name}")
+
+    def captured_at(self, end_ms):
+        """the capture time of the sent audio at end_ms"""
+        with self.sent_lock:
+            i = bisect.bisect_left(self.sent_ms, end_ms)
+            if i == len(self.sent_ms):
+                return None
+            return self.capture_times[i]
+
+    # receive stage
+
+    def receive_loop(self):
+        decoder = self.decoder
+        interim = ""
+        while True:
+            try:
+                response = self.sock.recv(65536)
+            except OSError:
+                break
+            if not response:
+                break
+            now = time.time()
+            for kind, payload in decoder.feed(response):
+                if kind == framing.TEXT:
+                    # Display the transcription text, in place of the interim one
+                    beg, end, transcription = framing.decode_text(payload)
+                    print("\r\033[K" + transcription)  # Print to console
+                    interim = ""
+                    self.put_line(transcription)
+                    captured = self.captured_at(end)
+                    if captured is not None:
+                        self.commit_latency.append(now - captured)
+                elif kind == framing.INTERIM:
+                    # Display the uncommitted text on the current line, until it's commited
+                    beg, end, text = framing.decode_text(payload)
+                    if text != interim:
+                        print("\r\033[K" + text, end="", flush=True)
+                        interim = text
+                        captured = self.captured_at(end)
+                        if text and captured is not None:
+                            self.display_latency.append(now - captured)
+                elif kind == framing.CONTROL:
+                    msg = framing.decode_control(payload)
+                    if msg["type"] == "error":
+                        print(f"\nServer error: {msg.get('message')}")
+                        self.stopping.set()
+                        return
+        if not self.stopping.is_set():
+            print("\nThe server closed the connection.")
+            self.stopping.set()
+
+    def put_line(self, line):
+        # the transcript lines are not dropped, the receive stage waits for the disk if it must
+        self.disk_queue.put(("line", line, None))
+
+    # disk stage
+
+    def disk_loop(self):
+        lines = 0
+        last_flush = time.time()
+        with open(self.transcript_file, 'a', encoding='utf-8') as f:
+            while True:
+                try:
+                    item = self.disk_queue.get(timeout=self.FLUSH_SEC)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    kind, data, _ = item
+                    if kind == "audio":
+                        self.wav_file.writeframes(data)
+                    else:
+                        f.write(data + '\n')
+                        lines += 1
+                if lines and (lines >= self.FLUSH_LINES or time.time() - last_flush >= self.FLUSH_SEC):
+                    f.flush()
+                    lines = 0
+                    last_flush = time.time()
+
+    def run(self, stream):
+        """runs the stages until Ctrl+C or until the server closes the connection"""
+        self.handshake()
+        threads = [threading.Thread(target=target, name=name, daemon=True) for target, name in 
+                   ((self.send_loop, "send"), (self.receive_loop, "receive"), (self.disk_loop, "disk"))]
+        for t in threads:
+            t.start()
+        stream.start_stream()
+        try:
+            while not self.stopping.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            print("\nStopping...")
+        self.stopping.set()
+        stream.stop_stream()
+
+        # the send stage sends the rest of the audio, then the end of the audio, and the server sends the rest of the text
+        while threads[0].is_alive():
+            try:
+                self.send_queue.put(None, timeout=0.5)
+                break
+            except queue.Full:  # the send stage ended with an error
+                pass
+        threads[0].join()
+        try:
+            self.sock.sendall(framing.encode_control("end"))
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        threads[1].join(timeout=10)
+        self.disk_queue.put(None)
+        threads[2].join()
+
+    def report(self):
+        summary = f"""
+=== Session Statistics ===
+Audio chunks: {self.chunks} captured, {self.chunks_sent} sent
+Sent audio: {self.bytes_sent/1000:.1f} kB, {self.bytes_sent/max(1, self.chunks_sent*self.CHUNK*2):.0%} of 16-bit PCM
+Input overflows: {self.overflows}
+Dropped chunks: {self.dropped_send} not sent, {self.dropped_disk} not saved (queues full)
+"""
+        for name, values in (("Latency to first display", self.display_latency), ("Latency to commit", self.commit_latency)):
+            if values:
+                v = np.array(values)
+                summary += f"{name}: mean {v.mean():.2f} s, median {np.median(v):.2f} s, 90th percentile {np.percentile(v, 90):.2f} s\n"
+        return summary
+
+
+def send_audio(host="localhost", port=43007, device_index=None, transcript_file="transcript.txt", codec="auto"):
+    # Audio stream configuration
+    FORMAT = pyaudio.paInt16
 
     # Create audio file name based on transcript file name
     transcript_path = Path(transcript_file)
@@ -77,62 +348,30 @@ def send_audio(host="localhost", port=43007, device_index=None, transcript_file=
 
     # Set up WAV file
     wf = wave.open(str(audio_file), 'wb')  # Convert Path to string for wave module
-    wf.setnchannels(CHANNELS)
+    wf.setnchannels(CaptionClient.CHANNELS)
     wf.setsampwidth(p.get_sample_size(FORMAT))
-    wf.setframerate(RATE)
-
-    # Open audio stream with selected device
-    stream = p.open(format=FORMAT,
-                   channels=CHANNELS,
-                   rate=RATE,
-                   input=True,
-                   input_device_index=device_index,
-                   frames_per_buffer=CHUNK)
+    wf.setframerate(CaptionClient.RATE)
 
+    stream = None
     print("\nConnecting to server...")
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         try:
             s.connect((host, port))
-            print("Connected! Start speaking (Ctrl+C to exit)...")
+            client = CaptionClient(s, wf, transcript_file, codec)
 
-            while True:
-                try:
-                    # Read audio data from microphone
-                    data = stream.read(CHUNK, exception_on_overflow=False)
-
-                    # Save audio chunk to WAV file
-                    wf.writeframes(data)
-
-                    # Check for voice activity (silently)
-                    audio_samples = struct.unpack(f'{CHUNK}h', data)
-                    max_amplitude = max(abs(min(audio_samples)), abs(max(audio_samples)))
-
-                    # Send the data if above noise threshold
-                    if max_amplitude > 500:
-                        s.sendall(data)
-
-                    # Try to receive any response
-                    try:
-                        s.settimeout(0.1)
-                        response = s.recv(1024)
-                        if response:
-                            # Parse and display the transcription text
-                            parts = response.decode('utf-8').strip().split('  ', 1)
-                            if len(parts) > 1:
-                                transcription = parts[1]
-                                print(transcription)  # Print to console
-                                # Save to file
-                                with open(transcript_file, 'a', encoding='utf-8') as f:
-                                    f.write(transcription + '\n')
-                    except socket.timeout:
-                        pass
-
-                except KeyboardInterrupt:
-                    print("\nStopping...")
-                    break
-                except Exception as e:
-                    print(f"\nError: {e}")
-                    break
+            # Open audio stream with selected device, the chunks are passed to the client's callback
+            stream = p.open(format=FORMAT,
+                           channels=CaptionClient.CHANNELS,
+                           rate=CaptionClient.RATE,
+                           input=True,
+                           input_device_index=device_index,
+                           frames_per_buffer=CaptionClient.CHUNK,
+                           stream_callback=client.audio_callback,
+                           start=False)
+
+            print("Connected! Start speaking (Ctrl+C to exit)...")
+            client.run(stream)
+            print(client.report())
 
         except ConnectionRefusedError:
             print("Could not connect to server. Make sure the server is running.")
@@ -140,15 +379,16 @@ def send_audio(host="localhost", port=43007, device_index=None, transcript_file=
             print(f"Error: {e}")
         finally:
             wf.close()  # Close the WAV file
-            stream.stop_stream()
-            stream.close()
+            if stream is not None:
+                stream.close()
             p.terminate()
 
-def create_session_summary(host, port, device_index, transcript_file, audio_file):
+def create_session_summary(host, port, device_index, transcript_file, audio_file, codec="auto"):
     summary = f"""
 === Configuration Summary ===
 Host: {host}
 Port: {port}
+Audio Codec: {codec}
 Audio Device Index: {device_index}
 Transcript File: {transcript_file}
 Audio File: {audio_file}
@@ -172,8 +412,16 @@ def main():
     port_input = input("\nEnter port number (press Enter for default 43007): ").strip()
     port = 43007 if not port_input else int(port_input)
 
+    # Add codec selection, the compressed ones save the bandwidth of constrained links
+    codecs = audio_codecs.available_codecs()
+    while True:
+        codec = input(f"\nEnter audio codec ({', '.join(codecs)}; press Enter for the best one the server supports): ").strip().lower() or "auto"
+        if codec == "auto" or codec in codecs:
+            break
+        print("Codec not available. Please try again.")
+
     # Create and display summary
-    summary = create_session_summary(host, port, device_index, transcript_file, audio_file)
+    summary = create_session_summary(host, port, device_index, transcript_file, audio_file, codec)
     print(summary)
 
     # Save to log file
@@ -184,7 +432,7 @@ def main():
         f.write("="*50 + "\n")
 
     # Start audio streaming
-    send_audio(host=host, port=port, device_index=device_index, transcript_file=transcript_file)
+    send_audio(host=host, port=port, device_index=device_index, transcript_file=transcript_file, codec=codec)
 
 if __name__ == "__main__":
     main()
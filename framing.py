@@ -0,0 +1,100 @@
+"""Length-prefixed binary framing of the client-server protocol.
+
+A client that uses it starts the connection with HELLO: the 4 bytes MAGIC and one byte of the protocol version.
+Otherwise, the server handles the connection as before: raw 16-bit PCM audio from the client, and text lines
+(line_packet) to the client. The server answers HELLO with a CONTROL frame {"type": "hello", "version": VERSION},
+or with {"type": "error", ...} if it doesn't support the version, and closes the connection. The hello also lists
+the codecs of the compressed audio uplink that the client can choose (audio_codecs.py).
+
+Then both directions are a sequence of frames: a header of the frame type (1 byte) and the payload length
+(4 bytes, little endian), followed by the payload.
+
+    AUDIO    client -> server  16-bit little-endian mono PCM, 16 kHz, a whole number of samples
+    TEXT     server -> client  commited text: begin and end time in ms (uint32 each, little endian) and UTF-8 text
+    INTERIM  server -> client  the uncommitted tail of the current hypothesis, in the same format as TEXT. It replaces
+                               the previous INTERIM, and the commited TEXT replaces it later. The empty text clears it.
+    CONTROL  both directions   UTF-8 JSON object with the key "type", e.g. {"type": "end"} when the client has no more audio
+    SILENCE  client -> server  the number of samples (uint32, little endian) of silence that the client doesn't send.
+                               The server moves its time by them without transcribing, so the timestamps stay those of
+                               the recording, and VAC sees the pause.
+
+Unknown frame types are skipped, so that new types can be added without a new version.
+"""
+import json
+import struct
+
+MAGIC = b"WSTR"
+VERSION = 1
+HELLO = MAGIC + bytes([VERSION])
+
+AUDIO = 1
+TEXT = 2
+CONTROL = 3
+INTERIM = 4
+SILENCE = 5
+
+HEADER = struct.Struct("<BI")
+TEXT_TIMES = struct.Struct("<II")
+SILENCE_SAMPLES = struct.Struct("<I")
+MAX_PAYLOAD = 16*1024*1024  # a longer frame is a protocol error, most likely not a framed stream at all
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+def encode_audio(pcm):
+    return encode_frame(AUDIO, bytes(pcm))
+
+def encode_text(beg, end, text, kind=TEXT):
+    """beg and end in milliseconds. kind is TEXT or INTERIM."""
+    return encode_frame(kind, TEXT_TIMES.pack(int(round(beg)), int(round(end))) + text.encode("utf-8", errors="replace"))
+
+def encode_silence(samples):
+    return encode_frame(SILENCE, SILENCE_SAMPLES.pack(samples))
+
+def decode_silence(payload):
+    return SILENCE_SAMPLES.unpack_from(payload)[0]
+
+def encode_control(type, **fields):
+    return encode_frame(CONTROL, json.dumps(dict(type=type, **fields)).encode("utf-8"))
+
+def decode_text(payload):
+    """returns (beg ms, end ms, text) of a TEXT or INTERIM frame"""
+    beg, end = TEXT_TIMES.unpack_from(payload)
+    return beg, end, bytes(payload[TEXT_TIMES.size:]).decode("utf-8", errors="replace")
+
+def decode_control(payload):
+    msg = json.loads(bytes(payload).decode("utf-8"))
+    if not isinstance(msg, dict) or "type" not in msg:
+        raise ProtocolError(f"invalid control message {msg!r}")
+    return msg
+
+
+class FrameDecoder:
+    '''Incremental decoder of frames. The received bytes are appended to a reassembly buffer by feed, and the
+    complete frames are returned. An incomplete frame waits in the buffer for the next feed.'''
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """appends the bytes data, returns the list of the complete frames as (type, payload bytes)"""
+        self.buffer += data
+        frames = []
+        pos = 0
+        while len(self.buffer) - pos >= HEADER.size:
+            kind, length = HEADER.unpack_from(self.buffer, pos)
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"frame of {length} bytes is too long")
+            if len(self.buffer) - pos - HEADER.size < length:
+                break
+            start = pos + HEADER.size
+            frames.append((kind, bytes(self.buffer[start:start+length])))
+            pos = start + length
+        if pos:
+            del self.buffer[:pos]
+        return frames
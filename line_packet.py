@@ -9,8 +9,12 @@ containing:
 
   - Zero or more \0 bytes as required to pad the packet to PACKET_SIZE
 
+The receiving functions keep the bytes after the received line, and an incomplete line, for the next call on the 
+same socket (LineDecoder).
+
 Originally from the UEDIN team of the ELITR project. 
 """
+import weakref
 
 PACKET_SIZE = 65536
 
@@ -31,11 +35,7 @@ def send_one_line(socket, text, pad_zeros=False):
         socket: a socket object.
         text: string containing a line of text for transmission.
     """
-    text.replace('\0', '\n')
-    lines = text.splitlines()
-    first_line = '' if len(lines) == 0 else lines[0]
-    # TODO Is there a better way of handling bad input than 'replace'?
-    data = first_line.encode('utf-8', errors='replace') + b'\n' + (b'\0' if pad_zeros else b'')
+    data = encode_line(text, pad_zeros)
     for offset in range(0, len(data), PACKET_SIZE):
         bytes_remaining = len(data) - offset
         if bytes_remaining < PACKET_SIZE:
@@ -46,6 +46,62 @@ def send_one_line(socket, text, pad_zeros=False):
         socket.sendall(packet)
 
 
+def encode_line(text, pad_zeros=False):
+    """The bytes of the first line of text, terminated by \n (and \0 with pad_zeros), as send_one_line sends them,
+    but without the padding to PACKET_SIZE."""
+    text = text.replace('\0', '\n')
+    lines = text.splitlines()
+    first_line = '' if len(lines) == 0 else lines[0]
+    # TODO Is there a better way of handling bad input than 'replace'?
+    return first_line.encode('utf-8', errors='replace') + b'\n' + (b'\0' if pad_zeros else b'')
+
+
+class LineDecoder:
+    '''Incremental decoder of the received lines. A line can be split between two receives, and one receive can
+    have more lines, so the bytes that aren't returned yet are kept. The \0 padding is dropped.'''
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += bytes(data).replace(b"\0", b"")
+
+    def line(self):
+        """the next complete line without \n, or None"""
+        end = self.buffer.find(b"\n")
+        if end < 0:
+            return None
+        # TODO Is there a better way of handling bad input than 'replace'?
+        line = self.buffer[:end].decode("utf-8", errors="replace")
+        del self.buffer[:end+1]
+        return line
+
+    def lines(self):
+        """all the complete lines without \n"""
+        end = self.buffer.rfind(b"\n")
+        if end < 0:
+            return []
+        lines = self.buffer[:end].decode("utf-8", errors="replace").split("\n")
+        del self.buffer[:end+1]
+        return lines
+
+    def rest(self):
+        """the incomplete line at the end of the stream, or None"""
+        if not self.buffer:
+            return None
+        rest = self.buffer.decode("utf-8", errors="replace")
+        self.buffer.clear()
+        return rest
+
+decoders = weakref.WeakKeyDictionary()  # socket -> its LineDecoder
+
+def decoder(socket):
+    d = decoders.get(socket)
+    if d is None:
+        d = decoders[socket] = LineDecoder()
+    return d
+
+
 def receive_one_line(socket):
     """Receives a line of text from the given socket.
 
@@ -54,8 +110,7 @@ def receive_one_line(socket):
     the sender has closed the connection (in which case it will return an
     empty string).
 
-    The string should not contain any newline characters, but if it does then
-    only the first line will be returned.
+    The bytes received after the line are kept for the next call.
 
     Args:
         socket: a socket object.
@@ -64,30 +119,28 @@ def receive_one_line(socket):
         A string representing a single line with a terminating newline or
         None if the connection has been closed.
     """
-    data = b''
+    d = decoder(socket)
     while True:
+        line = d.line()
+        if line is not None:
+            return line + '\n'
         packet = socket.recv(PACKET_SIZE)
         if not packet:  # Connection has been closed.
-            return None
-        data += packet
-        if b'\0' in packet:
-            break
-    # TODO Is there a better way of handling bad input than 'replace'?
-    text = data.decode('utf-8', errors='replace').strip('\0')
-    lines = text.split('\n')
-    return lines[0] + '\n'
+            rest = d.rest()
+            return None if rest is None else rest + '\n'
+        d.feed(packet)
 
 
 def receive_lines(socket):
+    """Receives the complete lines that are available now, [] if there are none. A line split between two receives
+    is returned by the call that receives its end. Returns None if the connection has been closed."""
+    d = decoder(socket)
     try:
         data = socket.recv(PACKET_SIZE)
     except BlockingIOError:
         return []
-    if data is None:  # Connection has been closed.
-        return None
-    # TODO Is there a better way of handling bad input than 'replace'?
-    text = data.decode('utf-8', errors='replace').strip('\0')
-    lines = text.split('\n')
-    if len(lines)==1 and not lines[0]:
-        return None
-    return lines
+    if not data:  # Connection has been closed.
+        rest = d.rest()
+        return None if rest is None else [rest]
+    d.feed(data)
+    return d.lines()
@@ -0,0 +1,139 @@
+"""Overload protection of the server sessions: graceful degradation when the processing falls behind real time.
+
+When the transcribe calls are slower than the audio arrives, the unprocessed audio of a session grows, the audio
+buffer of OnlineASRProcessor grows until the trimming catches up, every next call is slower, and the captions lag
+by minutes. OverloadManager watches, before every process_iter of the session:
+
+    backlog     seconds of audio received since the last process_iter, that wait for the processing
+    buffer      length of the audio buffer of OnlineASRProcessor
+    queue       transcribe calls of all the sessions that wait for the shared model (SharedASR), optionally
+
+The session is overloaded when any of them is above its limit. After ESCALATE_AFTER overloaded iterations, without
+CALM_SEC seconds of audio processed without overload between them, the next degradation step is applied. (The fast
+iterations between the slow ones, e.g. VAC without speech, don't reset the count.) After RECOVER_SEC seconds of audio
+processed without overload, the last applied step is undone. The recovery is slower than the escalation, so that the level doesn't flap. The steps are
+applied in the configured order, by default:
+
+    interim     the interim (uncommitted) hypotheses are not sent to the client
+    trim        the audio buffer is hard-trimmed at max_buffer_sec: the uncommitted hypothesis is force-commited,
+                without the confirmation by LocalAgreement (OnlineASRProcessor.hard_trim)
+    beam        the transcribe calls use the lower beam_size (only the backends with supports_beam_size)
+    model       the session is switched to the smaller fallback model, loaded at the server start
+
+Every change is logged, and counted in the server metrics.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+STEPS = ("interim", "trim", "beam", "model")
+
+
+class OverloadManager:
+
+    ESCALATE_AFTER = 3  # overloaded iterations before the next step
+    CALM_SEC = 10  # seconds of audio processed without overload that reset the count of the overloaded iterations
+    RECOVER_SEC = 30  # seconds of audio processed without overload before the last step is undone
+
+    def __init__(self, online, steps=STEPS, max_backlog_sec=3.0, max_buffer_sec=30.0, max_queue=0, queue_depth=None,
+                 beam_size=1, fallback_asr=None, metrics=None, name=""):
+        """online: the OnlineASRProcessor that is degraded (the inner one of VACOnlineASRProcessor)
+        max_queue: the limit of queue_depth(), the number of waiting transcribe calls. 0 means it's not watched.
+        fallback_asr: the smaller model for the "model" step
+        metrics: SessionMetrics of server_metrics.py, or None
+        """
+        self.online = online
+        self.asr = online.asr  # the original model
+        self.max_backlog_sec = max_backlog_sec
+        self.max_buffer_sec = max_buffer_sec
+        self.max_queue = max_queue
+        self.queue_depth = queue_depth
+        self.beam_size = beam_size
+        self.fallback_asr = fallback_asr
+        self.metrics = metrics
+        self.name = name
+
+        self.steps = []
+        for step in steps:
+            if step == "beam" and not getattr(online.asr, "supports_beam_size", False):
+                logger.warning("The ASR backend does not support beam_size, the \"beam\" overload step is not used.")
+            elif step == "model" and fallback_asr is None:
+                logger.warning("There is no fallback model, the \"model\" overload step is not used.")
+            else:
+                self.steps.append(step)
+
+        self.level = 0  # the number of the applied steps
+        self.overloads = 0
+        self.healthy_sec = 0
+        self.hard_trims = 0  # of online, already counted
+        self.counts = {}
+
+    def active(self, step):
+        return step in self.steps[:self.level]
+
+    def update(self, backlog_sec):
+        """Before process_iter. backlog_sec: seconds of the audio that wait for it."""
+        buffer_sec = len(self.online.audio_buffer)/self.online.SAMPLING_RATE
+        queue = self.queue_depth() if self.max_queue and self.queue_depth is not None else 0
+        reasons = []
+        if backlog_sec > self.max_backlog_sec:
+            reasons.append(f"backlog {backlog_sec:.1f} s")
+        if buffer_sec > self.max_buffer_sec:
+            reasons.append(f"buffer {buffer_sec:.1f} s")
+        if self.max_queue and queue > self.max_queue:
+            reasons.append(f"queue {queue}")
+
+        if reasons:
+            self.overloads += 1
+            self.healthy_sec = 0
+            if self.overloads >= self.ESCALATE_AFTER and self.level < len(self.steps):
+                self.overloads = 0
+                self.level += 1
+                logger.warning(f"{self.name} overloaded ({', '.join(reasons)}): applying the \"{self.steps[self.level-1]}\" step, level {self.level}/{len(self.steps)}")
+                self.count("overload_escalations")
+                self.apply()
+        else:
+            self.healthy_sec += backlog_sec
+            if self.healthy_sec >= self.CALM_SEC:
+                self.overloads = 0
+            if self.healthy_sec >= self.RECOVER_SEC and self.level > 0:
+                self.healthy_sec = 0
+                self.level -= 1
+                logger.info(f"{self.name} recovered: undoing the \"{self.steps[self.level]}\" step, level {self.level}/{len(self.steps)}")
+                self.count("overload_recoveries")
+                self.apply()
+
+        if self.active("beam"):
+            self.count("overload_reduced_beam_iterations")
+        if self.active("model"):
+            self.count("overload_fallback_model_iterations")
+
+    def apply(self):
+        self.online.max_buffer_sec = self.max_buffer_sec if self.active("trim") else None
+        self.online.beam_size = self.beam_size if self.active("beam") else None
+        self.online.asr = self.fallback_asr if self.active("model") else self.asr
+
+    def skip_interim(self, interim):
+        """whether the interim hypothesis is not sent, it's counted if it's not empty"""
+        if not self.active("interim"):
+            return False
+        if interim[2]:
+            self.count("overload_skipped_interims")
+        return True
+
+    def after_iter(self):
+        """After process_iter, counts its hard trims."""
+        n = self.online.hard_trims - self.hard_trims
+        if n:
+            self.hard_trims = self.online.hard_trims
+            self.count("overload_hard_trims", n)
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+        if self.metrics is not None:
+            self.metrics.inc(name, value)
+
+    def report(self):
+        if not self.counts:
+            return f"{self.name} was not overloaded"
+        return f"{self.name} overload: " + ", ".join(f"{k[len('overload_'):]} {v}" for k, v in sorted(self.counts.items()))
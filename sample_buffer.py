@@ -0,0 +1,51 @@
+import numpy as np
+
+class SampleBuffer:
+    """Growable buffer of audio samples, used for the audio buffers of OnlineASRProcessor, VACOnlineASRProcessor and FixedVADIterator.
+
+    The samples live in a preallocated array between the start and end index. append copies the new samples in place
+    after the end, trim only moves the start index forward. When there's no more room at the end, the live samples are
+    moved to the beginning of the array, or the array is reallocated to twice the size if it's more than half full,
+    so that every sample is copied only a constant number of times on average.
+
+    view() returns the samples as a contiguous numpy array without copying. It's valid until the next append.
+    """
+
+    def __init__(self, capacity=16000*30, dtype=np.float32):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def view(self):
+        return self.data[self.start:self.end]
+
+    def append(self, samples):
+        n = len(samples)
+        if self.end + n > len(self.data):
+            self.make_room(n)
+        self.data[self.end:self.end+n] = samples
+        self.end += n
+
+    def make_room(self, n):
+        size = len(self)
+        if size + n <= len(self.data) // 2:
+            self.data[:size] = self.data[self.start:self.end]
+        else:
+            data = np.empty(max(2*len(self.data), 2*(size + n)), dtype=self.data.dtype)
+            data[:size] = self.data[self.start:self.end]
+            self.data = data
+        self.start = 0
+        self.end = size
+
+    def trim(self, n):
+        """drops the first n samples"""
+        self.start = min(self.start + max(0, n), self.end)
+        if self.start == self.end:
+            self.clear()
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
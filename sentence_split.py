@@ -0,0 +1,112 @@
+"""Rule-based sentence splitter in pure Python, the fast default tokenizer of the sentence buffer trimming.
+
+RuleSplitter(lan).split(text) works like MosesTokenizer.split: it returns the list of the sentences of the text.
+A sentence ends by one of .!?… (and the closing quotes or brackets after it), followed by a space and a word that
+doesn't begin by a lowercase letter. A full stop doesn't end a sentence after a known abbreviation of the language,
+an initial ("J. F. Kennedy"), an acronym with inner dots ("U.S.") or, in the languages that write ordinal numbers
+so, after a number ("am 3. Oktober"). The full stops of the other scripts (。！？ । ؟ ۔ ። ။) end a sentence always,
+also without a space.
+
+It's meant for Whisper's output, which is punctuated and capitalized. The languages of RULE_LANGUAGES have their
+abbreviations here; the other languages with these punctuation marks work too, only without the abbreviations.
+"""
+import re
+
+# the languages for which the rules are the default tokenizer
+RULE_LANGUAGES = set("ar bg ca cs da de el en es et fa fi fr he hi hr hu id it ja ko lt lv ms nl no pl pt ro ru sk sl sr sv tr uk ur vi zh".split())
+
+# the languages that write ordinal numbers with a full stop
+ORDINAL_LANGUAGES = set("cs da de et fi hr hu is lt lv nb nn no pl sk sl sr sv tr".split())
+
+# lowercase, without the final full stop
+ABBREVIATIONS = {
+    "en": "mr mrs ms dr prof sr jr st mt vs etc e.g i.e a.m p.m u.s u.k vol fig approx dept est inc ltd co corp jan feb mar apr jun jul aug sep sept oct nov dec gen col lt sgt capt rev hon",
+    "de": "z.b bzw usw ca dr prof hr fr nr str vgl evtl ggf inkl d.h u.a s.o s.u sog jh jhd mio mrd bspw abs tel",
+    "fr": "m mm mme mlle dr pr st ste etc cf env p.ex n° av apr j.-c mrs",
+    "es": "sr sra srta dr dra ud uds etc p.ej pág núm av ee.uu aprox",
+    "it": "sig sigg dott prof ing avv ecc es pag n ca",
+    "pt": "sr sra dr dra prof etc pág n av ex",
+    "nl": "dhr mevr dr prof bijv o.a d.w.z enz ca nr blz",
+    "ca": "sr sra dr dra etc pàg núm av",
+    "cs": "např tzv atd apod mj resp tj př ing mgr bc dr prof doc str čís č sv",
+    "sk": "napr tzv atď atd resp tj ing mgr bc dr prof doc str č sv",
+    "pl": "np tzw itd itp m.in dr prof inż mgr ul nr str godz r ok zob",
+    "ru": "т.е т.д т.п т.к г гг др пр см им ул д стр млн млрд тыс",
+    "uk": "т.д т.п напр див ім вул д стр млн млрд тис р рр",
+    "bg": "т.е др напр гр ул стр млн млрд хил",
+    "sv": "t.ex bl.a dvs osv m.m ca nr s.k",
+    "da": "f.eks bl.a osv mht dvs ca nr",
+    "no": "f.eks bl.a osv dvs ca nr mht",
+    "fi": "esim ns jne ym mm tri prof",
+    "hu": "pl stb dr prof kb ún ill",
+    "ro": "dl dna dr prof etc nr str",
+    "sl": "npr itd dr prof oz tj",
+    "hr": "npr itd dr prof tj sl",
+    "sr": "npr itd dr prof tj",
+    "et": "nt jne dr prof vt",
+    "lt": "pvz dr prof t.y",
+    "lv": "piem dr prof u.c",
+    "el": "κ κα δρ π.χ",
+    "tr": "dr prof vb vs",
+    "id": "dr prof dll dsb",
+    "ms": "dr prof dll",
+    "vi": "ts ths",
+}
+
+TERMINATORS = ".!?…。！？।॥؟۔።။"
+# these end a sentence also without a space after them
+ALWAYS_END = set("。！？।॥؟۔።။")
+
+END = re.compile(r'([' + TERMINATORS + r']+)(["\'”’»)\]」』）]*)(\s*)')
+OPENING = "\"'“‘«([¿¡"
+
+
+class RuleSplitter:
+
+    thread_safe = True  # no state, it can be shared by the sessions without a lock
+
+    def __init__(self, lan=None):
+        self.lan = lan
+        self.abbreviations = set(ABBREVIATIONS.get(lan, ABBREVIATIONS["en"] if lan in (None, "auto") else "").split())
+        self.ordinals = lan in ORDINAL_LANGUAGES
+
+    def split(self, text):
+        sentences = []
+        start = 0
+        for m in END.finditer(text):
+            if m.end() >= len(text) or not self.ends_sentence(text, m):
+                continue
+            s = text[start:m.end(2)].strip()
+            if s:
+                sentences.append(s)
+            start = m.end()
+        s = text[start:].strip()
+        if s:
+            sentences.append(s)
+        return sentences
+
+    def ends_sentence(self, text, m):
+        """whether the match m of END, which isn't at the end of the text, ends a sentence"""
+        term = m.group(1)
+        if term[-1] in ALWAYS_END:
+            return True
+        if not m.group(3) or text[m.end()].islower():
+            return False
+        if term != ".":
+            return True
+        # the word before the single full stop
+        beg = m.start()
+        while beg > 0 and not text[beg-1].isspace() and m.start() - beg < 40:
+            beg -= 1
+        word = text[beg:m.start()].lstrip(OPENING)
+        if not word or m.group(2):
+            return True
+        if word.lower() in self.abbreviations:
+            return False
+        if len(word) == 1 and word.isalpha():  # an initial
+            return False
+        if "." in word and word.replace(".", "").replace("-", "").isalpha():  # an acronym
+            return False
+        if self.ordinals and word.isdigit():
+            return False
+        return True
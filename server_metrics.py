@@ -0,0 +1,167 @@
+"""Live metrics of whisper_online_server sessions, in the Prometheus text format on a separate local HTTP port.
+
+Every metric exists as an aggregate over all the sessions (whisper_<name>), and per session
+(whisper_session_<name>{session="host:port"}). The per-session series are removed when the session ends.
+"""
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for le, n in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += n
+            yield f"{name}_bucket", labels + [("le", "+Inf" if le == float("inf") else repr(le))], cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def samples(self, name, labels):
+        yield f"{name}_total", labels, self.value
+
+
+class ServerMetrics:
+    """Registry of the aggregate and per-session metrics. It's shared by the session threads."""
+
+    HISTOGRAMS = {
+        "transcribe_duration_seconds": ("Duration of the transcribe calls.", [0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16]),
+        "audio_buffer_seconds": ("Length of the audio buffer that is transcribed.", [1, 2, 5, 10, 15, 20, 25, 30, 60]),
+        "commit_latency_seconds": ("Wall time from receiving the end of the commited audio to sending the text.", [0.25, 0.5, 1, 2, 3, 5, 10, 30, 60]),
+        "vad_speech_ratio": ("Ratio of the audio that VAD detected as speech, per processing iteration.", [0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0]),
+    }
+    COUNTERS = {
+        "received_bytes": "Bytes of audio received from the clients.",
+        "sent_lines": "Lines sent to the clients.",
+        "duplicate_lines": "Lines not sent because they were the same as the previous one.",
+        "dropped_lines": "Lines and interim hypotheses that could not be sent because the connection was closed.",
+        "sent_interims": "Interim (uncommitted) hypotheses sent to the clients.",
+        "silence_samples": "Samples of silence that the clients marked instead of sending the audio.",
+        "transcribe_memo_hits": "Transcriptions reused because the audio buffer didn't change (--transcribe-memo).",
+        "transcribe_memo_skips": "Transcriptions reused because the buffer grew only by short or silent audio (--transcribe-memo).",
+        "transcribe_memo_misses": "Transcribe calls of the sessions with --transcribe-memo.",
+        "transcribe_memo_saved_seconds": "Seconds of audio buffer that were not transcribed again thanks to --transcribe-memo.",
+        "overload_escalations": "Overload degradation steps applied to the sessions (--overload-steps).",
+        "overload_recoveries": "Overload degradation steps undone after the sessions recovered.",
+        "overload_skipped_interims": "Interim hypotheses not sent because of overload.",
+        "overload_hard_trims": "Audio buffers hard-trimmed, with the hypothesis force-commited, because of overload.",
+        "overload_reduced_beam_iterations": "Processing iterations with the lowered beam size because of overload.",
+        "overload_fallback_model_iterations": "Processing iterations with the smaller fallback model because of overload.",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.aggregate = self.new_metrics()
+        self.sessions = {}  # session name -> metrics
+
+    def new_metrics(self):
+        m = {name: Histogram(buckets) for name, (_, buckets) in self.HISTOGRAMS.items()}
+        m.update({name: Counter() for name in self.COUNTERS})
+        return m
+
+    def session(self, name):
+        with self.lock:
+            self.sessions[name] = self.new_metrics()
+        return SessionMetrics(self, name)
+
+    def render(self):
+        """returns all the metrics in the Prometheus text exposition format"""
+        helps = {name: h for name, (h, _) in self.HISTOGRAMS.items()}
+        helps.update(self.COUNTERS)
+        lines = []
+        with self.lock:
+            lines.append("# HELP whisper_sessions_active Number of connected client sessions.")
+            lines.append("# TYPE whisper_sessions_active gauge")
+            lines.append(f"whisper_sessions_active {len(self.sessions)}")
+            for prefix, series in (("whisper_", [([], self.aggregate)]),
+                                   ("whisper_session_", [([("session", s)], m) for s, m in self.sessions.items()])):
+                for name, help in helps.items():
+                    kind = "histogram" if name in self.HISTOGRAMS else "counter"
+                    full = prefix + name
+                    lines.append(f"# HELP {full} {help}")
+                    lines.append(f"# TYPE {full} {kind}")
+                    for labels, metrics in series:
+                        for sample, sample_labels, value in metrics[name].samples(full, labels):
+                            lines.append(f"{sample}{format_labels(sample_labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        """serves the metrics on http://host:port/metrics from a daemon thread, returns the HTTP server"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics request: " + format % args)
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{httpd.server_address[1]}/metrics")
+        return httpd
+
+
+class SessionMetrics:
+    """Metrics of one session. Every value is recorded both to the session and to the aggregate."""
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def observe(self, metric, value):
+        r = self.registry
+        with r.lock:
+            r.aggregate[metric].observe(value)
+            if self.name in r.sessions:
+                r.sessions[self.name][metric].observe(value)
+
+    def inc(self, metric, value=1):
+        r = self.registry
+        with r.lock:
+            r.aggregate[metric].inc(value)
+            if self.name in r.sessions:
+                r.sessions[self.name][metric].inc(value)
+
+    def close(self):
+        with self.registry.lock:
+            self.registry.sessions.pop(self.name, None)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
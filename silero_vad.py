@@ -1,5 +1,3 @@
-import torch
-
 # This is copied from silero-vad's vad_utils.py:
 # https://github.com/snakers4/silero-vad/blob/f6b1294cb27590fb2452899df98fb234dfef1134/utils_vad.py#L340
 
@@ -61,6 +59,7 @@ class VADIterator:
         return_seconds: bool (default - False)
             whether return timestamps in seconds (default - samples)
         """
+        import torch
 
         if not torch.is_tensor(x):
             try:
@@ -69,9 +68,16 @@ class VADIterator:
                 raise TypeError("Audio cannot be casted to tensor. Cast it manually")
 
         window_size_samples = len(x[0]) if x.dim() == 2 else len(x)
-        self.current_sample += window_size_samples
-
         speech_prob = self.model(x, self.sampling_rate).item()
+        return self.update(speech_prob, window_size_samples, return_seconds)
+
+    def skip(self, samples):
+        """moves the time by samples of silence, which are not evaluated"""
+        self.current_sample += samples
+
+    def update(self, speech_prob, window_size_samples, return_seconds=False):
+        # the start/end decision for the next window, given its speech probability
+        self.current_sample += window_size_samples
 
         if (speech_prob >= self.threshold) and self.temp_end:
             self.temp_end = 0
@@ -99,28 +105,277 @@ class VADIterator:
 # (see https://github.com/ufal/whisper_streaming/issues/116 )
 
 import numpy as np
+from sample_buffer import SampleBuffer
 class FixedVADIterator(VADIterator):
 
     def reset_states(self):
         super().reset_states()
-        self.buffer = np.array([],dtype=np.float32)
+        if getattr(self, "buffer", None) is None:
+            self.buffer = SampleBuffer(1024)
+        else:
+            self.buffer.clear()
 
     def __call__(self, x, return_seconds=False):
-        self.buffer = np.append(self.buffer, x) 
+        self.buffer.append(x)
         if len(self.buffer) >= 512:
-            ret = super().__call__(self.buffer, return_seconds=return_seconds)
-            self.buffer = np.array([],dtype=np.float32)
+            ret = super().__call__(self.buffer.view(), return_seconds=return_seconds)
+            self.buffer.clear()
             return ret
         return None
 
+    def events(self, windows, return_seconds=False):
+        """the results of __call__ for every window of 512 samples, windows is an array of shape (n, 512)"""
+        return [self(w, return_seconds=return_seconds) for w in windows]
+
+#######################
+# Silero VAD through ONNX Runtime, without torch, batched across the streams of all the server sessions
+
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+import importlib.metadata
+
+logger = logging.getLogger(__name__)
+
+# The VAD models are loaded only from local files, never from the network. They are kept in a versioned cache
+# directory, <cache dir>/<silero-vad version>/silero_vad.onnx (and silero_vad.jit for torch). The cache is filled by
+#     python3 silero_vad.py --install
+# which copies the models from the silero-vad package or the torch.hub cache, or with --download from GitHub.
+
+VAD_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "whisper_streaming", "silero-vad")
+DOWNLOAD_VERSION = "5.1.2"
+DOWNLOAD_URL = "https://github.com/snakers4/silero-vad/raw/v{version}/src/silero_vad/data/{name}"
+MODEL_FILES = ["silero_vad.onnx", "silero_vad.jit"]
+
+def version_key(version):
+    return [int(p) if p.isdigit() else -1 for p in version.replace("-", ".").split(".")]
+
+def cached_model(name, cache_dir=None, version=None):
+    """path of the model file in the cache: of the given version, or of the newest one that has it. None if it's not there."""
+    cache_dir = cache_dir or VAD_CACHE_DIR
+    if version is not None:
+        versions = [version]
+    elif os.path.isdir(cache_dir):
+        versions = sorted(os.listdir(cache_dir), key=version_key, reverse=True)
+    else:
+        versions = []
+    for v in versions:
+        path = os.path.join(cache_dir, v, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def installed_models():
+    """(version, directory) of the local copies of the models that are not in the cache: the silero-vad pip package and the torch.hub cache.
+    The package is not imported, only its files are looked up. (It can't be found by its module name, this module has the same one.)"""
+    sources = []
+    try:
+        dist = importlib.metadata.distribution("silero-vad")
+        sources.append((dist.version, str(dist.locate_file("silero_vad/data"))))
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    torch_home = os.environ.get("TORCH_HOME", os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "torch"))
+    hub = os.path.join(torch_home, "hub", "snakers4_silero-vad_master")
+    sources.append(("hub-master", os.path.join(hub, "src", "silero_vad", "data")))
+    sources.append(("hub-master", os.path.join(hub, "files")))
+    return sources
+
+def find_model(name, path=None, cache_dir=None, version=None):
+    """Path of the model file name (silero_vad.onnx or silero_vad.jit): the explicit path, or from the cache, 
+    or from the silero-vad package or the torch.hub cache. Raises FileNotFoundError if it's nowhere."""
+    if path is not None:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"VAD model {path} does not exist")
+        return path
+    found = cached_model(name, cache_dir, version)
+    if found is not None:
+        return found
+    if version is None:
+        for _, d in installed_models():
+            if os.path.isfile(os.path.join(d, name)):
+                return os.path.join(d, name)
+    raise FileNotFoundError(f"VAD model {name} is not in the cache {cache_dir or VAD_CACHE_DIR}"
+                            + (f" for version {version}" if version else "")
+                            + ". Install it with: python3 silero_vad.py --install")
+
+def install(cache_dir=None, download=False, version=DOWNLOAD_VERSION):
+    """copies the models to the cache from the local copies, or downloads them. Returns the cache directory of the version."""
+    import shutil
+    cache_dir = cache_dir or VAD_CACHE_DIR
+    if download:
+        import urllib.request
+        target = os.path.join(cache_dir, version)
+        os.makedirs(target, exist_ok=True)
+        for name in MODEL_FILES:
+            url = DOWNLOAD_URL.format(version=version, name=name)
+            logger.info(f"downloading {url}")
+            urllib.request.urlretrieve(url, os.path.join(target, name) + ".part")
+            os.replace(os.path.join(target, name) + ".part", os.path.join(target, name))
+        return target
+    for v, d in installed_models():
+        files = [n for n in MODEL_FILES if os.path.isfile(os.path.join(d, n))]
+        if files:
+            target = os.path.join(cache_dir, v)
+            os.makedirs(target, exist_ok=True)
+            for n in files:
+                shutil.copyfile(os.path.join(d, n), os.path.join(target, n))
+                logger.info(f"copied {os.path.join(d, n)} to {target}")
+            return target
+    raise FileNotFoundError("No local copy of the Silero VAD models. Install the silero-vad package, or use --download.")
+
+def load_torch_model(path=None):
+    """the torch Silero model (silero_vad.jit), as torch.hub.load('snakers4/silero-vad', 'silero_vad') loads it, but from a local file"""
+    import torch
+    model = torch.jit.load(path or find_model("silero_vad.jit"))
+    model.eval()
+    return model
+
+class OnnxSileroVAD:
+    """Silero VAD (v5) model run by ONNX Runtime. Unlike the torch model, it doesn't keep any state: the recurrent
+    state and the context (the last 64 samples of the previous window) of every stream are passed in and returned,
+    so that the windows of many streams can be evaluated in one forward pass."""
+
+    WINDOW = 512
+    CONTEXT = 64
+
+    def __init__(self, path=None, num_threads=1, sampling_rate=16000):
+        import onnxruntime
+        if sampling_rate != 16000:
+            raise ValueError("OnnxSileroVAD supports only 16000 sampling rate")
+        opts = onnxruntime.SessionOptions()
+        opts.inter_op_num_threads = 1
+        opts.intra_op_num_threads = num_threads
+        self.path = path or find_model("silero_vad.onnx")
+        self.session = onnxruntime.InferenceSession(self.path, providers=["CPUExecutionProvider"], sess_options=opts)
+        self.sr = np.array(sampling_rate, dtype=np.int64)
+
+    def initial_state(self):
+        """the recurrent state and the context of a new stream"""
+        return np.zeros((2, 128), dtype=np.float32), np.zeros(self.CONTEXT, dtype=np.float32)
+
+    def forward(self, windows, states, contexts):
+        """windows: (n, 512), states: (2, n, 128), contexts: (n, 64).
+        Returns the speech probabilities (n,) and the new states (2, n, 128)."""
+        x = np.concatenate([contexts, windows], axis=1).astype(np.float32, copy=False)
+        out, states = self.session.run(None, {"input": x, "state": states, "sr": self.sr})
+        return out[:, 0], states
+
+class VADEngine:
+    """Evaluates the VAD windows of all the streams (BatchedVADIterator) with one OnnxSileroVAD model.
+
+    The streams put their windows to a queue and wait. An engine thread collects the pending requests (at most
+    batch_size of them, batch_window seconds after the first one arrived) and evaluates them in batches: the first
+    window of every request in one forward pass, then the second one, etc. The windows of one stream are in order,
+    because the model is recurrent. With batch_window=0, the requests that arrived during the previous forward pass
+    make the next batch, so no stream waits longer than for one pass.
+    """
+
+    def __init__(self, model, batch_size=64, batch_window=0.0):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.requests = queue.Queue()
+        self.forward_calls = 0
+        self.windows = 0
+
+        self.thread = threading.Thread(target=self.run, name="vad-engine", daemon=True)
+        self.thread.start()
+
+    def speech_probs(self, stream, windows):
+        """speech probabilities of the windows (n, 512) of the stream, it updates stream.state and stream.context"""
+        request = {"stream": stream, "windows": windows, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["probs"]
+
+    def collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            try:
+                self.forward(batch)
+            except Exception as e:
+                for r in batch:
+                    r["error"] = e
+            for r in batch:
+                r["done"].set()
+
+    def forward(self, batch):
+        for r in batch:
+            r["probs"] = np.empty(len(r["windows"]), dtype=np.float32)
+        for i in range(max(len(r["windows"]) for r in batch)):
+            active = [r for r in batch if i < len(r["windows"])]
+            windows = np.stack([r["windows"][i] for r in active])
+            states = np.stack([r["stream"].state for r in active], axis=1)
+            contexts = np.stack([r["stream"].context for r in active])
+            probs, states = self.model.forward(windows, states, contexts)
+            for j, r in enumerate(active):
+                r["probs"][i] = probs[j]
+                r["stream"].state = states[:, j]
+                r["stream"].context = windows[j, -self.model.CONTEXT:]
+            self.forward_calls += 1
+            self.windows += len(active)
+        logger.debug(f"VAD batch of {len(batch)} streams, {self.windows/max(1, self.forward_calls):.1f} windows per forward pass on average")
+
+class BatchedVADIterator(VADIterator):
+    """VADIterator of one stream, with the same start/end decisions, evaluated by the shared VADEngine.
+    The recurrent state of the model for this stream is kept here. The windows must be exactly 512 samples."""
+
+    def __init__(self, engine, **kwargs):
+        super().__init__(engine, **kwargs)
+
+    def reset_states(self):
+        self.state, self.context = self.model.model.initial_state()
+        self.triggered = False
+        self.temp_end = 0
+        self.current_sample = 0
+
+    def __call__(self, x, return_seconds=False):
+        x = np.asarray(x, dtype=np.float32)
+        if len(x) != OnnxSileroVAD.WINDOW:
+            raise ValueError(f"BatchedVADIterator needs windows of {OnnxSileroVAD.WINDOW} samples, got {len(x)}")
+        return self.events(x.reshape(1, -1), return_seconds=return_seconds)[0]
+
+    def events(self, windows, return_seconds=False):
+        probs = self.model.speech_probs(self, windows)
+        return [self.update(p, windows.shape[1], return_seconds) for p in probs]
+
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--install", action="store_true", help="Copy the VAD models to the cache, from the silero-vad package or the torch.hub cache.")
+    parser.add_argument("--download", action="store_true", help="With --install, download the models from GitHub instead.")
+    parser.add_argument("--version", type=str, default=DOWNLOAD_VERSION, help="silero-vad version to download.")
+    parser.add_argument("--cache-dir", type=str, default=VAD_CACHE_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.install:
+        target = install(args.cache_dir, download=args.download, version=args.version)
+        print(f"The VAD models are in {target}")
+        sys.exit(0)
+
     # test/demonstrate the need for FixedVADIterator:
 
-    import torch
-    model, _ = torch.hub.load(
-        repo_or_dir='snakers4/silero-vad',
-        model='silero_vad'
-    )
+    model = load_torch_model(find_model("silero_vad.jit", cache_dir=args.cache_dir))
     vac = FixedVADIterator(model)
 #   vac = VADIterator(model)  # the second case crashes with this
 
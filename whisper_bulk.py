@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""Bulk offline transcription of many recordings to subtitles (SRT, WebVTT) and JSON.
+
+The inputs are audio files, directories (searched recursively for the --extensions) and lists of files
+(--file-list, one path per line). Every recording is split at the pauses found by the Silero VAD into pieces of at
+most --max-piece-sec, because Whisper transcribes 30 seconds at once. The pieces of a recording are transcribed in
+batches of --batch-size with ASRBase.transcribe_batch, and with --workers N, N recordings are processed in parallel
+by worker processes, each with its own model (started as in worker_pool.py).
+
+The outputs are written next to each other in --output-dir, with the directory structure of the inputs. A finished
+recording is recorded in the journal PROGRESS_FILE there, after its outputs are complete, so an interrupted run
+started again with the same options continues with the first unfinished recording.
+
+    python3 whisper_bulk.py recordings/ --output-dir subtitles --lan en --model small --workers 4
+    python3 whisper_bulk.py --file-list todo.txt --formats srt json --batch-size 8 --num-workers 4
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from whisper_online import *
+from audio_source import AudioSource
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+PROGRESS_FILE = "whisper_bulk_progress.jsonl"
+FORMATS = ["srt", "vtt", "json"]
+EXTENSIONS = [".wav", ".flac", ".mp3", ".ogg", ".opus", ".m4a", ".aac", ".wma", ".mp4", ".mkv", ".webm"]
+VAD_BLOCK = 1024  # VAD windows of 512 samples evaluated in one call, 32 seconds
+SPEECH_PAD_MS = 200  # the speech segments of the VAD are extended by it, Whisper needs the beginning of the first word
+
+
+# splitting at the VAD pauses
+
+def speech_segments(source, vad):
+    """[(beg, end)] in samples of the speech of the AudioSource, found by the VADIterator vad"""
+    vad.reset_states()
+    window = 512
+    n = len(source) // window
+    segments = []
+    start = None
+    for i in range(0, n, VAD_BLOCK):
+        windows = source.read_samples(i*window, min(n, i+VAD_BLOCK)*window).reshape(-1, window)
+        for e in vad.events(windows):
+            if e is None:
+                continue
+            if "start" in e:
+                start = max(0, e["start"])
+            elif start is not None:
+                segments.append((start, min(len(source), e["end"])))
+                start = None
+    if start is not None:
+        segments.append((start, len(source)))
+    return segments
+
+def quietest_cut(source, beg, end, frame=1600):
+    """the start of the quietest frame in the second half of beg..end, to cut a long speech segment there"""
+    lo = beg + (end - beg)//2
+    frames = (end - lo) // frame
+    if frames < 2:
+        return end
+    energy = (source.read_samples(lo, lo+frames*frame).reshape(frames, frame)**2).sum(axis=1)
+    return lo + int(np.argmin(energy))*frame
+
+def split_pieces(source, segments, max_samples):
+    """joins the speech segments to pieces of at most max_samples, and cuts the longer segments at the quietest place"""
+    pieces = []
+    for beg, end in segments:
+        if pieces and end - pieces[-1][0] <= max_samples:
+            pieces[-1][1] = end
+            continue
+        while end - beg > max_samples:
+            cut = quietest_cut(source, beg, beg + max_samples)
+            pieces.append([beg, cut])
+            beg = cut
+        pieces.append([beg, end])
+    return [(beg, end) for beg, end in pieces]
+
+
+# subtitles
+
+def subtitle_cues(words, sep, max_chars=84, max_sec=6.0, max_gap=1.0):
+    """groups the words [(beg, end, word)] to subtitle cues [(beg, end, text)]. A cue ends after a sentence, at a pause
+    longer than max_gap, or before it would be longer than max_chars characters or max_sec seconds."""
+    cues = []
+    cue = []
+    for w in words:
+        if cue:
+            text = sep.join(x[2] for x in cue + [w]).strip()
+            if (w[0] - cue[-1][1] > max_gap or w[1] - cue[0][0] > max_sec or len(text) > max_chars
+                    or cue[-1][2].strip()[-1:] in (".", "?", "!")):
+                cues.append(cue)
+                cue = []
+        cue.append(w)
+    if cue:
+        cues.append(cue)
+    return [(c[0][0], c[-1][1], sep.join(x[2] for x in c).strip()) for c in cues]
+
+def timestamp(t, decimal):
+    ms = int(round(t*1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d}{decimal}{ms:03d}"
+
+def format_srt(result):
+    return "".join(f"{i}\n{timestamp(b, ',')} --> {timestamp(e, ',')}\n{t}\n\n" for i, (b, e, t) in enumerate(result["segments"], 1))
+
+def format_vtt(result):
+    return "WEBVTT\n\n" + "".join(f"{timestamp(b, '.')} --> {timestamp(e, '.')}\n{t}\n\n" for b, e, t in result["segments"])
+
+def format_json(result):
+    out = {
+        "file": result["file"],
+        "duration": round(result["duration"], 3),
+        "segments": [{"start": round(b, 3), "end": round(e, 3), "text": t} for b, e, t in result["segments"]],
+        "words": [{"start": round(b, 3), "end": round(e, 3), "word": w} for b, e, w in result["words"]],
+    }
+    return json.dumps(out, ensure_ascii=False, indent=1) + "\n"
+
+FORMATTERS = {"srt": format_srt, "vtt": format_vtt, "json": format_json}
+
+def write_atomic(path, text):
+    """the file is complete or it doesn't exist, even if the process is killed while writing"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part = path + ".part"
+    with open(part, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(part, path)
+
+
+# transcription
+
+class BulkTranscriber:
+    '''Transcribes whole recordings with one ASR model: VAD split, then batched transcribe calls of the pieces.'''
+
+    def __init__(self, args, asr):
+        self.asr = asr
+        self.batch_size = max(1, args.batch_size)
+        self.max_samples = int(args.max_piece_sec*SAMPLING_RATE)
+        self.cue_options = dict(max_chars=args.max_cue_chars, max_sec=args.max_cue_sec)
+        from silero_vad import BatchedVADIterator, FixedVADIterator, load_torch_model
+        vad_options = dict(min_silence_duration_ms=args.min_silence_ms, speech_pad_ms=SPEECH_PAD_MS)
+        vad_engine = vad_engine_factory(args)
+        if vad_engine is not None:
+            self.vad = BatchedVADIterator(vad_engine, **vad_options)
+        else:
+            self.vad = FixedVADIterator(load_torch_model(torch_vad_model(args)), **vad_options)
+
+    def transcribe(self, path):
+        """the result of the recording: the words and the cues with the times in seconds, and the processing times"""
+        t = time.perf_counter()
+        source = AudioSource(path)
+        pieces = split_pieces(source, speech_segments(source, self.vad), self.max_samples)
+        vad_sec = time.perf_counter() - t
+        words = []
+        for i in range(0, len(pieces), self.batch_size):
+            batch = pieces[i:i+self.batch_size]
+            results = self.asr.transcribe_batch([source.read_samples(b, e) for b, e in batch], [""]*len(batch))
+            for (b, e), res in zip(batch, results):
+                offset = b/SAMPLING_RATE
+                words.extend((offset + wb, min(offset + we, e/SAMPLING_RATE), w) for wb, we, w in self.asr.ts_words(res))
+        return {
+            "file": path,
+            "duration": source.duration,
+            "speech": sum(e - b for b, e in pieces)/SAMPLING_RATE,
+            "pieces": len(pieces),
+            "words": words,
+            "segments": subtitle_cues(words, self.asr.sep, **self.cue_options),
+            "vad_sec": vad_sec,
+            "processing_sec": time.perf_counter() - t,
+        }
+
+transcriber = None  # of this worker process
+
+def init_worker(args, asr):
+    """initializer of the worker processes. asr is the model loaded before fork, or None to load it here."""
+    global transcriber
+    # Ctrl-C is handled by the main process, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_logging(args, logger, other="")
+    if asr is None:
+        asr = backend_factory(args)
+    transcriber = BulkTranscriber(args, asr)
+
+def transcribe_task(path):
+    try:
+        return transcriber.transcribe(path)
+    except Exception as e:
+        logger.exception(f"transcribing {path} failed")
+        return {"file": path, "error": repr(e)}
+
+
+# inputs, outputs and the progress journal
+
+def collect_inputs(paths, file_list, extensions):
+    """[(input file, its output name without the extension)], in the order of the inputs, the directories sorted.
+    A file that is in the inputs more than once is transcribed once."""
+    extensions = tuple(x.lower() for x in extensions)
+    jobs = []
+    if file_list:
+        with open(file_list, encoding="utf-8") as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(extensions):
+                        path = os.path.join(root, name)
+                        jobs.append((path, os.path.splitext(os.path.relpath(path, p))[0]))
+        elif os.path.isfile(p):
+            jobs.append((p, os.path.splitext(os.path.basename(p))[0]))
+        else:
+            logger.error(f"{p} is not a file or a directory, skipping it")
+    seen = set()
+    unique = []
+    for path, name in jobs:
+        if os.path.abspath(path) not in seen:
+            seen.add(os.path.abspath(path))
+            unique.append((path, name))
+    return unique
+
+def output_collisions(jobs):
+    """{output name: [input files]} of the output names of more than one input file, e.g. talk.wav and talk.flac"""
+    names = {}
+    for path, name in jobs:
+        names.setdefault(name, []).append(path)
+    return {name: paths for name, paths in names.items() if len(paths) > 1}
+
+class Progress:
+    '''Journal of the finished recordings in the output directory, one JSON line per recording. A recording is done
+    if its size and modification time, and the options, are the same as in the journal, and its outputs exist.'''
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # the last line of a killed run
+                        continue
+                    self.done[entry["file"]] = entry
+
+    def key(self, path):
+        st = os.stat(path)
+        return {"file": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime, "options": self.options}
+
+    def is_done(self, path, outputs):
+        entry = self.done.get(os.path.abspath(path))
+        if entry is None or any(entry.get(k) != v for k, v in self.key(path).items()):
+            return False
+        return all(os.path.exists(o) for o in outputs)
+
+    def add(self, path, result):
+        entry = self.key(path)
+        entry.update(duration=result["duration"], processing_sec=round(result["processing_sec"], 3))
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribes many recordings to subtitles, in parallel.")
+    parser.add_argument("inputs", type=str, nargs="*", help="Audio files and directories.")
+    parser.add_argument("--file-list", type=str, default=None, dest="file_list", help="File with the paths of the audio files, one per line.")
+    parser.add_argument("--output-dir", type=str, default="transcripts", dest="output_dir", help="Directory of the outputs and of the progress journal.")
+    parser.add_argument("--formats", type=str, nargs="+", default=FORMATS, choices=FORMATS, help="Output formats.")
+    parser.add_argument("--extensions", type=str, nargs="+", default=EXTENSIONS, help="Extensions of the audio files searched in the directories.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each with its own model, transcribing different recordings. 1 means in this process. The workers share the weights of a model on CPU loaded before fork, but not of faster-whisper, which every worker loads again.")
+    parser.add_argument("--worker-start", type=str, default="auto", choices=["auto", "fork", "spawn"], dest="worker_start",
+            help="How the worker processes are started. auto: fork on CPU, the model is loaded before fork if the backend allows it; spawn on CUDA, always.")
+    parser.add_argument("--batch-size", type=int, default=4, dest="batch_size", help="Pieces of a recording transcribed in one transcribe_batch call. faster-whisper runs them in parallel with --num-workers.")
+    parser.add_argument("--max-piece-sec", type=float, default=25.0, dest="max_piece_sec", help="Maximum length of the pieces of the recordings, at most 30 seconds of Whisper.")
+    parser.add_argument("--min-silence-ms", type=int, default=500, dest="min_silence_ms", help="The recordings are split at the pauses of the VAD longer than this.")
+    parser.add_argument("--max-cue-chars", type=int, default=84, dest="max_cue_chars", help="Maximum length of a subtitle cue in characters.")
+    parser.add_argument("--max-cue-sec", type=float, default=6.0, dest="max_cue_sec", help="Maximum duration of a subtitle cue in seconds.")
+    parser.add_argument("--overwrite", action="store_true", default=False, help="Transcribe also the recordings that are done according to the progress journal.")
+    add_shared_args(parser)
+    args = parser.parse_args()
+    set_logging(args, logger, other="")
+    # the recordings are always split by the VAD, vad_engine_factory loads it only with vac
+    args.vac = True
+    if args.max_piece_sec > 30:
+        parser.error("--max-piece-sec must be at most 30 seconds")
+
+    jobs = collect_inputs(args.inputs, args.file_list, args.extensions)
+    if not jobs:
+        parser.error("no audio files in the inputs")
+    collisions = output_collisions(jobs)
+    if collisions:
+        parser.error("these inputs would have the same outputs, rename them or transcribe them separately with other --output-dir: "
+                     + "; ".join(", ".join(paths) for paths in collisions.values()))
+    options = {k: getattr(args, k) for k in ("model", "model_dir", "backend", "lan", "task", "vad", "max_piece_sec", "min_silence_ms", "max_cue_chars", "max_cue_sec")}
+    progress = Progress(os.path.join(args.output_dir, PROGRESS_FILE), options)
+    outputs = {path: [os.path.join(args.output_dir, f"{name}.{fmt}") for fmt in args.formats] for path, name in jobs}
+    todo = [path for path, _ in jobs if args.overwrite or not progress.is_done(path, outputs[path])]
+    logger.info(f"{len(jobs)} recordings, {len(jobs) - len(todo)} of them are done, {len(todo)} to transcribe")
+    if not todo:
+        return
+
+    t = time.time()
+    pool = None
+    if args.workers > 1:
+        from worker_pool import start_method
+        method, preload = start_method(args)
+        asr = backend_factory(args) if preload else None
+        logger.info(f"Starting {args.workers} workers ({method}, {'sharing the loaded model' if asr is not None else 'every worker loads the model'})")
+        pool = multiprocessing.get_context(method).Pool(args.workers, initializer=init_worker, initargs=(args, asr))
+        results = pool.imap_unordered(transcribe_task, todo)
+    else:
+        init_worker(args, None)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        results = map(transcribe_task, todo)
+
+    # the wall time includes the model load of the spawned workers, which happens in parallel with the first recordings
+    done = failed = 0
+    audio_sec = processing_sec = 0.0
+    try:
+        for result in results:
+            path = result["file"]
+            if "error" in result:
+                failed += 1
+                continue
+            for fmt, out in zip(args.formats, outputs[path]):
+                write_atomic(out, FORMATTERS[fmt](result))
+            progress.add(path, result)
+            done += 1
+            audio_sec += result["duration"]
+            processing_sec += result["processing_sec"]
+            logger.info(f"[{done + failed}/{len(todo)}] {path}: {result['duration']:.1f} s, {result['pieces']} pieces, "
+                        f"{len(result['words'])} words in {result['processing_sec']:.1f} s (RTF {result['processing_sec']/max(result['duration'], 1e-9):.3f})")
+    except KeyboardInterrupt:
+        logger.warning("Interrupted. The next run with the same options continues with the unfinished recordings.")
+        if pool is not None:
+            pool.terminate()
+        sys.exit(130)
+    finally:
+        wall = time.time() - t
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if done:
+            # RTF: processing time / audio duration, below 1 is faster than real time
+            # the recordings can be empty
+            audio = max(audio_sec, 1e-9)
+            logger.info(f"Transcribed {done} recordings, {audio_sec/3600:.2f} hours of audio, in {wall:.1f} s: "
+                        f"aggregate RTF {wall/audio:.4f} ({audio_sec/max(wall, 1e-9):.1f}x real time), "
+                        f"RTF per worker {processing_sec/audio:.4f}")
+    if failed:
+        logger.error(f"{failed} recordings failed")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
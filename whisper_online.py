@@ -1,27 +1,33 @@
 #!/usr/bin/env python3
+import os
 import sys
 import numpy as np
-import librosa
 from functools import lru_cache
 import time
 import logging
+import threading
 
-import io
-import soundfile as sf
 import math
+import bisect
+import itertools
+
+from sample_buffer import SampleBuffer
+from audio_source import AudioSource
+from sentence_split import RuleSplitter, RULE_LANGUAGES
 
 logger = logging.getLogger(__name__)
 
-@lru_cache(10**6)
+@lru_cache(16)
+def audio_source(fname):
+    """the AudioSource of the file, which reads only the requested chunks, so a long recording is never decoded at once"""
+    return AudioSource(fname)
+
 def load_audio(fname):
-    a, _ = librosa.load(fname, sr=16000, dtype=np.float32)
-    return a
+    """the whole audio file, 16 kHz mono float32"""
+    return audio_source(fname).read(0)
 
 def load_audio_chunk(fname, beg, end):
-    audio = load_audio(fname)
-    beg_s = int(beg*16000)
-    end_s = int(end*16000)
-    return audio[beg_s:end_s]
+    return audio_source(fname).read(beg, end)
 
 
 # Whisper backend
@@ -31,7 +37,13 @@ class ASRBase:
     sep = " "   # join transcribe words with this character (" " for whisper_timestamped,
                 # "" for faster-whisper because it emits the spaces when neeeded)
 
-    def __init__(self, lan, modelsize=None, cache_dir=None, model_dir=None, logfile=sys.stderr):
+    supports_prefix = False  # whether transcribe accepts the prefix argument, a forced beginning of the decoded text
+
+    supports_beam_size = False  # whether transcribe accepts the beam_size argument, to lower it under overload (overload.py)
+
+    fork_after_load = True  # whether a loaded model still works in a forked process (worker_pool shares its memory copy-on-write)
+
+    def __init__(self, lan, modelsize=None, cache_dir=None, model_dir=None, logfile=sys.stderr, **model_kwargs):
         self.logfile = logfile
 
         self.transcribe_kargs = {}
@@ -40,19 +52,47 @@ class ASRBase:
         else:
             self.original_language = lan
 
-        self.model = self.load_model(modelsize, cache_dir, model_dir)
+        self.model = self.load_model(modelsize, cache_dir, model_dir, **model_kwargs)
 
 
-    def load_model(self, modelsize, cache_dir):
+    def load_model(self, modelsize, cache_dir, model_dir, **model_kwargs):
         raise NotImplemented("must be implemented in the child class")
 
     def transcribe(self, audio, init_prompt=""):
         raise NotImplemented("must be implemented in the child class")
 
+    def transcribe_batch(self, audios, init_prompts, prefixes=None, beam_sizes=None):
+        """Transcribes several independent audio buffers, e.g. of different client sessions, in one call. 
+        Returns the list of results in the same order as audios. 
+        The default runs one transcribe call after another, the backends that can run them in parallel override it.
+        """
+        if prefixes is None:
+            prefixes = [None]*len(audios)
+        if beam_sizes is None:
+            beam_sizes = [None]*len(audios)
+        return [self.transcribe(a, init_prompt=p, **prefix_kwargs(x), **beam_kwargs(b)) for a, p, x, b in zip(audios, init_prompts, prefixes, beam_sizes)]
+
+    def count_tokens(self, text):
+        """approximate number of decoder tokens of the text, to measure the decoder steps saved by prefix decoding"""
+        return len(text.split())
+
+    def ts_words_after_prefix(self, res, prefix_end):
+        """ts_words of a result of transcribe with a prefix. It has only the words after the prefix, which ends at 
+        prefix_end seconds of the audio. The backends that don't align these words after the prefix override it."""
+        return self.ts_words(res)
+
     def use_vad(self):
         raise NotImplemented("must be implemented in the child class")
 
 
+def prefix_kwargs(prefix):
+    # the prefix argument is passed only if it's set, because not all the backends accept it
+    return {"prefix": prefix} if prefix else {}
+
+def beam_kwargs(beam_size):
+    # the beam_size argument is passed only if it's lowered, only the backends with supports_beam_size accept it
+    return {"beam_size": beam_size} if beam_size else {}
+
 class WhisperTimestampedASR(ASRBase):
     """Uses whisper_timestamped library as the backend. Initially, we tested the code on this backend. It worked, but slower than faster-whisper.
     On the other hand, the installation for GPU could be easier.
@@ -60,14 +100,16 @@ class WhisperTimestampedASR(ASRBase):
 
     sep = " "
 
-    def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
+    def load_model(self, modelsize=None, cache_dir=None, model_dir=None, device="auto", **kwargs):
         import whisper
         import whisper_timestamped
         from whisper_timestamped import transcribe_timestamped
         self.transcribe_timestamped = transcribe_timestamped
         if model_dir is not None:
             logger.debug("ignoring model_dir, not implemented")
-        return whisper.load_model(modelsize, download_root=cache_dir)
+        if kwargs:
+            logger.debug(f"ignoring {', '.join(kwargs)}, not implemented")
+        return whisper.load_model(modelsize, device=None if device == "auto" else device, download_root=cache_dir)
 
     def transcribe(self, audio, init_prompt=""):
         result = self.transcribe_timestamped(self.model,
@@ -102,8 +144,12 @@ class FasterWhisperASR(ASRBase):
     """
 
     sep = ""
+    supports_prefix = True
+    supports_beam_size = True
+    BEAM_SIZE = 5
+    fork_after_load = False  # CTranslate2 runs the model in its own threads, which a forked process doesn't have
 
-    def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
+    def load_model(self, modelsize=None, cache_dir=None, model_dir=None, device="auto", compute_type="auto", cpu_threads=0, num_workers=1):
         from faster_whisper import WhisperModel
 #        logging.getLogger("faster_whisper").setLevel(logger.level)
         if model_dir is not None:
@@ -114,32 +160,104 @@ class FasterWhisperASR(ASRBase):
         else:
             raise ValueError("modelsize or model_dir parameter must be set")
 
-        compute_type = "float32"
-        import torch
-        gpu_properties = torch.cuda.get_device_properties(0)
-        if gpu_properties.major >= 7:
-            compute_type = "float16"
-
-        # this worked fast and reliably on NVIDIA L40
-        model = WhisperModel(model_size_or_path, device="cuda", compute_type=compute_type, download_root=cache_dir)
-
-        # or run on GPU with INT8
-        # tested: the transcripts were different, probably worse than with FP16, and it was slightly (appx 20%) slower
-        #model = WhisperModel(model_size, device="cuda", compute_type="int8_float16")
+        device, compute_type = self.detect_device(device, compute_type)
+        logger.info(f"faster-whisper runs on {device} with {compute_type}")
 
-        # or run on CPU with INT8
-        # tested: works, but slow, appx 10-times than cuda FP16
-#        model = WhisperModel(modelsize, device="cpu", compute_type="int8") #, download_root="faster-disk-cache-dir/")
+        # tested: cuda with float16 worked fast and reliably on NVIDIA L40
+        # cuda with int8_float16: the transcripts were different, probably worse than with FP16, and it was slightly (appx 20%) slower
+        # cpu with int8: works, but slow, appx 10-times than cuda FP16
+        self.num_workers = num_workers
+        model = WhisperModel(model_size_or_path, device=device, compute_type=compute_type, 
+                cpu_threads=cpu_threads, num_workers=num_workers, download_root=cache_dir)
         return model
 
-    def transcribe(self, audio, init_prompt=""):
+    @staticmethod
+    def detect_device(device="auto", compute_type="auto"):
+        """Resolves "auto" device and compute type with CTranslate2, without importing torch. 
+        Returns (device, compute_type): cuda with float16 if the GPU supports it, otherwise float32; cpu with int8.
+        """
+        import ctranslate2
+        if device == "auto":
+            try:
+                device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+            except Exception as e:  # e.g. broken CUDA installation
+                logger.warning(f"CUDA device detection failed, using CPU: {e}")
+                device = "cpu"
+        if compute_type == "auto":
+            if device == "cuda":
+                supported = ctranslate2.get_supported_compute_types("cuda")
+                compute_type = "float16" if "float16" in supported else "float32"
+            else:
+                compute_type = "int8"
+        return device, compute_type
+
+    def transcribe(self, audio, init_prompt="", prefix=None, beam_size=None):
 
         # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
-        segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=5, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
+        # a lower one is used only under overload
+        segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, prefix=prefix, beam_size=beam_size or self.BEAM_SIZE, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
         #print(info)  # info contains language detection result
 
         return list(segments)
 
+    MAX_BATCHED_SEC = 30  # the batched pipeline decodes only one window of every audio
+
+    def transcribe_batch(self, audios, init_prompts, prefixes=None, beam_sizes=None):
+        # The calls with the same prompt, without prefixes, e.g. the pieces of whisper_bulk, are one batched model call 
+        # of BatchedInferencePipeline. The pipeline takes one prompt and one prefix for the whole batch, so the other 
+        # calls, e.g. of the server sessions with their own prompts, are separate transcribe calls. CTranslate2 runs 
+        # them in parallel only in more model workers: num_workers must be at least the batch size.
+        # The segments generator is consumed in the pool thread, so the decoding also happens there.
+        if prefixes is None:
+            prefixes = [None]*len(audios)
+        if beam_sizes is None:
+            beam_sizes = [None]*len(audios)
+        if len(audios) == 1:
+            return [self.transcribe(audios[0], init_prompt=init_prompts[0], prefix=prefixes[0], beam_size=beam_sizes[0])]
+        if (len(set(init_prompts)) == 1 and all(x is None for x in prefixes) and len(set(beam_sizes)) == 1 
+                and all(0 < len(a) <= self.MAX_BATCHED_SEC*16000 for a in audios)):
+            res = self.transcribe_batched(audios, init_prompts[0], beam_sizes[0])
+            if res is not None:
+                return res
+        if getattr(self, "batch_executor", None) is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.batch_executor = ThreadPoolExecutor(max_workers=max(1, self.num_workers), thread_name_prefix="faster-whisper-batch")
+        futures = [self.batch_executor.submit(self.transcribe, a, p, x, b) for a, p, x, b in zip(audios, init_prompts, prefixes, beam_sizes)]
+        return [f.result() for f in futures]
+
+    def transcribe_batched(self, audios, init_prompt, beam_size):
+        """The audios decoded in one batch of BatchedInferencePipeline, as the clips of one concatenated audio. 
+        Returns the segments of every audio, with the times from its beginning, or None if the installed 
+        faster-whisper doesn't have the pipeline (before 1.1)."""
+        if getattr(self, "batched_pipeline", None) is None:
+            try:
+                from faster_whisper import BatchedInferencePipeline
+            except ImportError:
+                logger.warning("this faster-whisper has no BatchedInferencePipeline, the batches are separate transcribe calls")
+                self.batched_pipeline = False
+            else:
+                self.batched_pipeline = BatchedInferencePipeline(self.model)
+        if self.batched_pipeline is False:
+            return None
+        offsets = list(itertools.accumulate((len(a) for a in audios[:-1]), initial=0))
+        clips = [{"start": o/16000, "end": (o + len(a))/16000} for o, a in zip(offsets, audios)]
+        kargs = {k: v for k, v in self.transcribe_kargs.items() if k != "vad_filter"}  # the clips are given
+        segments, info = self.batched_pipeline.transcribe(np.concatenate(audios), language=self.original_language, 
+                initial_prompt=init_prompt or None, beam_size=beam_size or self.BEAM_SIZE, word_timestamps=True, 
+                without_timestamps=False, clip_timestamps=clips, batch_size=len(audios), **kargs)
+        import dataclasses
+        starts = [o/16000 for o in offsets]
+        res = [[] for _ in audios]
+        for s in segments:
+            i = max(bisect.bisect_right(starts, s.start + 1e-3) - 1, 0)
+            t = starts[i]
+            words = [dataclasses.replace(w, start=w.start - t, end=w.end - t) for w in s.words or []]
+            res[i].append(dataclasses.replace(s, start=s.start - t, end=s.end - t, words=words))
+        return res
+
+    def count_tokens(self, text):
+        return len(self.model.hf_tokenizer.encode(" " + text.strip(), add_special_tokens=False).ids)
+
     def ts_words(self, segments):
         o = []
         for segment in segments:
@@ -152,6 +270,17 @@ class FasterWhisperASR(ASRBase):
                 o.append(t)
         return o
 
+    def ts_words_after_prefix(self, segments, prefix_end):
+        # faster-whisper aligns the word timestamps only over the generated tokens, not over the prefix, so the words 
+        # of the first segment, which continues the prefix, start near 0. They are moved after the prefix, and 
+        # squeezed to keep the end of the segment, which is a timestamp token decoded by the model.
+        first = self.ts_words(segments[:1])
+        if first and segments[0].end > prefix_end and first[0][0] < prefix_end:
+            b0 = first[0][0]
+            scale = (segments[0].end - prefix_end)/max(segments[0].end - b0, 1e-6)
+            first = [(prefix_end + (b - b0)*scale, prefix_end + (e - b0)*scale, w) for b, e, w in first]
+        return first + self.ts_words(segments[1:])
+
     def segments_end_ts(self, res):
         return [s.end for s in res]
 
@@ -210,6 +339,9 @@ class OpenaiApiASR(ASRBase):
         return [s.end for s in res.words]
 
     def transcribe(self, audio_data, prompt=None, *args, **kwargs):
+        import io
+        import soundfile as sf
+
         # Write the audio data to a buffer
         buffer = io.BytesIO()
         buffer.name = "temp.wav"
@@ -250,146 +382,446 @@ class OpenaiApiASR(ASRBase):
 
 
 
+class TimedWords:
+    """Timestamped words in parallel lists of begin times, end times, texts and token ids. 
+    The words before self.start are dropped, so that removing from the front is only an index move. 
+    The dropped part is compacted away when it's longer than the live one.
+    """
+
+    __slots__ = ("beg", "end", "text", "ids", "start")
+
+    def __init__(self):
+        self.beg = []
+        self.end = []
+        self.text = []
+        self.ids = []
+        self.start = 0
+
+    def __len__(self):
+        return len(self.ids) - self.start
+
+    def append(self, b, e, t, i):
+        self.beg.append(b)
+        self.end.append(e)
+        self.text.append(t)
+        self.ids.append(i)
+
+    def extend(self, other, beg, end):
+        """appends the words other[beg:end], the indices are relative to other.start"""
+        beg += other.start
+        end += other.start
+        self.beg.extend(other.beg[beg:end])
+        self.end.extend(other.end[beg:end])
+        self.text.extend(other.text[beg:end])
+        self.ids.extend(other.ids[beg:end])
+
+    def drop(self, n):
+        """drops the first n words"""
+        self.start += n
+        if self.start > len(self.ids) // 2:
+            s = self.start
+            del self.beg[:s], self.end[:s], self.text[:s], self.ids[:s]
+            self.start = 0
+
+    def tuples(self, beg=0, end=None):
+        s = self.start
+        end = len(self) if end is None else end
+        return list(zip(self.beg[s+beg:s+end], self.end[s+beg:s+end], self.text[s+beg:s+end]))
+
+
 class HypothesisBuffer:
 
     def __init__(self, logfile=sys.stderr):
-        self.commited_in_buffer = []
-        self.buffer = []
-        self.new = []
+        self.commited_in_buffer = TimedWords()
+        self.buffer = TimedWords()
+        self.new = TimedWords()
 
         self.last_commited_time = 0
         self.last_commited_word = None
 
+        # the words are compared by integer ids, not by strings
+        self.token_ids = {}
+
         self.logfile = logfile
 
     def insert(self, new, offset):
         # compare self.commited_in_buffer and new. It inserts only the words in new that extend the commited_in_buffer, it means they are roughly behind last_commited_time and new in content
         # the new tail is added to self.new
-        
-        new = [(a+offset,b+offset,t) for a,b,t in new]
-        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
 
-        if len(self.new) >= 1:
-            a,b,t = self.new[0]
-            if abs(a - self.last_commited_time) < 1:
-                if self.commited_in_buffer:
+        token_ids = self.token_ids
+        min_time = self.last_commited_time-0.1
+        self.new = n = TimedWords()
+        for a,b,t in new:
+            a += offset
+            if a > min_time:
+                n.append(a, b+offset, t, token_ids.setdefault(t, len(token_ids)))
+
+        if len(n) >= 1:
+            if abs(n.beg[0] - self.last_commited_time) < 1:
+                c = self.commited_in_buffer
+                if len(c):
                     # it's going to search for 1, 2, ..., 5 consecutive words (n-grams) that are identical in commited and new. If they are, they're dropped.
-                    cn = len(self.commited_in_buffer)
-                    nn = len(self.new)
+                    cn = len(c)
+                    nn = len(n)
                     for i in range(1,min(min(cn,nn),5)+1):  # 5 is the maximum 
-                        c = " ".join([self.commited_in_buffer[-j][2] for j in range(1,i+1)][::-1])
-                        tail = " ".join(self.new[j-1][2] for j in range(1,i+1))
-                        if c == tail:
-                            words = []
-                            for j in range(i):
-                                words.append(repr(self.new.pop(0)))
-                            words_msg = " ".join(words)
+                        if c.ids[-i:] == n.ids[:i]:
+                            words_msg = " ".join(repr(w) for w in n.tuples(0, i))
+                            n.drop(i)
                             logger.debug(f"removing last {i} words: {words_msg}")
                             break
 
     def flush(self):
         # returns commited chunk = the longest common prefix of 2 last inserts. 
 
-        commit = []
-        while self.new:
-            na, nb, nt = self.new[0]
-
-            if len(self.buffer) == 0:
-                break
-
-            if nt == self.buffer[0][2]:
-                commit.append((na,nb,nt))
-                self.last_commited_word = nt
-                self.last_commited_time = nb
-                self.buffer.pop(0)
-                self.new.pop(0)
-            else:
-                break
-        self.buffer = self.new
-        self.new = []
-        self.commited_in_buffer.extend(commit)
+        n, b = self.new, self.buffer
+        ni, bi = n.start, b.start
+        k = 0
+        kmax = min(len(n), len(b))
+        while k < kmax and n.ids[ni+k] == b.ids[bi+k]:
+            k += 1
+
+        commit = n.tuples(0, k)
+        if k:
+            self.last_commited_word = n.text[ni+k-1]
+            self.last_commited_time = n.end[ni+k-1]
+            self.commited_in_buffer.extend(n, 0, k)
+        n.drop(k)
+        self.buffer = n
+        self.new = TimedWords()
         return commit
 
     def pop_commited(self, time):
-        while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
-            self.commited_in_buffer.pop(0)
+        c = self.commited_in_buffer
+        k = c.start
+        while k < len(c.end) and c.end[k] <= time:
+            k += 1
+        c.drop(k - c.start)
 
     def complete(self):
-        return self.buffer
+        return self.buffer.tuples()
+
+class CommitedWords:
+    """The commited words [(beg, end, "text")] of OnlineASRProcessor, in constant memory in long sessions.
+
+    Only the words that can be needed again stay in memory: the words inside of the audio buffer, and the prompt
+    window of prompt_chars characters before them. The older words are dropped, in batches of at least DROP_BATCH.
+    With a journal (a text file), every word is appended to it as a line "beg end text" (in ms) when it's commited,
+    so the whole transcript is on disk.
+    The words are found by the end time with bisect, in the running maximum of the end times, because the timestamps
+    of Whisper may go back slightly.
+    """
+
+    DROP_BATCH = 256
+
+    def __init__(self, prompt_chars=200, journal=None):
+        self.words = []
+        self.ends = []  # running maximum of the end times of self.words
+        self.dropped = 0  # number of the dropped words before self.words
+        self.prompt_chars = prompt_chars
+        self.journal = journal
+
+    def __len__(self):
+        """the number of all the commited words"""
+        return self.dropped + len(self.words)
+
+    def extend(self, words):
+        for w in words:
+            self.words.append(w)
+            self.ends.append(max(w[1], self.ends[-1]) if self.ends else w[1])
+        if self.journal is not None and words:
+            self.journal.write("".join("%1.0f %1.0f %s\n" % (b*1000, e*1000, t.strip()) for b, e, t in words))
+            self.journal.flush()
+
+    def last(self):
+        return self.words[-1] if self.words else None
+
+    def since(self, n):
+        """the words after the first n commited ones, they must be in memory"""
+        return self.words[max(0, n - self.dropped):]
+
+    def split(self, offset):
+        """Returns ([prompt words], [context words]): the words that end after the time offset (at least the last 
+        one), and the words of the prompt window before them. The words before the window are dropped."""
+        k = max(0, min(bisect.bisect_right(self.ends, offset), len(self.words) - 1))
+        j = k
+        chars = 0
+        while j > 0 and chars < self.prompt_chars:
+            j -= 1
+            chars += len(self.words[j][2]) + 1
+        prompt, context = self.words[j:k], self.words[k:]
+        if j >= self.DROP_BATCH:
+            del self.words[:j], self.ends[:j]
+            self.dropped += j
+        return prompt, context
+
+def align_sentences(sentences, words):
+    """Maps the sentences of the tokenizer to the words [(beg, end, "text")] that they were split from, by the number 
+    of their non-space characters, in one pass. 
+    Returns: [(beg, end, "sentence")] and the number of the words in them.
+    """
+    out = []
+    i = 0
+    for sent in sentences:
+        need = len("".join(sent.split()))
+        if need == 0:
+            continue
+        start = i
+        have = 0
+        while i < len(words) and have < need:
+            have += len("".join(words[i][2].split()))
+            i += 1
+        if have < need:  # the tokenizer changed the text
+            break
+        out.append((words[start][0], words[i-1][1], sent.strip()))
+    return out, i
+
+class SentenceSegmenter:
+    """Incremental sentence segmentation of the commited words, for the sentence buffer trimming.
+
+    Only the words after the last sentence boundary are split by the tokenizer. All the sentences except the last 
+    one are complete, the end of the last complete one is the new boundary, and their words are removed. The last 
+    sentence can continue in the next words. The words before the audio buffer are dropped, because the buffer can't 
+    be trimmed there anymore, so the split text is never longer than the audio buffer.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.words = []  # the commited words after the last boundary
+        self.seen = 0  # the number of the commited words that were added to self.words
+        self.boundary = None  # the end time of the last complete sentence
+
+    def last_boundary(self, commited, offset):
+        """the end time of the last complete sentence of the CommitedWords, if it's after the time offset, or None"""
+        self.words.extend(commited.since(self.seen))
+        self.seen = len(commited)
+        k = 0
+        while k < len(self.words) and self.words[k][1] <= offset:
+            k += 1
+        del self.words[:k]
+        if self.words:
+            sents = self.tokenizer.split(" ".join(w[2] for w in self.words))
+            if len(sents) >= 2:
+                done, n = align_sentences(sents[:-1], self.words)
+                for s in done:
+                    logger.debug(f"\t\tSENT: {s}")
+                if done:
+                    self.boundary = done[-1][1]
+                    del self.words[:n]
+        if self.boundary is not None and self.boundary > offset:
+            return self.boundary
+        return None
+
+def open_commit_journal(directory):
+    """a new journal file of commited words in the directory, for one OnlineASRProcessor"""
+    os.makedirs(directory, exist_ok=True)
+    name = f"commited-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(journal_numbers)}.txt"
+    return open(os.path.join(directory, name), "a", encoding="utf-8")
+
+journal_numbers = itertools.count(1)
+
+class TranscribeMemo:
+    """Memoization of the transcribe calls of one OnlineASRProcessor.
+
+    The result of the last call is kept with the fingerprint of its audio buffer: the key (buffer time offset, prompt,
+    prefix) and the buffer length. The buffer only grows while the key is the same. The next call with the same key
+    is a hit if the buffer didn't change, and a skip if it grew only by less than min_new_sec seconds, or only by
+    silence (no sample above silence_level), up to max_skip_sec. Then the cached result is used instead of transcribing
+    the buffer again, and its words go to HypothesisBuffer as if Whisper reproduced them, which it would. A trimmed
+    buffer, another prompt or prefix, or new speech is a miss.
+    """
+
+    def __init__(self, min_new_sec=0.1, silence_level=0.015, max_skip_sec=5.0, sampling_rate=16000):
+        self.sampling_rate = sampling_rate
+        self.min_new = int(min_new_sec*sampling_rate)
+        self.silence_level = silence_level
+        self.max_skip = int(max_skip_sec*sampling_rate)
+        self.hits = 0
+        self.skips = 0
+        self.misses = 0
+        self.saved_sec = 0.0  # seconds of audio buffer that were not transcribed
+        self.clear()
+
+    def clear(self):
+        self.key = None
+        self.length = 0
+        self.result = None
+
+    def lookup(self, key, audio):
+        """the cached result for the audio buffer with the fingerprint key, or None"""
+        if key != self.key or len(audio) < self.length:
+            return None
+        new = audio[self.length:]
+        if len(new) == 0:
+            self.hits += 1
+        elif len(new) < self.min_new or (len(new) <= self.max_skip and np.abs(new).max() < self.silence_level):
+            self.skips += 1
+        else:
+            return None
+        self.saved_sec += len(audio)/self.sampling_rate
+        return self.result
+
+    def store(self, key, audio, result):
+        self.misses += 1
+        self.key, self.length, self.result = key, len(audio), result
+
+    def report(self):
+        calls = self.hits + self.skips + self.misses
+        return (f"transcribe memo: {self.hits} hits, {self.skips} skips, {self.misses} transcribe calls of {calls}, "
+                f"{self.saved_sec:.1f} seconds of audio not transcribed again")
 
 class OnlineASRProcessor:
 
     SAMPLING_RATE = 16000
 
-    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr):
+    PREFIX_MAX_FALLBACKS = 3  # prefix decoding is switched off after this number of rejected prefixes in a row
+
+    SILENCE_PAD = 0.5  # seconds of a pause that are transcribed as zeros, the rest of a longer one is skipped
+
+    def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr, prefix_decoding=False, memo=None, journal=None):
         """asr: WhisperASR object
         tokenizer: sentence tokenizer object for the target language. Must have a method *split* that behaves like the one of MosesTokenizer. It can be None, if "segment" buffer trimming option is used, then tokenizer is not used at all.
         ("segment", 15)
         buffer_trimming: a pair of (option, seconds), where option is either "sentence" or "segment", and seconds is a number. Buffer is trimmed if it is longer than "seconds" threshold. Default is the most recommended option.
         logfile: where to store the log. 
+        prefix_decoding: incremental mode. The commited text inside of the audio buffer is given to the backend as a forced 
+            decoding prefix, so that the decoder generates only the new tail. 
+        memo: TranscribeMemo, to reuse the last transcription when the buffer didn't change meaningfully, or None.
+        journal: text file where the commited words are appended (CommitedWords), or None.
         """
         self.asr = asr
         self.tokenizer = tokenizer
         self.logfile = logfile
 
+        self.prefix_decoding = prefix_decoding
+        if prefix_decoding and not getattr(asr, "supports_prefix", False):
+            logger.warning("The ASR backend does not support prefix decoding. The whole buffer is decoded in every iteration.")
+            self.prefix_decoding = False
+        self.prefix_steps_saved = 0  # decoder steps saved by prefix decoding, in total
+        self.prefix_fallbacks = 0  # prefix decodings that were rejected, in total
+        self.prefix_fallbacks_in_row = 0
+        self.memo = memo
+        self.journal = journal
+
+        # overload protection (overload.py): the hard limit of the audio buffer, and the lowered beam size, or None
+        self.max_buffer_sec = None
+        self.beam_size = None
+        self.hard_trims = 0
+
         self.init()
 
         self.buffer_trimming_way, self.buffer_trimming_sec = buffer_trimming
 
     def init(self, offset=None):
         """run this when starting or restarting processing"""
-        self.audio_buffer = np.array([],dtype=np.float32)
+        if getattr(self, "audio_buffer", None) is None:
+            self.audio_buffer = SampleBuffer()
+        else:
+            self.audio_buffer.clear()  # reuses the allocated memory
         self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
         self.buffer_time_offset = 0
         if offset is not None:
             self.buffer_time_offset = offset
         self.transcript_buffer.last_commited_time = self.buffer_time_offset
-        self.commited = []
+        self.commited = CommitedWords(journal=self.journal)
+        self.sentences = SentenceSegmenter(self.tokenizer) if self.tokenizer is not None else None
+        self.the_rest = (None, None, "")
+        self.silence_run = 0  # samples of the current pause
+        self.skipped_silence = 0  # samples of silence to skip in the next process_iter
+        self.last_transcribed_sec = None
+        self.last_transcribe_duration = None
+        if self.memo is not None:
+            self.memo.clear()
 
     def insert_audio_chunk(self, audio):
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        self.audio_buffer.append(audio)
+        if len(audio):
+            self.silence_run = 0
+
+    def insert_silence(self, samples):
+        """Inserts the given number of samples of silence, that the client didn't send. The first SILENCE_PAD seconds
+        of a pause are inserted as zeros, so that Whisper sees the end of the speech. The rest of it is not transcribed:
+        the next process_iter commits all the text, as at the end of an utterance, and the processing continues after 
+        the silence, with the right timestamps. 
+        Returns: True if process_iter must be called before inserting more audio, because a part of the silence is skipped.
+        """
+        pad = max(0, int(self.SILENCE_PAD*self.SAMPLING_RATE) - self.silence_run)
+        pad = min(pad, samples) if len(self.audio_buffer) else 0  # the pause before any speech is not needed
+        if pad:
+            self.audio_buffer.append(np.zeros(pad, dtype=np.float32))
+        self.silence_run += samples
+        self.skipped_silence += samples - pad
+        return self.skipped_silence > 0
+
+    def skip_silence(self):
+        # ends the utterance before the skipped silence: its uncommitted words are commited, as by finish, and the 
+        # processing continues after the silence. The commited text stays for the prompt.
+        rest = self.transcript_buffer.complete()
+        self.commited.extend(rest)
+        end = self.buffer_time_offset + (len(self.audio_buffer) + self.skipped_silence)/self.SAMPLING_RATE
+        logger.debug(f"skipping {self.skipped_silence/self.SAMPLING_RATE:2.2f} seconds of silence, continuing from {end:2.2f}")
+        self.audio_buffer.clear()
+        self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
+        self.transcript_buffer.last_commited_time = end
+        self.buffer_time_offset = end
+        self.skipped_silence = 0
+        self.the_rest = (None, None, "")
+        return rest
+
+    def interim(self):
+        """The uncommitted tail of the last hypothesis, that is not confirmed by LocalAgreement yet. It can change 
+        in the next process_iter, and the commited text replaces it later.
+        Returns: the same format as self.process_iter()
+        """
+        return self.the_rest
 
     def prompt(self):
         """Returns a tuple: (prompt, context), where "prompt" is a 200-character suffix of commited text that is inside of the scrolled away part of audio buffer. 
         "context" is the commited text that is inside the audio buffer. It is transcribed again and skipped. It is returned only for debugging and logging reasons.
         """
-        k = max(0,len(self.commited)-1)
-        while k > 0 and self.commited[k-1][1] > self.buffer_time_offset:
-            k -= 1
-
-        p = self.commited[:k]
-        p = [t for _,_,t in p]
-        prompt = []
-        l = 0
-        while p and l < 200:  # 200 characters prompt size
-            x = p.pop(-1)
-            l += len(x)+1
-            prompt.append(x)
-        non_prompt = self.commited[k:]
-        return self.asr.sep.join(prompt[::-1]), self.asr.sep.join(t for _,_,t in non_prompt)
+        prompt, non_prompt = self.commited.split(self.buffer_time_offset)
+        return self.asr.sep.join(t for _,_,t in prompt), self.asr.sep.join(t for _,_,t in non_prompt)
 
     def process_iter(self):
         """Runs on the current audio buffer.
         Returns: a tuple (beg_timestamp, end_timestamp, "text"), or (None, None, ""). 
         The non-emty text is confirmed (committed) partial transcript.
         """
+        if self.skipped_silence and len(self.audio_buffer) == 0:  # nothing to transcribe
+            self.last_transcribed_sec = None
+            return self.to_flush(self.skip_silence())
 
         prompt, non_prompt = self.prompt()
         logger.debug(f"PROMPT: {prompt}")
         logger.debug(f"CONTEXT: {non_prompt}")
         logger.debug(f"transcribing {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f} seconds from {self.buffer_time_offset:2.2f}")
-        res = self.asr.transcribe(self.audio_buffer, init_prompt=prompt)
-
-        # transform to [(beg,end,"word1"), ...]
-        tsw = self.asr.ts_words(res)
-
-        self.transcript_buffer.insert(tsw, self.buffer_time_offset)
-        o = self.transcript_buffer.flush()
-        self.commited.extend(o)
-        completed = self.to_flush(o)
-        logger.debug(f">>>>COMPLETE NOW: {completed}")
-        the_rest = self.to_flush(self.transcript_buffer.complete())
-        logger.debug(f"INCOMPLETE: {the_rest}")
+        self.last_transcribed_sec = len(self.audio_buffer)/self.SAMPLING_RATE
+        t = time.time()
+        res = None
+        if self.memo is not None:
+            key = (self.buffer_time_offset, prompt, non_prompt if self.prefix_decoding else None)
+            res = self.memo.lookup(key, self.audio_buffer.view())
+        reused = res is not None
+        if not reused:
+            res, tsw = self.transcribe(prompt, non_prompt)
+            if self.memo is not None:
+                self.memo.store(key, self.audio_buffer.view(), res)
+        else:
+            logger.debug("the audio buffer didn't change meaningfully, reusing the last transcription")
+            self.last_transcribed_sec = None  # nothing was transcribed, for the chunk size and the metrics
+        self.last_transcribe_duration = time.time() - t
+
+        if reused:
+            # The same hypothesis again would "confirm" itself by LocalAgreement and commit the unstable tail.
+            # Nothing new is commited, the incomplete text stays.
+            o = []
+        else:
+            self.transcript_buffer.insert(tsw, self.buffer_time_offset)
+            o = self.transcript_buffer.flush()
+            self.commited.extend(o)
+            completed = self.to_flush(o)
+            logger.debug(f">>>>COMPLETE NOW: {completed}")
+            self.the_rest = self.to_flush(self.transcript_buffer.complete())
+            logger.debug(f"INCOMPLETE: {self.the_rest}")
 
         # there is a newly confirmed text
 
@@ -416,31 +848,62 @@ class OnlineASRProcessor:
             logger.debug("chunking segment")
             #self.chunk_at(t)
 
+        if self.max_buffer_sec is not None and len(self.audio_buffer)/self.SAMPLING_RATE > self.max_buffer_sec:
+            o = o + self.hard_trim()
+
         logger.debug(f"len of buffer now: {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f}")
+        if self.skipped_silence:
+            o = o + self.skip_silence()
         return self.to_flush(o)
 
+    def transcribe(self, prompt, non_prompt):
+        """Transcribes the audio buffer. With prefix decoding, non_prompt (the commited text inside of the buffer) is the decoding prefix. 
+        The backend rejects it if it raises an error, or if the timestamps of the new words start before the prefix ends 
+        (the words weren't aligned to the audio after the prefix). Then the whole buffer is decoded again without the prefix.
+        Returns: the result of the backend, and its words [(beg,end,"word1"), ...]
+        """
+        audio = self.audio_buffer.view()
+        if self.prefix_decoding and non_prompt:
+            prefix_end = self.transcript_buffer.last_commited_time - self.buffer_time_offset
+            try:
+                res = self.asr.transcribe(audio, init_prompt=prompt, prefix=non_prompt, **beam_kwargs(self.beam_size))
+                tsw = self.asr.ts_words_after_prefix(res, prefix_end)
+            except Exception as e:
+                logger.warning(f"prefix decoding failed: {repr(e)}")
+                res = None
+            else:
+                if tsw and tsw[0][0] + self.buffer_time_offset < self.transcript_buffer.last_commited_time - 1:
+                    logger.debug(f"prefix decoding rejected, the new words start at {tsw[0][0] + self.buffer_time_offset:2.2f}")
+                    res = None
+            if res is not None:
+                self.prefix_fallbacks_in_row = 0
+                saved = self.asr.count_tokens(non_prompt)
+                self.prefix_steps_saved += saved
+                logger.debug(f"prefix decoding: {saved} decoder steps saved in this iteration, {self.prefix_steps_saved} in total")
+                return res, tsw
+
+            self.prefix_fallbacks += 1
+            self.prefix_fallbacks_in_row += 1
+            if self.prefix_fallbacks_in_row >= self.PREFIX_MAX_FALLBACKS:
+                logger.warning(f"prefix decoding was rejected {self.prefix_fallbacks_in_row} times in a row, switching it off")
+                self.prefix_decoding = False
+        res = self.asr.transcribe(audio, init_prompt=prompt, **beam_kwargs(self.beam_size))
+        return res, self.asr.ts_words(res)
+
     def chunk_completed_sentence(self):
-        if self.commited == []: return
-        logger.debug(self.commited)
-        sents = self.words_to_sentences(self.commited)
-        for s in sents:
-            logger.debug(f"\t\tSENT: {s}")
-        if len(sents) < 2:
+        # we will continue with audio processing at the end of the last complete sentence
+        chunk_at = self.sentences.last_boundary(self.commited, self.buffer_time_offset)
+        if chunk_at is None:
             return
-        while len(sents) > 2:
-            sents.pop(0)
-        # we will continue with audio processing at this timestamp
-        chunk_at = sents[-2][1]
-
         logger.debug(f"--- sentence chunked at {chunk_at:2.2f}")
         self.chunk_at(chunk_at)
 
     def chunk_completed_segment(self, res):
-        if self.commited == []: return
+        if not self.commited: return
 
         ends = self.asr.segments_end_ts(res)
 
-        t = self.commited[-1][1]
+        t = self.commited.last()[1]
 
         if len(ends) > 1:
 
@@ -460,40 +923,33 @@ class OnlineASRProcessor:
 
 
 
+    def hard_trim(self):
+        """Overload protection: the uncommitted hypothesis is commited without the confirmation, and the audio buffer
+        is trimmed after it, to at most half of max_buffer_sec. 
+        Returns: the force-commited words
+        """
+        rest = self.transcript_buffer.complete()
+        self.commited.extend(rest)
+        end = self.buffer_time_offset + len(self.audio_buffer)/self.SAMPLING_RATE
+        t = rest[-1][1] if rest else self.buffer_time_offset
+        t = min(end, max(t, end - self.max_buffer_sec/2))
+        logger.debug(f"--- hard trim at {t:2.2f}, {len(rest)} words force-commited")
+        self.audio_buffer.trim(int((t - self.buffer_time_offset)*self.SAMPLING_RATE))
+        self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
+        self.transcript_buffer.last_commited_time = t
+        self.buffer_time_offset = t
+        self.the_rest = (None, None, "")
+        self.hard_trims += 1
+        return rest
+
     def chunk_at(self, time):
         """trims the hypothesis and audio buffer at "time"
         """
         self.transcript_buffer.pop_commited(time)
         cut_seconds = time - self.buffer_time_offset
-        self.audio_buffer = self.audio_buffer[int(cut_seconds*self.SAMPLING_RATE):]
+        self.audio_buffer.trim(int(cut_seconds*self.SAMPLING_RATE))
         self.buffer_time_offset = time
 
-    def words_to_sentences(self, words):
-        """Uses self.tokenizer for sentence segmentation of words.
-        Returns: [(beg,end,"sentence 1"),...]
-        """
-        
-        cwords = [w for w in words]
-        t = " ".join(o[2] for o in cwords)
-        s = self.tokenizer.split(t)
-        out = []
-        while s:
-            beg = None
-            end = None
-            sent = s.pop(0).strip()
-            fsent = sent
-            while cwords:
-                b,e,w = cwords.pop(0)
-                w = w.strip()
-                if beg is None and sent.startswith(w):
-                    beg = b
-                elif end is None and sent == w:
-                    end = e
-                    out.append((beg,end,fsent))
-                    break
-                sent = sent[len(w):].strip()
-        return out
-
     def finish(self):
         """Flush the incomplete text when the whole processing ends.
         Returns: the same format as self.process_iter()
@@ -501,9 +957,18 @@ class OnlineASRProcessor:
         o = self.transcript_buffer.complete()
         f = self.to_flush(o)
         logger.debug(f"last, noncommited: {f}")
+        self.commited.extend(o)  # they are final now
         self.buffer_time_offset += len(self.audio_buffer)/16000
+        self.the_rest = (None, None, "")  # it's flushed now
         return f
 
+    def close(self):
+        """Closes the journal of the commited words, at the end of the session."""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            self.commited.journal = None
+
 
     def to_flush(self, sents, sep=None, offset=0, ):
         # concatenates the timestamped words or sentences into one sequence that is flushed in one line
@@ -528,26 +993,32 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
     When it detects end of speech (non-voice for 500ms), it makes OnlineASRProcessor to end the utterance immediately.
     '''
 
-    def __init__(self, online_chunk_size, *a, **kw):
+    def __init__(self, online_chunk_size, *a, vad_engine=None, vad_model=None, **kw):
+        """vad_engine: silero_vad.VADEngine shared by the processors, or None to load the torch Silero model for this one,
+        from the file vad_model (silero_vad.jit), or from the VAD cache by default."""
         self.online_chunk_size = online_chunk_size
         self.online = OnlineASRProcessor(*a, **kw)
+        self.memo = self.online.memo
 
         # VAC:
-        import torch
-        model, _ = torch.hub.load(
-            repo_or_dir='snakers4/silero-vad',
-            model='silero_vad'
-        )
-        from silero_vad import FixedVADIterator
-        self.vac = FixedVADIterator(model)
+        if vad_engine is not None:
+            from silero_vad import BatchedVADIterator
+            self.vac = BatchedVADIterator(vad_engine)
+        else:
+            from silero_vad import FixedVADIterator, load_torch_model
+            self.vac = FixedVADIterator(load_torch_model(vad_model))
         self.logfile = self.online.logfile
         
         # Initialize state
         self.status = None  # or "voice" or "nonvoice"
-        self.audio_buffer = np.array([], dtype=np.float32)
+        self.audio_buffer = SampleBuffer(16000)
         self.buffer_offset = 0
         self.current_online_chunk_buffer_size = 0
         self.is_currently_final = False
+        self.last_transcribed_sec = None  # length of audio buffer transcribed in the last process_iter, or None
+        self.last_transcribe_duration = None
+        self.vad_samples = 0  # samples processed by VAD
+        self.voice_samples = 0  # samples passed to online processing as voice
         self.vac.reset_states()
 
     def init(self):
@@ -558,77 +1029,171 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
         self.is_currently_final = False
 
         self.status = None  # or "voice" or "nonvoice"
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio_buffer.clear()
         self.buffer_offset = 0  # in frames
 
     def clear_buffer(self):
         self.buffer_offset += len(self.audio_buffer)
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio_buffer.clear()
 
 
     def insert_audio_chunk(self, audio):
-        # Ensure chunks are exactly 512 samples for VAD
+        # VAD processes exactly 512 samples at once, all the complete windows of the chunk in one call.
+        # The remaining samples wait in self.audio_buffer for the next chunk.
+        # self.buffer_offset is the position of the first sample in self.audio_buffer from the beginning of the stream.
         chunk_size = 512
-        audio_samples = len(audio)
-        
-        # Process complete chunks of 512 samples
-        for i in range(0, audio_samples - chunk_size + 1, chunk_size):
-            chunk = audio[i:i+chunk_size]
-            res = self.vac(chunk)
+        self.audio_buffer.append(audio)
+
+        n = len(self.audio_buffer) // chunk_size
+        if n == 0:
+            return
+        windows = self.audio_buffer.view()[:n*chunk_size].reshape(n, chunk_size)
+        for chunk, res in zip(windows, self.vac.events(windows)):
+            send_audio = None
             
             if res is not None:
                 frame = list(res.values())[0]
                 if 'start' in res and 'end' not in res:
                     self.status = 'voice'
                     send_audio = chunk
-                    self.online.init(offset=(self.buffer_offset + i)/self.SAMPLING_RATE)
-                    self.online.insert_audio_chunk(send_audio)
-                    self.current_online_chunk_buffer_size += len(send_audio)
+                    self.online.init(offset=self.buffer_offset/self.SAMPLING_RATE)
                 elif 'end' in res and 'start' not in res:
                     self.status = 'nonvoice'
-                    send_audio = chunk[:frame]
-                    self.online.insert_audio_chunk(send_audio)
-                    self.current_online_chunk_buffer_size += len(send_audio)
+                    send_audio = chunk[:max(0, frame - self.buffer_offset)]
                     self.is_currently_final = True
             elif self.status == 'voice':
-                self.online.insert_audio_chunk(chunk)
-                self.current_online_chunk_buffer_size += len(chunk)
-        
-        # Store any remaining samples less than 512 for next time
-        remaining = audio_samples % chunk_size
-        if remaining > 0:
-            self.audio_buffer = audio[-remaining:]
-        else:
-            self.audio_buffer = np.array([], dtype=np.float32)
+                send_audio = chunk
+
+            if send_audio is not None:
+                self.online.insert_audio_chunk(send_audio)
+                self.current_online_chunk_buffer_size += len(send_audio)
+                self.voice_samples += len(send_audio)
+            self.vad_samples += chunk_size
+            self.buffer_offset += chunk_size
+        self.audio_buffer.trim(n*chunk_size)
 
 
+    def insert_silence(self, samples):
+        # The silence goes through VAD only until VAD ends the speech (SILENCE_PAD seconds), and to complete the last 
+        # window of 512 samples. For the rest, only the time moves, without running VAD.
+        chunk_size = 512
+        pad = min(samples, int(self.SILENCE_PAD*self.SAMPLING_RATE)) if self.status == 'voice' else 0
+        rest = samples - pad
+        fill = min(rest, -(len(self.audio_buffer) + pad) % chunk_size)
+        rest -= fill
+        if pad + fill:
+            self.insert_audio_chunk(np.zeros(pad + fill, dtype=np.float32))
+        if rest:
+            if self.status == 'voice':  # VAD didn't end the speech in the padding
+                self.status = 'nonvoice'
+                self.is_currently_final = True
+                self.vac.triggered = False
+                self.vac.temp_end = 0
+            self.vac.skip(rest)
+            self.buffer_offset += rest
+            self.vad_samples += rest
+        return self.is_currently_final
+
     def process_iter(self):
+        self.last_transcribed_sec = None
         if self.is_currently_final:
             return self.finish()
         elif self.current_online_chunk_buffer_size > self.SAMPLING_RATE*self.online_chunk_size:
             self.current_online_chunk_buffer_size = 0
             ret = self.online.process_iter()
+            self.last_transcribed_sec = self.online.last_transcribed_sec
+            self.last_transcribe_duration = self.online.last_transcribe_duration
             return ret
         else:
             print("no online update, only VAD", self.status, file=self.logfile)
             return (None, None, "")
 
+    def interim(self):
+        return self.online.interim()
+
     def finish(self):
         ret = self.online.finish()
         self.current_online_chunk_buffer_size = 0
         self.is_currently_final = False
         return ret
 
+    def close(self):
+        self.online.close()
+
+
+
+class ChunkSizeController:
+    '''Adapts the chunk size -- the amount of new audio processed by one process_iter -- to the measured processing speed.
+
+    A confirmed word is emitted appx. "chunk size + processing time" after it was spoken. The processing time grows with 
+    the audio buffer length, so the controller keeps an average of process_iter duration per second of transcribed buffer, 
+    predicts the duration of the next iteration, and chooses the chunk size that holds target_latency. The chunk must 
+    stay longer than the processing time (times headroom), otherwise the unprocessed audio would grow without bound. 
+    The chunk size is kept within [min_size, max_size].
+    '''
+
+    def __init__(self, chunk_size, min_size=0.1, max_size=5.0, target_latency=2.0, headroom=1.2, smoothing=0.3):
+        self.chunk_size = chunk_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.cost = None  # seconds of processing per second of transcribed audio buffer
+
+    def update(self, duration, chunk_sec, buffer_sec):
+        """duration: seconds that the last process_iter took
+        chunk_sec: seconds of new audio that it processed
+        buffer_sec: seconds of audio buffer that it transcribed
+        Returns: the new chunk size in seconds
+        """
+        if buffer_sec <= 0:
+            return self.chunk_size
+        cost = duration/buffer_sec
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost = self.smoothing*cost + (1-self.smoothing)*self.cost
+
+        predicted = self.cost*buffer_sec
+        size = max(self.target_latency - predicted, predicted*self.headroom)
+        self.chunk_size = min(max(size, self.min_size), self.max_size)
+
+        rtf = duration/chunk_sec if chunk_sec > 0 else float("inf")
+        logger.info(f"chunk size {self.chunk_size:.2f} s, real-time factor {rtf:.2f} (process_iter {duration:.2f} s for {chunk_sec:.2f} s of new audio, buffer {buffer_sec:.2f} s)")
+        return self.chunk_size
 
 
 WHISPER_LANG_CODES = "af,am,ar,as,az,ba,be,bg,bn,bo,br,bs,ca,cs,cy,da,de,el,en,es,et,eu,fa,fi,fo,fr,gl,gu,ha,haw,he,hi,hr,ht,hu,hy,id,is,it,ja,jw,ka,kk,km,kn,ko,la,lb,ln,lo,lt,lv,mg,mi,mk,ml,mn,mr,ms,mt,my,ne,nl,nn,no,oc,pa,pl,ps,pt,ro,ru,sa,sd,si,sk,sl,sn,so,sq,sr,su,sv,sw,ta,te,tg,th,tk,tl,tr,tt,uk,ur,uz,vi,yi,yo,zh".split(",")
 
-def create_tokenizer(lan):
-    """returns an object that has split function that works like the one of MosesTokenizer"""
+MOSES_LANGUAGES = "as bn ca cs de el en es et fi fr ga gu hi hu is it kn lt lv ml mni mr nl or pa pl pt ro ru sk sl sv ta te yue zh".split()
+
+WTP_MODEL = "wtp-canine-s-12l-no-adapters"
+
+def create_tokenizer(lan, kind="auto", wtp_model=WTP_MODEL):
+    """returns an object that has split function that works like the one of MosesTokenizer
+
+    kind: "rules" is the RuleSplitter of sentence_split.py, "moses", "tokenize_uk" or "wtp". "auto" is rules for the 
+    languages of RULE_LANGUAGES (and for the language detection), otherwise tokenize_uk for Ukrainian, Moses for its 
+    languages and WtP for the rest.
+    wtp_model: name of the WtP model on the huggingface hub, or its local directory
+    """
+    if kind == "auto":
+        if lan == "auto" or lan in RULE_LANGUAGES:
+            kind = "rules"
+        elif lan == "uk":
+            kind = "tokenize_uk"
+        elif lan in MOSES_LANGUAGES:
+            kind = "moses"
+        else:
+            kind = "wtp"
+
+    if kind == "rules":
+        return RuleSplitter(lan)
 
     assert lan in WHISPER_LANG_CODES, "language must be Whisper's supported lang code: " + " ".join(WHISPER_LANG_CODES)
 
-    if lan == "uk":
+    if kind == "tokenize_uk":
         import tokenize_uk
         class UkrainianTokenizer:
             def split(self, text):
@@ -636,39 +1201,97 @@ def create_tokenizer(lan):
         return UkrainianTokenizer()
 
     # supported by fast-mosestokenizer
-    if lan in "as bn ca cs de el en es et fi fr ga gu hi hu is it kn lt lv ml mni mr nl or pa pl pt ro ru sk sl sv ta te yue zh".split():
+    if kind == "moses":
         from mosestokenizer import MosesTokenizer
         return MosesTokenizer(lan)
 
     # the following languages are in Whisper, but not in wtpsplit:
+    wtp_lan = lan
     if lan in "as ba bo br bs fo haw hr ht jw lb ln lo mi nn oc sa sd sn so su sw tk tl tt".split():
         logger.debug(f"{lan} code is not supported by wtpsplit. Going to use None lang_code option.")
-        lan = None
-
-    from wtpsplit import WtP
-    # downloads the model from huggingface on the first use
-    wtp = WtP("wtp-canine-s-12l-no-adapters")
+        wtp_lan = None
+
+    try:
+        from wtpsplit import WtP
+        # a model name is downloaded from huggingface on the first use, a directory is loaded from the disk
+        wtp = WtP(wtp_model)
+    except (ImportError, OSError) as e:
+        logger.warning(f"The WtP model {wtp_model} can't be loaded ({e}), using the rule-based sentence splitter.")
+        return RuleSplitter(lan)
     class WtPtok:
         def split(self, sent):
-            return wtp.split(sent, lang_code=lan)
+            return wtp.split(sent, lang_code=wtp_lan)
     return WtPtok()
 
+class SerializedTokenizer:
+    """a shared tokenizer that isn't thread-safe, called by one session at a time (MosesTokenizer talks to one Perl 
+    subprocess through a pipe)"""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.lock = threading.Lock()
+
+    def split(self, text):
+        with self.lock:
+            return self.tokenizer.split(text)
+
+# (process id, kind, language, WtP model) -> tokenizer. A forked process doesn't use the tokenizers of its parent.
+tokenizers = {}
+tokenizers_lock = threading.Lock()
+
+def shared_tokenizer(lan, kind="auto", wtp_model=WTP_MODEL):
+    """the tokenizer of create_tokenizer, loaded once per process and shared by all the sessions"""
+    key = (os.getpid(), kind, lan, wtp_model)
+    with tokenizers_lock:
+        if key not in tokenizers:
+            t = time.time()
+            tokenizer = create_tokenizer(lan, kind, wtp_model)
+            logger.info(f"Loaded the {type(tokenizer).__name__} sentence tokenizer for {lan} in {time.time()-t:.2f} seconds.")
+            if not getattr(tokenizer, "thread_safe", False):
+                tokenizer = SerializedTokenizer(tokenizer)
+            tokenizers[key] = tokenizer
+        return tokenizers[key]
+
+def sentence_tokenizer_language(args):
+    """the language of the text for the sentence tokenizer"""
+    if args.task == "translate":
+        return "en"  # Whisper translates into English
+    return args.lan  # Whisper transcribes in this language
+
 
 def add_shared_args(parser):
     """shared args for simulation (this entry point) and server
     parser: argparse.ArgumentParser object
     """
     parser.add_argument('--min-chunk-size', type=float, default=1.0, help='Minimum audio chunk size in seconds. It waits up to this time to do processing. If the processing takes shorter time, it waits, otherwise it processes the whole segment that was received by this time.')
+    parser.add_argument('--adaptive-chunk', action="store_true", default=False, dest="adaptive_chunk", help='Adapt the chunk size to the measured processing time, to hold --target-latency. --min-chunk-size is the initial size.')
+    parser.add_argument('--adaptive-chunk-bounds', type=float, nargs=2, default=[0.1, 5.0], dest="adaptive_chunk_bounds", metavar=("MIN", "MAX"), help='Lower and upper bound of the adaptive chunk size in seconds.')
+    parser.add_argument('--target-latency', type=float, default=2.0, dest="target_latency", help='Target latency in seconds for the adaptive chunk size: chunk size + processing time.')
     parser.add_argument('--model', type=str, default='large-v2', choices="tiny.en,tiny,base.en,base,small.en,small,medium.en,medium,large-v1,large-v2,large-v3,large".split(","),help="Name size of the Whisper model to use (default: large-v2). The model is automatically downloaded from the model hub if not present in model cache dir.")
     parser.add_argument('--model_cache_dir', type=str, default=None, help="Overriding the default model cache dir where models downloaded from the hub are saved")
     parser.add_argument('--model_dir', type=str, default=None, help="Dir where Whisper model.bin and other files are saved. This option overrides --model and --model_cache_dir parameter.")
     parser.add_argument('--lan', '--language', type=str, default='auto', help="Source language code, e.g. en,de,cs, or 'auto' for language detection.")
     parser.add_argument('--task', type=str, default='transcribe', choices=["transcribe","translate"],help="Transcribe or translate.")
     parser.add_argument('--backend', type=str, default="faster-whisper", choices=["faster-whisper", "whisper_timestamped", "openai-api"],help='Load only this backend for Whisper processing.')
-    parser.add_argument('--vac', action="store_true", default=False, help='Use VAC = voice activity controller. Recommended. Requires torch.')
+    parser.add_argument('--device', type=str, default="auto", choices=["auto", "cuda", "cpu"], help='Device to run the Whisper model on. "auto" uses CUDA if a GPU is available, otherwise CPU.')
+    parser.add_argument('--compute-type', type=str, default="auto", dest="compute_type", help='faster-whisper compute type, e.g. float16, float32, int8, int8_float16. "auto" is float16 (or float32) on GPU and int8 on CPU.')
+    parser.add_argument('--cpu-threads', type=int, default=0, dest="cpu_threads", help='faster-whisper: number of threads used on CPU. 0 means the default of CTranslate2.')
+    parser.add_argument('--num-workers', type=int, default=None, dest="num_workers", help='faster-whisper: number of model workers. CTranslate2 runs concurrent transcribe calls in parallel only in more workers, at the cost of more memory. The default is --batch-size of the server and of whisper_bulk.py, otherwise 1.')
+    parser.add_argument('--vac', action="store_true", default=False, help='Use VAC = voice activity controller. Recommended. Requires onnxruntime, or torch.')
+    parser.add_argument('--vad-engine', type=str, default="auto", choices=["auto", "onnx", "torch"], dest="vad_engine", help='How VAC runs the Silero VAD model. "onnx" is ONNX Runtime without torch, batched across the server sessions. "auto" uses onnx if it\'s available, otherwise torch.')
+    parser.add_argument('--vad-model', type=str, default=None, dest="vad_model", help='Path of the VAD model file, silero_vad.onnx for the onnx engine or silero_vad.jit for torch. By default, it\'s taken from --vad-cache-dir, or the silero-vad package, or the torch.hub cache. It\'s never downloaded.')
+    parser.add_argument('--vad-cache-dir', type=str, default=None, dest="vad_cache_dir", help='Versioned cache directory of the VAD models, filled by "python3 silero_vad.py --install". Default ~/.cache/whisper_streaming/silero-vad.')
+    parser.add_argument('--vad-version', type=str, default=None, dest="vad_version", help='silero-vad version of the VAD model in the cache. Default is the newest one.')
     parser.add_argument('--vac-chunk-size', type=float, default=0.04, help='VAC sample size in seconds.')
     parser.add_argument('--vad', action="store_true", default=False, help='Use VAD = voice activity detection, with the default parameters.')
+    parser.add_argument('--experimental-prefix-decoding', action="store_true", default=False, dest="prefix_decoding", help='EXPERIMENTAL, not measured with a real model yet (benchmarks/prefix_decoding.py). Incremental decoding: the commited text inside of the audio buffer is the forced decoding prefix, so that only the new tail is decoded. It falls back to the full decoding if the backend rejects the prefix. Only faster-whisper supports it.')
+    parser.add_argument('--transcribe-memo', action="store_true", default=False, dest="transcribe_memo", help='Reuse the last transcription instead of transcribing the audio buffer again, when it grew only by a short or silent audio since then.')
+    parser.add_argument('--memo-min-new-sec', type=float, default=0.1, dest="memo_min_new_sec", help='With --transcribe-memo, the buffer is transcribed again when at least this much new audio arrived.')
+    parser.add_argument('--memo-silence-level', type=float, default=0.015, dest="memo_silence_level", help='With --transcribe-memo, the new audio is silent if no sample is above this level (1.0 is the full scale), then the buffer isn\'t transcribed again, up to 5 seconds of it.')
+    parser.add_argument('--commit-journal', type=str, default=None, dest="commit_journal", help='Directory where every session appends its commited words to its own file, as lines "beg end word" (in ms). Only the recent commited words are kept in memory, the journal has all of them.')
     parser.add_argument('--buffer_trimming', type=str, default="segment", choices=["sentence", "segment"],help='Buffer trimming strategy -- trim completed sentences marked with punctuation mark and detected by sentence segmenter, or the completed segments returned by Whisper. Sentence segmenter must be installed for "sentence" option.')
+    parser.add_argument('--sentence-tokenizer', type=str, default="auto", choices=["auto", "rules", "moses", "tokenize_uk", "wtp"], dest="sentence_tokenizer", help='Sentence tokenizer of the "sentence" buffer trimming. "rules" is the built-in rule-based splitter, without any dependency. "auto" uses it for the common languages, otherwise tokenize_uk, Moses or WtP, as the language needs. The tokenizer is loaded once and shared by all the sessions.')
+    parser.add_argument('--wtp-model', type=str, default=WTP_MODEL, dest="wtp_model", help='WtP model for the "wtp" sentence tokenizer: its name on the huggingface hub, which is downloaded on the first use, or its local directory for the hosts without internet access. If it can\'t be loaded, the rule-based splitter is used.')
     parser.add_argument('--buffer_trimming_sec', type=float, default=15, help='Buffer trimming length threshold in seconds. If buffer length is longer, trimming sentence/segment is triggered.')
     parser.add_argument("-l", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Set the log level", default='DEBUG')
 
@@ -676,6 +1299,14 @@ def asr_factory(args, logfile=sys.stderr):
     """
     Creates and configures an ASR and ASR Online instance based on the specified backend and arguments.
     """
+    asr = backend_factory(args)
+    online = online_factory(args, asr, logfile=logfile, vad_engine=vad_engine_factory(args))
+    return asr, online
+
+def backend_factory(args):
+    """
+    Loads and configures the ASR backend only. The backend libraries are imported here, not at the module import.
+    """
     backend = args.backend
     if backend == "openai-api":
         logger.debug("Using OpenAI API.")
@@ -683,14 +1314,21 @@ def asr_factory(args, logfile=sys.stderr):
     else:
         if backend == "faster-whisper":
             asr_cls = FasterWhisperASR
+            batch_size = getattr(args, "batch_size", 1)
+            num_workers = args.num_workers or batch_size
+            if num_workers < batch_size:
+                logger.warning(f"--num-workers {num_workers} is lower than --batch-size {batch_size}, the batched transcribe calls "
+                               "with different prompts run one after another")
+            model_kwargs = dict(device=args.device, compute_type=args.compute_type, cpu_threads=args.cpu_threads, num_workers=num_workers)
         else:
             asr_cls = WhisperTimestampedASR
+            model_kwargs = dict(device=args.device)
 
         # Only for FasterWhisperASR and WhisperTimestampedASR
         size = args.model
         t = time.time()
         logger.info(f"Loading Whisper {size} model for {args.lan}...")
-        asr = asr_cls(modelsize=size, lan=args.lan, cache_dir=args.model_cache_dir, model_dir=args.model_dir)
+        asr = asr_cls(modelsize=size, lan=args.lan, cache_dir=args.model_cache_dir, model_dir=args.model_dir, **model_kwargs)
         e = time.time()
         logger.info(f"done. It took {round(e-t,2)} seconds.")
 
@@ -699,27 +1337,82 @@ def asr_factory(args, logfile=sys.stderr):
         logger.info("Setting VAD filter")
         asr.use_vad()
 
-    language = args.lan
     if args.task == "translate":
         asr.set_translate_task()
-        tgt_language = "en"  # Whisper translates into English
-    else:
-        tgt_language = language  # Whisper transcribes in this language
 
-    # Create the tokenizer
+    return asr
+
+def chunk_controller_factory(args):
+    """ChunkSizeController for --adaptive-chunk, or None"""
+    if not args.adaptive_chunk:
+        return None
+    return ChunkSizeController(args.min_chunk_size, *args.adaptive_chunk_bounds, target_latency=args.target_latency)
+
+def vad_engine_factory(args):
+    """
+    Loads the torch-free Silero VAD engine for --vac, which is shared by all the VACOnlineASRProcessors. 
+    Returns None for --vad-engine torch, or with auto when onnxruntime or the ONNX model is missing. Then every
+    VACOnlineASRProcessor loads its own torch model. It's loaded here once too, so that torch is imported 
+    and a missing model is reported at startup, not at the first session.
+    """
+    if not args.vac:
+        return None
+    from silero_vad import OnnxSileroVAD, VADEngine, find_model, load_torch_model
+    if args.vad_engine != "torch":
+        try:
+            model = OnnxSileroVAD(find_model("silero_vad.onnx", args.vad_model, args.vad_cache_dir, args.vad_version))
+        except (ImportError, FileNotFoundError) as e:
+            if args.vad_engine == "onnx":
+                raise
+            logger.warning(f"The ONNX VAD engine is not available ({e}), using torch.")
+        else:
+            logger.info(f"Using the ONNX VAD engine with {model.path}")
+            return VADEngine(model)
+    load_torch_model(torch_vad_model(args))
+    return None
+
+def torch_vad_model(args):
+    """path of silero_vad.jit for the torch VAD"""
+    from silero_vad import find_model
+    return find_model("silero_vad.jit", args.vad_model if args.vad_engine == "torch" else None, args.vad_cache_dir, args.vad_version)
+
+def online_factory(args, asr, logfile=sys.stderr, vad_engine=None):
+    """
+    Creates a new OnlineASRProcessor (or VACOnlineASRProcessor with --vac) around an already loaded ASR object.
+    The server calls it for every client connection, so that all the sessions share one model but not the processing state.
+    With --vac, they share vad_engine too, from vad_engine_factory. If it's None, every processor loads its own torch VAD model.
+    """
+    # the tokenizer is shared by all the sessions of the process
     if args.buffer_trimming == "sentence":
-        tokenizer = create_tokenizer(tgt_language)
+        tokenizer = shared_tokenizer(sentence_tokenizer_language(args), args.sentence_tokenizer, args.wtp_model)
     else:
         tokenizer = None
 
+    memo = TranscribeMemo(args.memo_min_new_sec, args.memo_silence_level) if args.transcribe_memo else None
+    journal = open_commit_journal(args.commit_journal) if args.commit_journal else None
+
     # Create the OnlineASRProcessor
     if args.vac:
-        
-        online = VACOnlineASRProcessor(args.min_chunk_size, asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
+        vad_model = torch_vad_model(args) if vad_engine is None else None
+        online = VACOnlineASRProcessor(args.min_chunk_size, asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),prefix_decoding=args.prefix_decoding,memo=memo,journal=journal,vad_engine=vad_engine,vad_model=vad_model)
     else:
-        online = OnlineASRProcessor(asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec))
-
-    return asr, online
+        online = OnlineASRProcessor(asr,tokenizer,logfile=logfile,buffer_trimming=(args.buffer_trimming, args.buffer_trimming_sec),prefix_decoding=args.prefix_decoding,memo=memo,journal=journal)
+
+    return online
+
+def comp_unaware_chunks(duration, min_chunk, beg=0.0):
+    """Yields (beg, end) timestamps of the consecutive audio chunks of computationally unaware simulation: 
+    every chunk is min_chunk seconds long, except of the last one, until the audio duration."""
+    end = beg + min_chunk
+    while True:
+        yield beg, end
+        if end >= duration:
+            break
+        beg = end
+        if end + min_chunk > duration:
+            end = duration
+        else:
+            end += min_chunk
 
 def set_logging(args,logger,other="_server"):
     logging.basicConfig(#format='%(name)s 
@@ -737,7 +1430,7 @@ if __name__ == "__main__":
     parser.add_argument('audio_path', type=str, help="Filename of 16kHz mono channel wav, on which live streaming is simulated.")
     add_shared_args(parser)
     parser.add_argument('--start_at', type=float, default=0.0, help='Start processing audio at this time.')
-    parser.add_argument('--offline', action="store_true", default=False, help='Offline mode.')
+    parser.add_argument('--offline', action="store_true", default=False, help='Offline mode. It transcribes the whole audio in one call, so only up to 30 seconds. For longer recordings, or many of them, use whisper_bulk.py.')
     parser.add_argument('--comp_unaware', action="store_true", default=False, help='Computationally unaware simulation.')
     
     args = parser.parse_args()
@@ -758,7 +1451,7 @@ if __name__ == "__main__":
     audio_path = args.audio_path
 
     SAMPLING_RATE = 16000
-    duration = len(load_audio(audio_path))/SAMPLING_RATE
+    duration = audio_source(audio_path).duration
     logger.info("Audio duration is: %2.2f seconds" % duration)
 
     asr, online = asr_factory(args, logfile=logfile)
@@ -767,7 +1460,7 @@ if __name__ == "__main__":
     else:
         min_chunk = args.min_chunk_size
 
-    # load the audio into the LRU cache before we start the timer
+    # open the audio file before we start the timer
     a = load_audio_chunk(audio_path,0,1)
 
     # warm up the ASR because the very first transcribe takes much more time than the other
@@ -803,8 +1496,7 @@ if __name__ == "__main__":
             output_transcript(o)
         now = None
     elif args.comp_unaware:  # computational unaware mode 
-        end = beg + min_chunk
-        while True:
+        for beg, end in comp_unaware_chunks(duration, min_chunk, beg):
             a = load_audio_chunk(audio_path,beg,end)
             online.insert_audio_chunk(a)
             try:
@@ -816,19 +1508,10 @@ if __name__ == "__main__":
                 output_transcript(o, now=end)
 
             logger.debug(f"## last processed {end:.2f}s")
-
-            if end >= duration:
-                break
-            
-            beg = end
-            
-            if end + min_chunk > duration:
-                end = duration
-            else:
-                end += min_chunk
         now = duration
 
     else: # online = simultaneous mode
+        chunk_controller = chunk_controller_factory(args)
         end = 0
         while True:
             now = time.time() - start
@@ -839,6 +1522,7 @@ if __name__ == "__main__":
             beg = end
             online.insert_audio_chunk(a)
 
+            t = time.time()
             try:
                 o = online.process_iter()
             except AssertionError as e:
@@ -847,6 +1531,12 @@ if __name__ == "__main__":
             else:
                 output_transcript(o)
             now = time.time() - start
+            if chunk_controller is not None and online.last_transcribed_sec is not None:
+                size = chunk_controller.update(time.time()-t, len(a)/SAMPLING_RATE, online.last_transcribed_sec)
+                if args.vac:
+                    online.online_chunk_size = size
+                else:
+                    min_chunk = size
             logger.debug(f"## last processed {end:.2f} s, now is {now:.2f}, the latency is {now-end:.2f}")
 
             if end >= duration:
@@ -855,3 +1545,6 @@ if __name__ == "__main__":
 
     o = online.finish()
     output_transcript(o, now=now)
+    online.close()
+    if online.memo is not None:
+        logger.info(online.memo.report())
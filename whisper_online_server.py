@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+import time
+STARTUP_TIME = time.time()  # before the imports, for the startup report
+
 from whisper_online import *
 
 import sys
@@ -6,11 +9,16 @@ import argparse
 import os
 import logging
 import numpy as np
-import time
 import socket
+import selectors
+import threading
+import queue
+import bisect
+from collections import deque
 import line_packet
-import io
-import soundfile
+import framing
+import audio_codecs
+from server_metrics import ServerMetrics
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +30,7 @@ def get_user_preferences():
     defaults = {
         "model": "medium",
         "backend": "faster-whisper",
+        "device": "auto",
         "host": "0.0.0.0",
         "port": 43007,
         "warmup_file": "./jfk.wav",
@@ -75,6 +84,16 @@ def get_user_preferences():
         except ValueError:
             print("Please enter a valid number.")
 
+    # Device
+    devices = ["auto", "cuda", "cpu"]
+    while True:
+        device = input(f"\nSelect a device ({'/'.join(devices)}) [default: {defaults['device']}]: ").strip().lower()
+        if not device:
+            device = defaults["device"]
+        if device in devices:
+            break
+        print(f"Invalid choice. Please enter one of: {', '.join(devices)}.")
+
     # Host
     host = input(f"\nEnter host address [default: {defaults['host']}]: ").strip()
     host = host if host else defaults["host"]
@@ -136,6 +155,7 @@ def get_user_preferences():
     sys.argv = [sys.argv[0]]
     sys.argv.extend(["--model", selected_model])
     sys.argv.extend(["--backend", selected_backend])
+    sys.argv.extend(["--device", device])
     sys.argv.extend(["--host", host])
     sys.argv.extend(["--port", str(port)])
     sys.argv.extend(["--warmup-file", warmup_file])
@@ -153,6 +173,7 @@ def get_user_preferences():
 Server IP: {local_ip}
 Model: {selected_model}
 Backend: {selected_backend}
+Device: {device}
 Host: {host}
 Port: {port}
 Warmup File: {warmup_file}
@@ -166,42 +187,228 @@ Log Level: {selected_log_level}
 
     return summary
 
+def pcm16_to_float32(data):
+    """Converts signed 16-bit little-endian PCM (bytes, bytearray or memoryview of even length) 
+    to float32 samples, scaled the same way as soundfile/librosa do it."""
+    audio = np.frombuffer(data, dtype="<i2").astype(np.float32)
+    audio *= 1/32768
+    return audio
+
+def format_line(beg, end, text):
+    """the text line of a commited segment, for the clients without framing"""
+    return "%1.0f %1.0f %s" % (beg, end, text)
+
+_server_codecs = None
+
+def server_codecs():
+    """the codecs of the audio uplink that the server offers to the clients, they are detected at the first use"""
+    global _server_codecs
+    if _server_codecs is None:
+        _server_codecs = audio_codecs.available_codecs()
+    return _server_codecs
+
 class Connection:
-    '''it wraps conn object'''
+    '''it wraps conn object
+
+    The protocol is detected from the first bytes: a client that starts with framing.HELLO sends and receives frames 
+    (framing.py). Otherwise, it's the protocol without framing: raw PCM audio from the client, and text lines to it.'''
     PACKET_SIZE = 32000*5*60 # 5 minutes # was: 65536
+    RECV_BUFFER_SIZE = 65536  # bytes of one receive, 2 s of audio; the receive loop collects the chunk of many
 
-    def __init__(self, conn):
+    def __init__(self, conn, metrics=None):
         self.conn = conn
-        self.last_line = ""
+        self.last_sent = None
+        self.metrics = metrics
+
+        # audio is received into this preallocated buffer
+        self.recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.odd_byte = None  # if the audio ends in the middle of a sample, its first byte waits for the next receive
+
+        self.last_interim = (0, 0, "")  # nothing is displayed
+        self.framed = None  # not detected yet
+        self.pending = None  # bytes received during the detection, that are audio without framing
+        self.decoder = None
+        self.frames = deque()  # decoded frames that wait for the next receive, after a silence
+        self.audio_decoder = audio_codecs.PCMDecoder()  # the client can choose a compressed codec, see audio_codecs.py
+        self.ended = False
 
         self.conn.setblocking(True)
 
+    def detect_protocol(self):
+        received = bytearray()
+        while len(received) < len(framing.HELLO) and framing.HELLO.startswith(received[:len(framing.MAGIC)]):
+            packet = self.conn.recv(len(framing.HELLO) - len(received))
+            if not packet:
+                break
+            self.count_received(len(packet))
+            received += packet
+        if received[:len(framing.MAGIC)] != framing.MAGIC:
+            self.framed = False
+            self.pending = bytes(received)
+            return
+        self.framed = True
+        self.decoder = framing.FrameDecoder()
+        version = received[len(framing.MAGIC)] if len(received) > len(framing.MAGIC) else None
+        if version != framing.VERSION:
+            self.conn.sendall(framing.encode_control("error", message=f"unsupported protocol version {version}, the server supports {framing.VERSION}"))
+            self.ended = True
+            return
+        self.conn.sendall(framing.encode_control("hello", version=framing.VERSION, codecs=server_codecs()))
+        logger.debug("the client uses framing version %d" % version)
+
+    def count_received(self, n):
+        if self.metrics is not None:
+            self.metrics.inc("received_bytes", n)
+
+    def send_once(self, key, data):
+        '''it doesn't send the same message twice, because it was problematic in online-text-flow-events'''
+        if key == self.last_sent:
+            if self.metrics is not None:
+                self.metrics.inc("duplicate_lines")
+            return
+        self.sendall(data)
+        self.last_sent = key
+        if self.metrics is not None:
+            self.metrics.inc("sent_lines")
+
+    def sendall(self, data):
+        '''sends the encoded line or frame, it counts it as dropped if the connection is closed'''
+        try:
+            self.conn.sendall(data)
+        except OSError:
+            if self.metrics is not None:
+                self.metrics.inc("dropped_lines")
+            raise
+
     def send(self, line):
-        '''it doesn't send the same line twice, because it was problematic in online-text-flow-events'''
-        if line == self.last_line:
+        '''sends a text line, without framing'''
+        self.send_once(line, line_packet.encode_line(line))
+
+    def send_text(self, beg, end, text):
+        '''sends the commited text from beg to end ms, as a TEXT frame or a text line'''
+        if self.framed:
+            self.send_once((beg, end, text), framing.encode_text(beg, end, text))
+        else:
+            self.send(format_line(beg, end, text))
+
+    def send_interim(self, beg, end, text):
+        '''sends the uncommitted tail of the hypothesis, only to the clients with framing, 
+        because the text lines are all commited text'''
+        if not self.framed or (beg, end, text) == self.last_interim:
             return
-        line_packet.send_one_line(self.conn, line)
-        self.last_line = line
+        self.sendall(framing.encode_text(beg, end, text, kind=framing.INTERIM))
+        self.last_interim = (beg, end, text)
+        if self.metrics is not None:
+            self.metrics.inc("sent_interims")
 
     def receive_lines(self):
         in_line = line_packet.receive_lines(self.conn)
         return in_line
 
-    def non_blocking_receive_audio(self):
+    def receive_pcm(self):
+        '''returns the PCM bytes that are available now (it can be empty), or None if the connection is closed
+        or the client ended the audio. Without framing, it's a memoryview valid until the next receive.
+        With framing, it can return an int instead: the number of samples of silence that the client didn't send. 
+        The audio before the silence is returned first, and the audio after it in the next calls.'''
+        if self.framed is None:
+            self.detect_protocol()
+            if self.pending:
+                pending, self.pending = self.pending, None
+                return pending
+        if self.framed and self.frames:
+            return self.next_audio()
+        if self.ended:
+            return None
         try:
-            r = self.conn.recv(self.PACKET_SIZE)
-            return r
+            n = self.conn.recv_into(self.recv_view)
         except ConnectionResetError:
             return None
+        if not n:
+            return None
+        self.count_received(n)
+        if not self.framed:
+            return self.recv_view[:n]
+        self.frames.extend(self.decoder.feed(self.recv_view[:n]))
+        return self.next_audio()
+
+    def next_audio(self):
+        # the audio of the received frames until the first silence
+        audio = bytearray()
+        while self.frames and not self.ended:
+            kind, payload = self.frames[0]
+            if kind == framing.SILENCE:
+                if audio:
+                    break
+                self.frames.popleft()
+                return framing.decode_silence(payload)
+            self.frames.popleft()
+            if kind == framing.AUDIO:
+                try:
+                    audio += self.audio_decoder.decode(payload)
+                except (ValueError, RuntimeError, OSError) as e:
+                    self.send_error(f"can't decode the audio: {e}")
+            elif kind == framing.CONTROL:
+                self.handle_control(framing.decode_control(payload))
+        if self.ended:
+            self.frames.clear()
+        return audio
+
+    def handle_control(self, msg):
+        if msg["type"] == "end":
+            self.ended = True
+        elif msg["type"] == "codec":
+            name = msg.get("codec")
+            if name not in server_codecs():
+                self.send_error(f"unsupported codec {name}, the server supports {', '.join(server_codecs())}")
+                return
+            params = {k: v for k, v in msg.items() if k not in ("type", "codec")}
+            self.audio_decoder = audio_codecs.decoder(name, **params)
+            self.conn.sendall(framing.encode_control("codec", codec=name))
+            logger.debug(f"the client sends {name} audio")
+        else:
+            logger.debug(f"ignoring control message {msg}")
+
+    def send_error(self, message):
+        # the client gets the error, and the connection ends
+        logger.error(f"client error: {message}")
+        self.conn.sendall(framing.encode_control("error", message=message))
+        self.ended = True
+
+    def non_blocking_receive_audio(self):
+        '''returns float32 audio samples that are available now (it can be empty), or None if the connection is closed,
+        or the number of samples of silence, as receive_pcm'''
+        data = self.receive_pcm()
+        if data is None or isinstance(data, int):
+            return data
+        if self.odd_byte is not None:
+            data = self.odd_byte + bytes(data)
+            self.odd_byte = None
+        if len(data) % 2:
+            self.odd_byte = bytes(data[-1:])
+            data = data[:-1]
+        return pcm16_to_float32(data)
 
 # wraps socket and ASR object, and serves one client connection. 
 # next client should be served by a new instance of this object
 class ServerProcessor:
 
-    def __init__(self, c, online_asr_proc, min_chunk):
+    def __init__(self, c, online_asr_proc, min_chunk, chunk_controller=None, metrics=None, overload=None):
         self.connection = c
         self.online_asr_proc = online_asr_proc
         self.min_chunk = min_chunk
+        self.chunk_controller = chunk_controller
+        self.metrics = metrics
+        self.overload = overload  # OverloadManager of overload.py, or None
+
+        # for commit latency: (number of samples received in total, wall time when they were received)
+        self.received_samples = 0
+        self.receive_times = deque()
+        self.silence = 0  # samples of silence that ended the last received chunk
+        self.unprocessed = 0  # samples inserted since the last process_iter
+        self.backlog = 0  # samples of audio (not silence) received since the last process_iter
+        self.vad_counts = (0, 0)
+        self.memo_counts = (0, 0, 0, 0.0)
 
         self.last_end = None
 
@@ -211,30 +418,42 @@ class ServerProcessor:
         # receive all audio that is available by this time
         # blocks operation if less than self.min_chunk seconds is available
         # unblocks if connection is closed or a chunk is available
+        # a silence that the client didn't send ends the chunk, it's in self.silence
         out = []
+        self.silence = 0
         minlimit = self.min_chunk*SAMPLING_RATE
         while sum(len(x) for x in out) < minlimit:
-            raw_bytes = self.connection.non_blocking_receive_audio()
-            if not raw_bytes:
+            audio = self.connection.non_blocking_receive_audio()
+            if audio is None:
+                break
+            if isinstance(audio, int):
+                self.silence = audio
+                self.count_samples(audio)
+                if self.metrics is not None:
+                    self.metrics.inc("silence_samples", audio)
                 break
-#            print("received audio:",len(raw_bytes), "bytes", raw_bytes[:10])
-            sf = soundfile.SoundFile(io.BytesIO(raw_bytes), channels=1,endian="LITTLE",samplerate=SAMPLING_RATE, subtype="PCM_16",format="RAW")
-            audio, _ = librosa.load(sf,sr=SAMPLING_RATE,dtype=np.float32)
             out.append(audio)
-        if not out:
+            self.count_samples(len(audio))
+        if not out and not self.silence:
             return None
-        conc = np.concatenate(out)
-        if self.is_first and len(conc) < minlimit:
+        conc = np.concatenate(out) if out else np.zeros(0, dtype=np.float32)
+        if self.is_first and len(conc) < minlimit and not self.silence:
             return None
         self.is_first = False
-        return np.concatenate(out)
+        return conc
+
+    def count_samples(self, n):
+        if self.metrics is not None and n:
+            self.received_samples += n
+            self.receive_times.append((self.received_samples, time.time()))
 
-    def format_output_transcript(self,o):
+    def output_segment(self,o):
         # output format in stdout is like:
         # 0 1720 Takhle to je
         # - the first two words are:
         #    - beg and end timestamp of the text segment, as estimated by Whisper model. The timestamps are not accurate, but they're useful anyway
         # - the next words: segment transcript
+        # It returns (beg, end, text), with beg and end in ms, and the connection sends it as a text line or a TEXT frame.
 
         # This function differs from whisper_online.output_transcript in the following:
         # succeeding [beg,end] intervals are not overlapping because ELITR protocol (implemented in online-text-flow events) requires it.
@@ -247,16 +466,67 @@ class ServerProcessor:
                 beg = max(beg, self.last_end)
 
             self.last_end = end
-            print("%1.0f %1.0f %s" % (beg,end,o[2]),flush=True,file=sys.stderr)
-            return "%1.0f %1.0f %s" % (beg,end,o[2])
+            print(format_line(beg,end,o[2]),flush=True,file=sys.stderr)
+            return (round(beg), round(end), o[2])
         else:
             logger.debug("No text in this segment")
             return None
 
     def send_result(self, o):
-        msg = self.format_output_transcript(o)
-        if msg is not None:
-            self.connection.send(msg)
+        segment = self.output_segment(o)
+        if segment is not None:
+            self.connection.send_text(*segment)
+        interim = self.online_asr_proc.interim()
+        if self.overload is not None and self.overload.skip_interim(interim):
+            interim = (None, None, "")  # the last displayed interim is cleared, once
+        self.send_interim(interim)
+
+    def send_interim(self, o):
+        # the interim text starts after the commited one, as the commited segments don't overlap
+        if o[0] is None:
+            self.connection.send_interim(0, 0, "")
+            return
+        beg, end = o[0]*1000, o[1]*1000
+        if self.last_end is not None:
+            beg = max(beg, self.last_end)
+        self.connection.send_interim(round(beg), round(max(beg, end)), o[2])
+
+    def update_chunk_size(self, duration, chunk_sec):
+        buffer_sec = self.online_asr_proc.last_transcribed_sec
+        if self.chunk_controller is None or buffer_sec is None:
+            return
+        size = self.chunk_controller.update(duration, chunk_sec, buffer_sec)
+        if isinstance(self.online_asr_proc, VACOnlineASRProcessor):
+            self.online_asr_proc.online_chunk_size = size
+        else:
+            self.min_chunk = size
+
+    def update_metrics(self, o):
+        proc = self.online_asr_proc
+        if proc.last_transcribed_sec is not None:
+            self.metrics.observe("transcribe_duration_seconds", proc.last_transcribe_duration)
+            self.metrics.observe("audio_buffer_seconds", proc.last_transcribed_sec)
+        if isinstance(proc, VACOnlineASRProcessor):
+            vad, voice = proc.vad_samples - self.vad_counts[0], proc.voice_samples - self.vad_counts[1]
+            self.vad_counts = (proc.vad_samples, proc.voice_samples)
+            if vad:
+                self.metrics.observe("vad_speech_ratio", voice/vad)
+        if proc.memo is not None:
+            m = proc.memo
+            counts = (m.hits, m.skips, m.misses, m.saved_sec)
+            for name, new, old in zip(("transcribe_memo_hits", "transcribe_memo_skips", "transcribe_memo_misses", "transcribe_memo_saved_seconds"), counts, self.memo_counts):
+                if new != old:
+                    self.metrics.inc(name, new - old)
+            self.memo_counts = counts
+        if o[0] is not None:
+            # the wall time when the end of the commited audio was received
+            end = o[1]*SAMPLING_RATE
+            i = bisect.bisect_left(self.receive_times, (end,))
+            if i < len(self.receive_times):
+                self.metrics.observe("commit_latency_seconds", time.time() - self.receive_times[i][1])
+            # the older audio can't be commited anymore
+            for _ in range(i):
+                self.receive_times.popleft()
 
     def process(self):
         # handle one client connection
@@ -266,12 +536,31 @@ class ServerProcessor:
             if a is None:
                 break
             self.online_asr_proc.insert_audio_chunk(a)
+            self.unprocessed += len(a) + self.silence
+            self.backlog += len(a)
+            if self.silence and not self.online_asr_proc.insert_silence(self.silence) and self.unprocessed < self.min_chunk*SAMPLING_RATE:
+                continue  # a short pause, it's processed with the next chunk
+            chunk_sec = self.unprocessed/SAMPLING_RATE  # all the new audio of this process_iter, not only a
+            self.unprocessed = 0
+            if self.overload is not None:
+                self.overload.update(self.backlog/SAMPLING_RATE)
+            self.backlog = 0
+            t = time.time()
             o = self.online_asr_proc.process_iter()
+            if self.overload is not None:
+                self.overload.after_iter()
+            self.update_chunk_size(time.time()-t, chunk_sec)
+            if self.metrics is not None:
+                self.update_metrics(o)
             try:
                 self.send_result(o)
             except BrokenPipeError:
                 logger.info("broken pipe -- connection closed?")
                 break
+        if self.online_asr_proc.memo is not None:
+            logger.info(self.online_asr_proc.memo.report())
+        if self.overload is not None:
+            logger.info(self.overload.report())
 
 #        o = self.online_asr_proc.finish()  # this should be working
 #        self.send_result(o)
@@ -283,14 +572,264 @@ def check_shutdown_command():
         return True
     return False
 
-def main():
-    parser = argparse.ArgumentParser()
+class SharedASR:
+    '''Wraps the one loaded ASR object that is shared by all the client sessions. 
+
+    The sessions are served from their own threads. Their transcribe calls are put to a queue, and a scheduler 
+    thread collects the pending ones within a short time window (batch_window seconds after the first one arrived, 
+    at most batch_size of them) and runs them as one asr.transcribe_batch call. The results are routed back 
+    to the waiting sessions, which continue with HypothesisBuffer.insert as usual. 
+    With batch_size=1, the calls are just serialized.
+
+    The other attributes (sep, ts_words, segments_end_ts, ...) are passed through.
+    '''
+
+    REPORT_EVERY = 60  # seconds between throughput reports
+
+    def __init__(self, asr, batch_size=1, batch_window=0.05):
+        self.asr = asr
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.requests = queue.Queue()
+
+        # throughput statistics: batch size -> [number of batches, audio seconds, model call seconds]
+        self.stats = {}
+        self.last_report = time.time()
+
+        self.scheduler = threading.Thread(target=self.run, name="transcribe-scheduler", daemon=True)
+        self.scheduler.start()
+
+    def transcribe(self, audio, init_prompt="", prefix=None, beam_size=None):
+        request = {"audio": audio, "init_prompt": init_prompt, "prefix": prefix, "beam_size": beam_size, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["result"]
+
+    def backlog(self):
+        """the number of the transcribe calls that wait for the model"""
+        return self.requests.qsize()
+
+    def collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
 
-    # server options
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            t = time.time()
+            try:
+                results = self.asr.transcribe_batch([r["audio"] for r in batch], [r["init_prompt"] for r in batch], [r["prefix"] for r in batch], [r["beam_size"] for r in batch])
+            except Exception as e:
+                for r in batch:
+                    r["error"] = e
+            else:
+                for r, res in zip(batch, results):
+                    r["result"] = res
+            e = time.time()
+            for r in batch:
+                r["done"].set()
+            self.update_stats(batch, e-t)
+
+    def update_stats(self, batch, duration):
+        s = self.stats.setdefault(len(batch), [0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += sum(len(r["audio"]) for r in batch)/SAMPLING_RATE
+        s[2] += duration
+        logger.debug(f"transcribed a batch of {len(batch)} in {duration:.3f} seconds")
+        if time.time() - self.last_report > self.REPORT_EVERY:
+            self.report()
+
+    def report(self):
+        """Logs the throughput per batch size, in seconds of audio transcribed per second of model calls. 
+        The batches of size 1 are the single-call mode, so the speed-up of batching is relative to them."""
+        self.last_report = time.time()
+        single = self.stats.get(1)
+        single_tp = single[1]/single[2] if single and single[2] > 0 else None
+        for size in sorted(self.stats):
+            n, audio_sec, call_sec = self.stats[size]
+            tp = audio_sec/call_sec if call_sec > 0 else 0
+            msg = f"batch size {size}: {n} calls, {audio_sec:.1f} s of audio in {call_sec:.1f} s, throughput {tp:.2f}x real time"
+            if single_tp and size > 1:
+                msg += f", {tp/single_tp:.2f}x of the single-call mode"
+            logger.info(msg)
+
+    def __getattr__(self, name):
+        return getattr(self.asr, name)
+
+def fallback_backend(args):
+    """the smaller model of the "model" overload step (--overload-model), or None"""
+    if "model" not in args.overload_steps:
+        return None
+    return backend_factory(argparse.Namespace(**{**vars(args), "model": args.overload_model, "model_dir": None}))
+
+def overload_factory(args, online, fallback_asr=None, asr=None, metrics=None, name=""):
+    """OverloadManager of the session with --overload-steps, or None. 
+    asr: SharedASR, its queue of transcribe calls is watched"""
+    if not args.overload_steps:
+        return None
+    from overload import OverloadManager
+    inner = online.online if isinstance(online, VACOnlineASRProcessor) else online
+    return OverloadManager(inner, args.overload_steps, max_backlog_sec=args.overload_max_backlog, max_buffer_sec=args.overload_max_buffer, 
+                           max_queue=args.overload_max_queue, queue_depth=getattr(asr, "backlog", None), 
+                           beam_size=args.overload_beam_size, fallback_asr=fallback_asr, metrics=metrics, name=name)
+
+class CaptionServer:
+    '''Accepts many client connections at once. 
+
+    The listening socket is watched by a selector, so that the shutdown command is checked periodically. 
+    Every accepted connection gets its own OnlineASRProcessor (or VACOnlineASRProcessor) from online_factory, 
+    and it's served by ServerProcessor in its own thread. All the sessions share one resident ASR model, and with --vac
+    one VAD engine.
+    '''
+
+    def __init__(self, args, asr, metrics=None, vad_engine=None, pool=None, fallback_asr=None):
+        """With pool (worker_pool.WorkerPool), the sessions are processed in the worker processes, and asr is None.
+        fallback_asr: the smaller model of the "model" overload step, or None"""
+        self.args = args
+        self.asr = SharedASR(asr, batch_size=args.batch_size, batch_window=args.batch_window) if asr is not None else None
+        self.fallback_asr = SharedASR(fallback_asr, batch_size=args.batch_size, batch_window=args.batch_window) if fallback_asr is not None else None
+        self.metrics = metrics
+        self.vad_engine = vad_engine  # from vad_engine_factory, shared by the VAC sessions
+        self.pool = pool
+        self.sessions = {}  # thread name -> client address
+        self.lock = threading.Lock()
+
+    def serve(self, s):
+        sel = selectors.DefaultSelector()
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+        try:
+            while True:
+                if check_shutdown_command():
+                    logger.info('Shutdown command received, stopping server...')
+                    break
+                # time out so we can check for shutdown command periodically
+                for key, _ in sel.select(timeout=1.0):
+                    try:
+                        conn, addr = s.accept()
+                    except BlockingIOError:
+                        continue
+                    self.start_session(conn, addr)
+        finally:
+            sel.close()
+            if self.asr is not None:
+                self.asr.report()
+            if self.pool is not None:
+                self.pool.stop()
+
+    def start_session(self, conn, addr):
+        online = online_factory(self.args, self.asr, vad_engine=self.vad_engine) if self.pool is None else None
+        t = threading.Thread(target=self.run_session, args=(conn, addr, online), name="session-%s:%d" % addr, daemon=True)
+        with self.lock:
+            self.sessions[t.name] = addr
+            n = len(self.sessions)
+        logger.info('Connected to client on {}, {} session(s) active'.format(addr, n))
+        t.start()
+
+    def run_session(self, conn, addr, online):
+        metrics = self.metrics.session("%s:%d" % addr) if self.metrics is not None else None
+        try:
+            with conn:
+                conn.setblocking(True)
+                connection = Connection(conn, metrics)
+                if self.pool is not None:
+                    self.pool.serve(connection)
+                else:
+                    overload = overload_factory(self.args, online, self.fallback_asr, self.asr, metrics, "session %s:%d" % addr)
+                    proc = ServerProcessor(connection, online, self.args.min_chunk_size, chunk_controller_factory(self.args), metrics, overload)
+                    proc.process()
+        except Exception as e:
+            logger.error(f'Error processing connection {addr}: {str(e)}')
+        finally:
+            if online is not None:
+                online.close()
+            if metrics is not None:
+                metrics.close()
+            with self.lock:
+                self.sessions.pop(threading.current_thread().name, None)
+                n = len(self.sessions)
+            logger.info('Connection to client {} closed, {} session(s) active'.format(addr, n))
+
+class StartupTimer:
+    '''Measures the phases of the server startup (imports, model load, VAD load, warm-up) and logs them in one report,
+    to see what delays the first caption.'''
+
+    def __init__(self, start=STARTUP_TIME):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def phase(self, name):
+        """ends the phase name, that started at the end of the previous one"""
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def skip(self):
+        """the time since the last phase is not counted to the next one, e.g. the interactive setup"""
+        now = time.time()
+        self.start += now - self.last
+        self.last = now
+
+    def report(self):
+        phases = ", ".join(f"{name} {sec:.2f} s" for name, sec in self.phases)
+        logger.info(f"Startup took {self.last - self.start:.2f} seconds: {phases}")
+
+def add_server_args(parser):
+    """the options of the server, without the shared ones of whisper_online.add_shared_args"""
     parser.add_argument("--host", type=str, default='0.0.0.0')
     parser.add_argument("--port", type=int, default=43007)
     parser.add_argument("--warmup-file", type=str, dest="warmup_file", 
             help="The path to a speech audio wav file to warm up Whisper...")
+    parser.add_argument("--batch-size", type=int, default=1, dest="batch_size",
+            help="Maximum number of transcribe calls of concurrent client sessions that are run as one batched model call. 1 means no batching.")
+    parser.add_argument("--batch-window", type=float, default=0.05, dest="batch_window",
+            help="How long to wait in seconds for more transcribe calls of other sessions to fill a batch.")
+    parser.add_argument("--metrics-port", type=int, default=0, dest="metrics_port",
+            help="Serve Prometheus metrics of the sessions on this HTTP port, at /metrics. 0 means no metrics.")
+    parser.add_argument("--metrics-host", type=str, default="127.0.0.1", dest="metrics_host",
+            help="Host address of the metrics HTTP server. Local only by default.")
+    parser.add_argument("--workers", type=int, default=0,
+            help="Process the sessions in this many worker processes, each with its own model, to use more CPU cores. 0 means in the server process. "
+                 "The workers share the weights of a model on CPU loaded before fork, but not of faster-whisper, which every worker loads again.")
+    parser.add_argument("--worker-start", type=str, default="auto", choices=["auto", "fork", "spawn"], dest="worker_start",
+            help="How the worker processes are started. auto: fork on CPU, the model is loaded before fork if the backend allows it; spawn on CUDA, always.")
+    parser.add_argument("--worker-ring-sec", type=float, default=60, dest="worker_ring_sec",
+            help="Size of the shared memory audio buffer of a session, in seconds. The client waits when it's full.")
+
+    parser.add_argument("--overload-steps", type=str, nargs="*", default=[], choices=["interim", "trim", "beam", "model"], dest="overload_steps",
+            help="Overload protection: the degradation steps that are applied one by one, in this order, while a session falls behind real time, "
+                 "and undone when it recovers. interim: no interim hypotheses; trim: force-commit and hard-trim the audio buffer at --overload-max-buffer; "
+                 "beam: --overload-beam-size (faster-whisper); model: the smaller --overload-model. Default: no overload protection.")
+    parser.add_argument("--overload-max-backlog", type=float, default=3.0, dest="overload_max_backlog",
+            help="A session is overloaded when more than this many seconds of audio wait for a processing iteration.")
+    parser.add_argument("--overload-max-buffer", type=float, default=30.0, dest="overload_max_buffer",
+            help="A session is overloaded when its audio buffer is longer, in seconds. The trim step hard-trims it at this length.")
+    parser.add_argument("--overload-max-queue", type=int, default=0, dest="overload_max_queue",
+            help="A session is overloaded when more transcribe calls of all the sessions wait for the model. 0 means it's not watched.")
+    parser.add_argument("--overload-beam-size", type=int, default=1, dest="overload_beam_size",
+            help="Beam size of the beam step.")
+    parser.add_argument("--overload-model", type=str, default=None, dest="overload_model",
+            help="The smaller model of the model step, e.g. base. It's loaded at the start.")
+
+def main():
+    timer = StartupTimer()
+    timer.phase("imports")
+    parser = argparse.ArgumentParser()
+
+    add_server_args(parser)
 
     # options from whisper_online
     add_shared_args(parser)
@@ -307,59 +846,63 @@ def main():
             f.write("="*50 + "\n")
 
     args = parser.parse_args()
+    if "model" in args.overload_steps and not args.overload_model:
+        parser.error("the model overload step needs --overload-model")
     set_logging(args, logger, other="")
+    timer.skip()
 
     size = args.model
     language = args.lan
-    asr, online = asr_factory(args)
-    min_chunk = args.min_chunk_size
-
-    # warm up the ASR...
     msg = "Whisper is not warmed up. The first chunk processing may take longer."
-    if args.warmup_file:
-        if os.path.isfile(args.warmup_file):
+    if args.warmup_file and not os.path.isfile(args.warmup_file):
+        logger.critical("The warm up file is not available. "+msg)
+        sys.exit(1)
+    elif not args.warmup_file:
+        logger.warning(msg)
+
+    asr = vad_engine = pool = fallback_asr = None
+    if args.workers:
+        from worker_pool import WorkerPool
+        pool = WorkerPool(args, args.workers)
+        pool.wait_ready()
+        timer.phase("workers' model load, VAD load and warm-up")
+    else:
+        asr = backend_factory(args)
+        timer.phase("model load")
+        fallback_asr = fallback_backend(args)
+        if fallback_asr is not None:
+            timer.phase("fallback model load")
+        vad_engine = vad_engine_factory(args)
+        timer.phase("VAD load")
+        if args.buffer_trimming == "sentence":
+            shared_tokenizer(sentence_tokenizer_language(args), args.sentence_tokenizer, args.wtp_model)
+            timer.phase("sentence tokenizer load")
+
+        # warm up the ASR...
+        if args.warmup_file:
             a = load_audio_chunk(args.warmup_file,0,1)
             asr.transcribe(a)
             logger.info("Whisper is warmed up.")
-        else:
-            logger.critical("The warm up file is not available. "+msg)
-            sys.exit(1)
-    else:
-        logger.warning(msg)
+        if vad_engine is not None:
+            from silero_vad import BatchedVADIterator
+            BatchedVADIterator(vad_engine).events(np.zeros((1, 512), dtype=np.float32))
+        timer.phase("warm-up")
+    timer.report()
 
     # Server loop
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind((args.host, args.port))
-            s.listen(1)
+            s.listen()
             logger.info('Listening on'+str((args.host, args.port)))
             logger.info('Press Ctrl+C or create "shutdown.txt" file to stop the server')
-            
-            while True:
-                if check_shutdown_command():
-                    logger.info('Shutdown command received, stopping server...')
-                    break
-                    
-                try:
-                    # Set a timeout so we can check for shutdown command periodically
-                    s.settimeout(1.0)
-                    conn, addr = s.accept()
-                    s.settimeout(None)  # Reset timeout for normal operation
-                    
-                    logger.info('Connected to client on {}'.format(addr))
-                    connection = Connection(conn)
-                    proc = ServerProcessor(connection, online, args.min_chunk_size)
-                    proc.process()
-                    conn.close()
-                    logger.info('Connection to client closed')
-                except socket.timeout:
-                    continue  # Check for shutdown command again
-                except KeyboardInterrupt:
-                    logger.info('Received interrupt, shutting down...')
-                    break
-                except Exception as e:
-                    logger.error(f'Error processing connection: {str(e)}')
-                    continue
+
+            metrics = None
+            if args.metrics_port:
+                metrics = ServerMetrics()
+                metrics.serve(args.metrics_host, args.metrics_port)
+            CaptionServer(args, asr, metrics, vad_engine, pool, fallback_asr).serve(s)
                 
     except KeyboardInterrupt:
         logger.info('Received interrupt, shutting down...')
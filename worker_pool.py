@@ -0,0 +1,418 @@
+"""Multi-process mode of whisper_online_server (--workers N).
+
+The Python-level work of the sessions (VAD, hypothesis merging, PCM decoding) holds the GIL, so one process uses
+one core for it. With --workers N, the server process is only the socket front end: it accepts the clients and
+moves their audio to N worker processes, which run the sessions with ServerProcessor as the single-process server
+does, each with its own ASR model.
+
+The audio goes through a shared memory ring buffer per session (SharedRing). The front end copies the received bytes
+to it and sends only a small notification with the new write position through the control pipe of the worker. The
+worker sends the commited text back through its result pipe, and the front end sends it to the client, in the
+protocol of the client's connection (framed or text lines). With --metrics-port, the worker sends also the values of
+the session's metrics through the result pipe, and the front end records them to its ServerMetrics.
+
+The workers are forked after the model is loaded, so that they share its memory copy-on-write, if the backend allows
+it (ASRBase.fork_after_load) and the model is on CPU. Otherwise they are forked before loading (faster-whisper on
+CPU), or spawned on CUDA, also with --worker-start fork, and every worker loads its own model. A CTranslate2 model
+doesn't work after fork (its threads aren't in the child), so with faster-whisper, the default backend, the workers
+don't share the weights: N workers need N times the memory of the model.
+"""
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from whisper_online import *
+import whisper_online_server as server
+
+logger = logging.getLogger(__name__)
+
+
+class SharedRing:
+    '''Single-producer single-consumer ring buffer of bytes in shared memory.
+
+    The header contains the write and read positions, as the total number of bytes written and read, so they only grow.
+    The producer (front end) writes the data, then the write position. The consumer (worker) reads only up to the
+    write position that it was notified about, then it moves the read position.
+    '''
+
+    HEADER = 16  # two int64 positions
+
+    def __init__(self, capacity=None, name=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER + capacity)
+            self.owner = True
+        else:
+            # the workers share the resource tracker of the front end (WorkerPool), so the segment is unlinked only by the front end
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.capacity = capacity or self.shm.size - self.HEADER
+        self.pos = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray(self.capacity, dtype=np.uint8, buffer=self.shm.buf, offset=self.HEADER)
+        if self.owner:
+            self.pos[:] = 0
+        self.closed = False
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def free(self):
+        return self.capacity - (int(self.pos[0]) - int(self.pos[1]))
+
+    def write(self, b):
+        """copies the bytes b to the ring, it waits while the ring is full. Returns the new write position."""
+        n = len(b)
+        if n > self.capacity:
+            raise ValueError(f"{n} bytes don't fit into the ring of {self.capacity} bytes")
+        while self.free() < n:
+            if self.closed:
+                raise BrokenPipeError("the ring is closed")
+            time.sleep(0.01)
+        b = np.frombuffer(b, dtype=np.uint8)
+        w = int(self.pos[0])
+        start = w % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[start:start+first] = b[:first]
+        self.data[:n-first] = b[first:]
+        self.pos[0] = w + n
+        return w + n
+
+    def read(self, until):
+        """returns a copy of the bytes from the read position until the given write position"""
+        r = int(self.pos[1])
+        n = until - r
+        start = r % self.capacity
+        first = min(n, self.capacity - start)
+        out = np.empty(n, dtype=np.uint8)
+        out[:first] = self.data[start:start+first]
+        out[first:] = self.data[:n-first]
+        self.pos[1] = until
+        return out
+
+    def close(self):
+        self.closed = True
+        del self.pos, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingConnection:
+    '''Replaces server.Connection in the worker: the audio of the session is read from the SharedRing,
+    and the commited text is sent to the front end through the result pipe.'''
+
+    def __init__(self, sid, ring, results, results_lock):
+        self.sid = sid
+        self.ring = ring
+        self.results = results
+        self.results_lock = results_lock
+        self.cond = threading.Condition()
+        self.written = 0  # the write position from the last notification
+        self.closed = False
+        self.carry = np.empty(0, dtype=np.uint8)  # an odd byte, the half of a sample
+        self.silences = deque()  # (ring position, samples) of the silences that the client didn't send
+
+    def notify(self, written=None, closed=False, silence=None):
+        with self.cond:
+            if written is not None:
+                self.written = written
+            if silence is not None:
+                self.silences.append(silence)
+            self.closed = self.closed or closed
+            self.cond.notify()
+
+    def non_blocking_receive_audio(self):
+        '''returns float32 audio samples that are available now, it waits for at least one, or None if the session is closed,
+        or the number of samples of silence, as server.Connection'''
+        with self.cond:
+            while True:
+                # the audio is read only until the next silence
+                until = self.silences[0][0] if self.silences else self.written
+                if self.silences and until == int(self.ring.pos[1]):
+                    return self.silences.popleft()[1]
+                if until - int(self.ring.pos[1]) + len(self.carry) >= 2 or self.closed:
+                    break
+                self.cond.wait()
+            written = until
+        b = self.ring.read(written)
+        if len(self.carry):
+            b = np.concatenate([self.carry, b])
+        if len(b) < 2:
+            return None
+        even = len(b) // 2 * 2
+        self.carry = b[even:]
+        return server.pcm16_to_float32(b[:even])
+
+    def send_text(self, beg, end, text):
+        with self.results_lock:
+            self.results.send(("text", self.sid, (beg, end, text)))
+
+    def send_interim(self, beg, end, text):
+        with self.results_lock:
+            self.results.send(("interim", self.sid, (beg, end, text)))
+
+
+class PipeMetrics:
+    '''Replaces server_metrics.SessionMetrics in the worker: the values are sent through the result pipe, and the front
+    end records them to the metrics of the client's session (--metrics-port).'''
+
+    def __init__(self, sid, results, results_lock):
+        self.sid = sid
+        self.results = results
+        self.results_lock = results_lock
+
+    def observe(self, metric, value):
+        with self.results_lock:
+            self.results.send(("metrics", self.sid, ("observe", metric, value)))
+
+    def inc(self, metric, value=1):
+        with self.results_lock:
+            self.results.send(("metrics", self.sid, ("inc", metric, value)))
+
+
+def worker_main(index, args, asr, control, results):
+    """The worker process. asr is the model loaded before fork, or None to load it here."""
+    set_logging(args, logger, other="")
+    server.logger.setLevel(args.log_level)
+    if asr is None:
+        asr = backend_factory(args)
+    if args.warmup_file:
+        asr.transcribe(load_audio_chunk(args.warmup_file, 0, 1))
+    asr = server.SharedASR(asr, batch_size=args.batch_size, batch_window=args.batch_window)
+    fallback_asr = server.fallback_backend(args)
+    if fallback_asr is not None:
+        fallback_asr = server.SharedASR(fallback_asr, batch_size=args.batch_size, batch_window=args.batch_window)
+    vad_engine = vad_engine_factory(args)
+    if args.buffer_trimming == "sentence":
+        shared_tokenizer(sentence_tokenizer_language(args), args.sentence_tokenizer, args.wtp_model)
+    logger.info(f"worker {index} (pid {os.getpid()}) is ready")
+
+    results_lock = threading.Lock()
+    with results_lock:
+        results.send(("ready", None, None))
+    sessions = {}
+
+    def run_session(connection):
+        online = None
+        try:
+            online = online_factory(args, asr, vad_engine=vad_engine)
+            # the connection's metrics (received bytes, sent lines) are counted by the front end
+            metrics = PipeMetrics(connection.sid, results, results_lock) if args.metrics_port else None
+            overload = server.overload_factory(args, online, fallback_asr, asr, metrics, name=f"worker {index} session {connection.sid}")
+            proc = server.ServerProcessor(connection, online, args.min_chunk_size, chunk_controller_factory(args), metrics, overload)
+            proc.process()
+        except Exception as e:
+            logger.error(f"worker {index}: error in session {connection.sid}: {e}")
+        finally:
+            if online is not None:
+                online.close()
+            connection.ring.close()
+            with results_lock:
+                results.send(("done", connection.sid, None))
+
+    while True:
+        try:
+            msg = control.recv()
+        except EOFError:
+            break
+        kind = msg[0]
+        if kind == "data":
+            _, sid, written = msg
+            sessions[sid].notify(written=written)
+        elif kind == "silence":
+            _, sid, position, samples = msg
+            sessions[sid].notify(silence=(position, samples))
+        elif kind == "open":
+            _, sid, name, capacity = msg
+            connection = RingConnection(sid, SharedRing(capacity, name=name), results, results_lock)
+            sessions[sid] = connection
+            threading.Thread(target=run_session, args=(connection,), name=f"worker-session-{sid}", daemon=True).start()
+        elif kind == "close":
+            sessions.pop(msg[1]).notify(closed=True)
+        elif kind == "stop":
+            break
+    asr.report()
+
+
+class Worker:
+    '''Front end's handle of one worker process'''
+
+    def __init__(self, index, context, args, asr):
+        self.index = index
+        child_control, self.control = context.Pipe(duplex=False)
+        self.results, child_results = context.Pipe(duplex=False)
+        self.process = context.Process(target=worker_main, args=(index, args, asr, child_control, child_results), name=f"whisper-worker-{index}", daemon=True)
+        self.child_pipes = [child_control, child_results]
+        self.control_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.sessions = {}  # sid -> PoolSession
+
+    def start(self):
+        self.process.start()
+        # the front end must not keep the worker's ends, so that it gets EOF when the worker ends
+        for p in self.child_pipes:
+            p.close()
+
+    def send(self, *msg):
+        with self.control_lock:
+            self.control.send(msg)
+
+class PoolSession:
+    '''One client session, served by a worker'''
+
+    def __init__(self, sid, worker, connection, capacity):
+        self.sid = sid
+        self.worker = worker
+        self.connection = connection
+        self.ring = SharedRing(capacity)
+        self.done = threading.Event()
+
+    def write(self, b):
+        self.worker.send("data", self.sid, self.ring.write(b))
+
+    def silence(self, samples):
+        """the silence of samples, after the audio written so far"""
+        self.worker.send("silence", self.sid, int(self.ring.pos[0]), samples)
+
+    def close(self):
+        """ends the audio, waits until the worker sends all the text, and frees the ring"""
+        try:
+            self.worker.send("close", self.sid)
+        except OSError:  # the worker ended
+            pass
+        self.done.wait()
+        self.ring.close()
+
+class WorkerPool:
+    '''Starts the worker processes and assigns the sessions to them, the least busy one first.'''
+
+    def __init__(self, args, n):
+        self.args = args
+        method, preload = start_method(args)
+        context = multiprocessing.get_context(method)
+        # the model is loaded here only if the forked workers can share it
+        asr = backend_factory(args) if preload else None
+        logger.info(f"Starting {n} workers ({method}, {'sharing the loaded model' if asr is not None else 'every worker loads the model'})")
+        self.workers = [Worker(i, context, args, asr) for i in range(n)]
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.next_sid = 0
+        self.ring_capacity = int(args.worker_ring_sec * server.SAMPLING_RATE * 2)
+        # the workers inherit the resource tracker of shared memory, and don't start their own ones
+        resource_tracker.ensure_running()
+        for w in self.workers:
+            w.start()
+            threading.Thread(target=self.dispatch, args=(w,), name=f"worker-results-{w.index}", daemon=True).start()
+
+    def wait_ready(self):
+        """waits until all the workers loaded and warmed up their models"""
+        for w in self.workers:
+            while not w.ready.wait(timeout=1.0):
+                if not w.process.is_alive():
+                    raise RuntimeError(f"worker {w.index} failed to start, exit code {w.process.exitcode}")
+
+    def serve(self, connection):
+        """forwards the audio of the client connection (server.Connection) to a worker until the client closes it"""
+        session = self.open_session(connection)
+        try:
+            while True:
+                data = connection.receive_pcm()
+                if data is None:
+                    break
+                if isinstance(data, int):
+                    session.silence(data)
+                elif len(data):
+                    session.write(data)
+        finally:
+            session.close()
+
+    def open_session(self, connection):
+        with self.lock:
+            worker = min(self.workers, key=lambda w: len(w.sessions))
+            sid = self.next_sid
+            self.next_sid += 1
+            session = PoolSession(sid, worker, connection, self.ring_capacity)
+            worker.sessions[sid] = session
+        worker.send("open", sid, session.ring.name, session.ring.capacity)
+        logger.debug(f"session {sid} goes to worker {worker.index}")
+        return session
+
+    def dispatch(self, worker):
+        # receives the results of the worker, in a thread of the front end
+        while True:
+            try:
+                kind, sid, segment = worker.results.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                worker.ready.set()
+                continue
+            session = worker.sessions.get(sid)
+            if session is None:
+                continue
+            if kind in ("text", "interim"):
+                try:
+                    if kind == "text":
+                        session.connection.send_text(*segment)
+                    else:
+                        session.connection.send_interim(*segment)
+                except OSError:
+                    logger.info(f"session {sid}: the client connection is closed")
+            elif kind == "metrics":
+                if session.connection.metrics is not None:
+                    method, metric, value = segment
+                    getattr(session.connection.metrics, method)(metric, value)
+            elif kind == "done":
+                with self.lock:
+                    worker.sessions.pop(sid, None)
+                session.done.set()
+        # the worker ended, its sessions can't continue
+        if not self.stopping:
+            logger.error(f"worker {worker.index} ended unexpectedly")
+        with self.lock:
+            sessions = list(worker.sessions.values())
+            worker.sessions.clear()
+        for session in sessions:
+            session.ring.closed = True  # a waiting write raises BrokenPipeError
+            session.done.set()
+
+    def stop(self):
+        self.stopping = True
+        for w in self.workers:
+            try:
+                w.send("stop")
+            except OSError:
+                pass
+        for w in self.workers:
+            w.process.join(timeout=5)
+            if w.process.is_alive():
+                w.process.terminate()
+
+def start_method(args):
+    """(multiprocessing start method, whether the workers can use the model loaded before fork)"""
+    if args.worker_start == "spawn" or "fork" not in multiprocessing.get_all_start_methods():
+        return "spawn", False
+    if model_device(args) == "cuda":
+        # CUDA can't be used in a process forked from a process that initialized it
+        if args.worker_start == "fork":
+            logger.warning("--worker-start fork does not work with a model on CUDA, the workers are spawned")
+        return "spawn", False
+    backend = {"faster-whisper": FasterWhisperASR, "whisper_timestamped": WhisperTimestampedASR, "openai-api": OpenaiApiASR}[args.backend]
+    return "fork", backend.fork_after_load
+
+def model_device(args):
+    """cpu or cuda, where the model of args will run"""
+    if args.backend == "openai-api" or args.device == "cpu":
+        return "cpu"
+    if args.device == "cuda":
+        return "cuda"
+    if args.backend == "faster-whisper":
+        return FasterWhisperASR.detect_device(args.device, args.compute_type)[0]
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"